@@ -190,41 +190,52 @@ class circus_clust(object):
     def _make_referenced_circus_npy(self):
         emap = self._emap
         file_dir = self._rec_dir
-        all_data = None
+        traces = []
         for i, row in emap.iterrows():
             el = row["Electrode"]
             if row["dead"]:
-                trace = h5io.get_raw_trace(file_dir, el, emap)
+                trace = h5io.get_raw_trace(rec_dir=file_dir, chan_idx=el)
             else:
                 trace = h5io.get_referenced_trace(file_dir, el)
 
             if trace is None:
                 raise ValueError("Unable to obtain data trace for electrode %i" % el)
 
-            if all_data is None:
-                all_data = trace
-            else:
-                all_data = np.vstack((all_data, trace))
+            traces.append(trace)
 
-        np.save(self._data_file, all_data)
+        self._write_circus_npy(traces)
 
     def _make_raw_circus_npy(self):
         emap = self._emap
         file_dir = self._rec_dir
-        all_data = None
+        traces = []
         for i, row in emap.iterrows():
             el = row["Electrode"]
-            trace = h5io.get_raw_trace(file_dir, el, emap)
+            trace = h5io.get_raw_trace(rec_dir=file_dir, chan_idx=el)
 
             if trace is None:
                 raise ValueError("Unable to obtain data trace for electrode %i" % el)
 
-            if all_data is None:
-                all_data = trace
-            else:
-                all_data = np.vstack((all_data, trace))
+            traces.append(trace)
+
+        self._write_circus_npy(traces)
+
+    def _write_circus_npy(self, traces):
+        """Writes traces row by row into a channel-major .npy file, raw traces
+        that are memory-mapped are copied straight from their pages without
+        stacking everything in memory first"""
+        if len(set(len(x) for x in traces)) > 1:
+            raise ValueError("All electrode traces must be the same length")
+
+        dtype = np.result_type(*traces)
+        all_data = np.lib.format.open_memmap(
+            self._data_file, mode="w+", dtype=dtype, shape=(len(traces), len(traces[0]))
+        )
+        for i, trace in enumerate(traces):
+            all_data[i] = trace
 
-        np.save(self._data_file, all_data)
+        all_data.flush()
+        del all_data
 
     def start_the_show(self):
         fn = os.path.basename(self._data_file)
@@ -2,6 +2,7 @@ from __future__ import annotations
 
 import itertools
 import logging
+import multiprocessing
 import os
 import shutil
 from collections.abc import Iterable
@@ -9,20 +10,20 @@ from copy import deepcopy
 from datetime import datetime
 from pathlib import Path
 from icecream import ic
+from joblib import Parallel, delayed, effective_n_jobs
 import mne
+from numba import njit, prange
 
 import numpy as np
 import pandas as pd
 import pywt
 import umap
 from scipy import linalg
-from scipy.signal import find_peaks
 from scipy.spatial.distance import mahalanobis
-from sklearn.decomposition import PCA
+from sklearn.decomposition import PCA, IncrementalPCA
 from sklearn.mixture import GaussianMixture
 from statsmodels.stats.diagnostic import lilliefors
-from scipy.interpolate import interp1d
-from scipy.signal import butter, filtfilt
+from scipy.signal import butter, sos2zpk, sosfiltfilt
 
 from cpl_pipeline.analysis.spike_analysis import spike_time_xcorr, spike_time_acorr
 from cpl_pipeline.plot.data_plot import (
@@ -50,15 +51,103 @@ from cpl_pipeline.spk_io.writer import (
 logger = logging.getLogger(__name__)
 
 
-def get_filtered_electrode(data, freq=[300.0, 3000.0], sampling_rate=30000.0):
-    el = data
-    m, n = butter(
-        2,
+FILTER_BLOCK_SIZE = 1024 * 1024
+DEJITTER_BATCH_SIZE = 10000
+FEATURE_BATCH_SIZE = 50000
+RENDER_COMPLETE_FILE = "render_complete.txt"
+
+
+def get_filtered_electrode(data, freq=[300.0, 3000.0], sampling_rate=30000.0, out=None):
+    """
+    Bandpass filters an electrode trace, see :func:`filter_signal_chunked`.
+
+    data can be any sliceable 1-D trace (np.ndarray, np.memmap, tables.EArray), and out an
+    optional preallocated array (e.g. np.memmap) to write the filtered trace into.
+    """
+    return filter_signal_chunked(data, sampling_rate, freq, out=out, verbose=False)
+
+
+def get_bandpass_sos(freq, sampling_rate, order=2):
+    """Returns the second-order sections of the Butterworth bandpass filter used on electrode traces"""
+    return butter(
+        order,
         [2.0 * freq[0] / sampling_rate, 2.0 * freq[1] / sampling_rate],
         btype="bandpass",
+        output="sos",
     )
-    filt_el = filtfilt(m, n, el)
-    return filt_el
+
+
+def get_filter_overlap(sos, tol=1e-12):
+    """
+    Number of samples needed for the impulse response of a filter to decay below tol.
+
+    Taken from the largest pole radius, doubled as a margin for repeated poles.
+    """
+    _, poles, _ = sos2zpk(sos)
+    radius = np.max(np.abs(poles))
+    return int(2 * np.ceil(np.log(tol) / np.log(radius)))
+
+
+def filter_signal_chunked(
+        signal,
+        sampling_rate: int | float,
+        freq,
+        out=None,
+        block_size=FILTER_BLOCK_SIZE,
+        verbose=True,
+):
+    """
+    Zero-phase Butterworth bandpass filter applied block by block (overlap-save).
+
+    Each block is read with enough samples on either side for the filter transients to
+    decay, filtered forward and backward and only its center is kept, so the result matches
+    ``filtfilt`` on the whole signal to numerical precision while only one block is held in
+    memory at a time.
+
+    Parameters
+    ----------
+    signal : array-like
+        The input electrode signal as a 1-D sliceable array (np.ndarray, np.memmap, tables.EArray).
+    sampling_rate : float
+        The sampling rate of the signal in Hz.
+    freq : tuple
+        The frequency range for the bandpass filter as (low_frequency, high_frequency).
+    out : array-like (optional)
+        1-D array to write the filtered signal into, e.g. a np.memmap, allocated in memory if None.
+    block_size : int (optional)
+        Number of output samples filtered at a time.
+
+    Returns
+    -------
+    filt_el : array-like
+        The filtered electrode signal as a 1-D array, out if it was given.
+    """
+    if verbose:
+        print("Filtering electrode signal")
+
+    sos = get_bandpass_sos(freq, sampling_rate)
+    # padding filtfilt uses with the (b, a) form of the same filter
+    padlen = 3 * (2 * len(sos) + 1)
+    overlap = get_filter_overlap(sos)
+
+    n_samples = len(signal)
+    if out is None:
+        out = np.empty(n_samples, dtype=np.float64)
+    elif len(out) != n_samples:
+        raise ValueError("out must have the same length as signal")
+
+    for start in range(0, n_samples, block_size):
+        stop = min(start + block_size, n_samples)
+        read_start = max(start - overlap, 0)
+        read_stop = min(stop + overlap, n_samples)
+        block = np.asarray(signal[read_start:read_stop], dtype=np.float64)
+        filt_block = sosfiltfilt(sos, block, padlen=padlen)
+        out[start:stop] = filt_block[start - read_start: stop - read_start]
+
+    if isinstance(out, np.memmap):
+        out.flush()
+
+    return out
 
 
 def get_waveforms(
@@ -75,9 +164,7 @@ def get_waveforms(
     del el_trace
     pre_pts = int((snapshot[0] + 0.1) * (sampling_rate / 1000))
     post_pts = int((snapshot[1] + 0.2) * (sampling_rate / 1000))
-    slices = np.zeros((spike_times.shape[0], pre_pts + post_pts))
-    for i, st in enumerate(spike_times):
-        slices[i, :] = filt_el[st - pre_pts: st + post_pts]
+    slices = filt_el[np.asarray(spike_times)[:, None] + np.arange(-pre_pts, post_pts)]
 
     slices_dj, times_dj = dejitter(slices, spike_times, snapshot, sampling_rate)
 
@@ -120,23 +207,51 @@ def detect_spikes(filt_el, spike_snapshot, fs, thresh=None, verbose=True):
     if thresh is None:
         thresh = get_detection_threshold(filt_el)
 
-    pos = np.where(filt_el <= thresh)[0]
-    consecutive = group_consecutives(pos)
+    times = get_crossing_minima(filt_el, thresh)
+    keep = (times + snapshot[0] >= 0) & (times + snapshot[-1] < len(filt_el))
+    times = times[keep]
+    if len(times) == 0:
+        return None, None, thresh
 
-    waves = []
-    times = []
-    for idx in consecutive:
-        minimum = idx[np.argmin(filt_el[idx])]
-        spike_idx = minimum + snapshot
-        if spike_idx[0] >= 0 and spike_idx[-1] < len(filt_el):
-            waves.append(filt_el[spike_idx])
-            times.append(minimum)
+    waves = np.asarray(filt_el[times[:, None] + snapshot])
+    waves_dj, times_dj = dejitter(waves, times, spike_snapshot, fs, verbose=verbose)
+    return waves_dj, times_dj, thresh
 
-    if len(waves) == 0:
-        return None, None
 
-    waves_dj, times_dj = dejitter(np.array(waves), np.array(times), spike_snapshot, fs)
-    return waves_dj, times_dj, thresh
+def get_crossing_minima(filt_el, thresh):
+    """
+    Returns the index of the minimum of each run of consecutive samples at or below thresh.
+
+    Equivalent to taking the argmin over each group of :func:`group_consecutives`, computed
+    with array operations for all threshold crossings at once.
+
+    Parameters
+    ----------
+    filt_el : np.array, 1-D
+        filtered electrode trace
+    thresh : float
+        spike detection threshold
+
+    Returns
+    -------
+    np.array
+        sample index of each crossing's minimum, first occurrence on ties
+    """
+    pos = np.flatnonzero(filt_el <= thresh)
+    if len(pos) == 0:
+        return pos.astype("int64")
+
+    group_starts = np.concatenate(([0], np.flatnonzero(np.diff(pos) > 1) + 1))
+    group_ids = np.zeros(len(pos), dtype="int64")
+    group_ids[group_starts[1:]] = 1
+    group_ids = np.cumsum(group_ids)
+
+    values = np.asarray(filt_el[pos])
+    group_min = np.minimum.reduceat(values, group_starts)
+    at_min = np.flatnonzero(values == group_min[group_ids])
+    # first sample reaching the minimum in each group, as np.argmin
+    _, first = np.unique(group_ids[at_min], return_index=True)
+    return pos[at_min[first]].astype("int64")
 
 
 def group_consecutives(arr):
@@ -190,17 +305,7 @@ def filter_signal(
     filt_el : array-like
         The filtered electrode signal as a 1-D array.
     """
-
-    if verbose:
-        print("Filtering electrode signal")
-    # noinspection
-    m, n = butter(
-        2,
-        [2.0 * freq[0] / sampling_rate, 2.0 * freq[1] / sampling_rate],
-        btype="bandpass",
-    )
-    filt_el = filtfilt(m, n, signal)
-    return filt_el
+    return filter_signal_chunked(signal, sampling_rate, freq, verbose=verbose)
 
 
 def get_detection_threshold(filt_el, verbose=True):
@@ -256,34 +361,50 @@ def dejitter(
     """
     if verbose:
         print("Dejittering waveforms")
-    x = np.arange(0, len(slices[0]), 1)
-    xnew = np.arange(0, len(slices[0]) - 1, 0.1)
+    slices = np.asarray(slices)
+    spike_times = np.asarray(spike_times)
+    x = np.arange(0, slices.shape[1], 1)
+    xnew = np.arange(0, slices.shape[1] - 1, 0.1)
 
     # Calculate the number of samples to be sliced out around each spike's minimum
     before = int((sampling_rate / 1000.0) * (spike_snapshot[0]))
     after = int((sampling_rate / 1000.0) * (spike_snapshot[1]))
+    window = np.arange(-before * 10, after * 10)
+
+    # Linear interpolation kernel shared by every spike, same arithmetic as interp1d
+    hi = np.clip(np.searchsorted(x, xnew), 1, len(x) - 1)
+    lo = hi - 1
+    offset = xnew - x[lo]
+    step = x[hi] - x[lo]
 
     slices_dejittered = []
     spike_times_dejittered = []
-    for i in range(len(slices)):
-        f = interp1d(x, slices[i])
-        # 10-fold interpolated spike
-        ynew = f(xnew)
-        orig_min = np.where(slices[i] == np.min(slices[i]))[0][0]
-        orig_min_time = x[orig_min] / (sampling_rate / 1000)
-        minimum = np.where(ynew == np.min(ynew))[0][0]
+    for start in range(0, len(slices), DEJITTER_BATCH_SIZE):
+        batch = slices[start: start + DEJITTER_BATCH_SIZE]
+        # 10-fold interpolated spikes
+        ynew = (batch[:, hi] - batch[:, lo]) / step * offset + batch[:, lo]
+        orig_min_time = x[np.argmin(batch, axis=1)] / (sampling_rate / 1000)
+        minimum = np.argmin(ynew, axis=1)
         min_time = xnew[minimum] / (sampling_rate / 1000)
         # Only accept spikes if the interpolated minimum has shifted by
         # less than 1/10th of a ms (3 samples for a 30kHz recording, 30
         # samples after interpolation)
-        if np.abs(min_time - orig_min_time) <= 0.1:
-            # If minimum is too close to the end for a full snapshot then toss out spike
-            if minimum + after * 10 < len(ynew) and minimum - before * 10 >= 0:
-                slices_dejittered.append(
-                    ynew[minimum - before * 10: minimum + after * 10]
-                )
-                spike_times_dejittered.append(spike_times[i])
-    return np.array(slices_dejittered), np.array(spike_times_dejittered)
+        # If minimum is too close to the end for a full snapshot then toss out spike
+        keep = (
+                (np.abs(min_time - orig_min_time) <= 0.1)
+                & (minimum + after * 10 < ynew.shape[1])
+                & (minimum - before * 10 >= 0)
+        )
+        keep_idx = np.flatnonzero(keep)
+        slices_dejittered.append(
+            np.take_along_axis(ynew[keep_idx], minimum[keep_idx, None] + window, axis=1)
+        )
+        spike_times_dejittered.append(spike_times[start + keep_idx])
+
+    if len(slices_dejittered) == 0:
+        return np.array([]), np.array([])
+
+    return np.concatenate(slices_dejittered), np.concatenate(spike_times_dejittered)
 
 
 def implement_wavelet_transform(waves, n_pc=10, verbose=True):
@@ -300,12 +421,65 @@ def implement_wavelet_transform(waves, n_pc=10, verbose=True):
     return all_coeffs[:, idx[:n_pc]]
 
 
-def implement_pca(scaled_slices):
-    pca = PCA()
+def get_waveform_source_key(waves_list):
+    """Identifies the files behind a list of memory-mapped waveform arrays by
+    path, mtime, size and number of waveforms. Returns None if any array is not
+    memory-mapped from a file.
+    """
+    sources = []
+    for waves in waves_list:
+        fn = getattr(waves, "filename", None)
+        if fn is None or not os.path.isfile(fn):
+            return None
+
+        stat = os.stat(fn)
+        sources.append([str(fn), stat.st_mtime_ns, stat.st_size, int(waves.shape[0])])
+
+    return {"sources": sources}
+
+
+def implement_pca(scaled_slices, n_components=None):
+    # full solver keeps features deterministic and equal to slicing a full PCA
+    pca = PCA(n_components=n_components, svd_solver="full")
     pca_slices = pca.fit_transform(scaled_slices)
     return pca_slices, pca.explained_variance_ratio_
 
 
+def implement_incremental_pca(waves, energy, n_pc=3, batch_size=FEATURE_BATCH_SIZE):
+    """
+    Fits PCA on energy-scaled waveforms in batches of rows, without loading all waveforms.
+
+    Parameters
+    ----------
+    waves : array-like
+        waveforms with a row for each spike, e.g. np.memmap from ``np.load(mmap_mode="r")``
+    energy : np.array
+        RMS energy of each waveform
+    n_pc : int (optional)
+        number of principal components to fit
+    batch_size : int (optional)
+        number of waveforms read at a time
+
+    Returns
+    -------
+    pca : IncrementalPCA, fitted model
+    batches : list of (start, stop) row ranges used, every one at least n_pc rows
+    """
+    n_waves = waves.shape[0]
+    batch_size = max(batch_size, n_pc)
+    batches = [(start, min(start + batch_size, n_waves)) for start in range(0, n_waves, batch_size)]
+    # partial_fit needs at least n_pc rows, fold a short last batch into the previous one
+    if len(batches) > 1 and batches[-1][1] - batches[-1][0] < n_pc:
+        batches[-2:] = [(batches[-2][0], n_waves)]
+
+    pca = IncrementalPCA(n_components=n_pc)
+    for start, stop in batches:
+        block = np.asarray(waves[start:stop], dtype=np.float64)
+        pca.partial_fit(block / np.asarray(energy[start:stop])[:, None])
+
+    return pca, batches
+
+
 def implement_umap(waves, n_pc=3, n_neighbors=30, min_dist=0.0):
     reducer = umap.UMAP(n_components=n_pc, n_neighbors=n_neighbors, min_dist=min_dist)
     return reducer.fit_transform(waves)
@@ -344,18 +518,86 @@ def get_spike_slopes(waves, verbose=True):
     """
     if verbose:
         print("Computing spike slopes")
-    slopes = np.zeros((waves.shape[0],))
-    for i, wave in enumerate(waves):
-        peaks = find_peaks(wave)[0]
-        minima = np.argmin(wave)
-        if not any(peaks < minima):
-            maxima = np.argmax(wave[:minima])
-        else:
-            maxima = max(peaks[np.where(peaks < minima)[0]])
+    _, _, slopes = get_waveform_features(waves)
+    return slopes
 
-        slopes[i] = (wave[minima] - wave[maxima]) / (minima - maxima)
 
-    return slopes
+@njit(parallel=True)
+def _waveform_features(waves):
+    """
+    Compiled kernel computing amplitude, energy and slope of each waveform.
+
+    The slope runs from the last local maximum before the minimum to the minimum, with
+    local maxima (and flat peaks) found as in ``scipy.signal.find_peaks``. If there is no
+    such peak the largest sample before the minimum is used, and nan if the minimum is
+    the first sample.
+    """
+    n_waves, n_samples = waves.shape
+    amplitudes = np.empty(n_waves)
+    energy = np.empty(n_waves)
+    slopes = np.empty(n_waves)
+    for w in prange(n_waves):
+        wave = waves[w]
+        minima = 0
+        total = 0.0
+        for i in range(n_samples):
+            total += wave[i] * wave[i]
+            if wave[i] < wave[minima]:
+                minima = i
+
+        amplitudes[w] = wave[minima]
+        energy[w] = np.sqrt(total) / n_samples
+
+        # last peak before the minimum
+        maxima = -1
+        i = 1
+        while i < n_samples - 1:
+            if wave[i - 1] < wave[i]:
+                i_ahead = i + 1
+                while i_ahead < n_samples - 1 and wave[i_ahead] == wave[i]:
+                    i_ahead += 1
+
+                if wave[i_ahead] < wave[i]:
+                    peak = (i + i_ahead - 1) // 2
+                    if peak >= minima:
+                        break
+                    maxima = peak
+                    i = i_ahead
+            i += 1
+
+        if maxima < 0:
+            if minima == 0:
+                slopes[w] = np.nan
+                continue
+            maxima = 0
+            for i in range(1, minima):
+                if wave[i] > wave[maxima]:
+                    maxima = i
+
+        slopes[w] = (wave[minima] - wave[maxima]) / (minima - maxima)
+
+    return amplitudes, energy, slopes
+
+
+def get_waveform_features(waves):
+    """
+    Returns the amplitude, energy and slope of every waveform in one pass.
+
+    Parameters
+    ----------
+    waves : np.array, matrix of waveforms, with row for each spike
+
+    Returns
+    -------
+    amplitudes : np.array, minimum of each waveform
+    energy : np.array, RMS energy of each waveform, as :func:`get_waveform_energy`
+    slopes : np.array, initial downward slope of each waveform, as :func:`get_spike_slopes`
+    """
+    waves = np.ascontiguousarray(waves, dtype=np.float64)
+    if waves.ndim != 2:
+        raise ValueError("waves must be a 2-D array with a row for each waveform")
+
+    return _waveform_features(waves)
 
 
 def get_ISI_and_violations(
@@ -434,11 +676,7 @@ def scale_waveforms(waves, energy=None, verbose=True):
             )
         )
 
-    scaled_slices = np.zeros(waves.shape)
-    for i, w in enumerate(zip(waves, energy)):
-        scaled_slices[i] = w[0] / w[1]
-
-    return scaled_slices
+    return waves / np.asarray(energy)[:, None]
 
 
 def compute_waveform_metrics(waves, n_pc=3, use_umap=False, verbose=True):
@@ -463,25 +701,14 @@ def compute_waveform_metrics(waves, n_pc=3, use_umap=False, verbose=True):
     if verbose:
         print("Computing waveform metrics")
 
-    data = np.zeros((waves.shape[0], 3))
-    for i, wave in enumerate(waves):
-        data[i, 0] = np.min(wave)
-        data[i, 1] = np.sqrt(np.sum(wave ** 2)) / len(wave)
-        peaks = find_peaks(wave)[0]
-        minima = np.argmin(wave)
-        if not any(peaks < minima):
-            maxima = np.argmax(wave[:minima])
-        else:
-            maxima = max(peaks[np.where(peaks < minima)[0]])
-
-        data[i, 2] = (wave[minima] - wave[maxima]) / (minima - maxima)
+    data = np.column_stack(get_waveform_features(waves))
 
     # Scale waveforms to energy before running PCA
     if use_umap:
         pc_waves = implement_umap(waves, n_pc=n_pc)
     else:
         scaled_waves = scale_waveforms(waves, energy=data[:, 1])
-        pc_waves, _ = implement_pca(scaled_waves)
+        pc_waves, _ = implement_pca(scaled_waves, n_components=n_pc)
 
     data = np.hstack((data, pc_waves[:, :n_pc]))
     data_columns = ["amplitude", "energy", "spike_slope"]
@@ -489,6 +716,57 @@ def compute_waveform_metrics(waves, n_pc=3, use_umap=False, verbose=True):
     return data, data_columns
 
 
+def compute_waveform_metrics_out_of_core(
+        waves, n_pc=3, out_file=None, batch_size=FEATURE_BATCH_SIZE, verbose=True
+):
+    """
+    Out-of-core version of :func:`compute_waveform_metrics` for waveform sets larger than memory.
+
+    Waveforms are read batch_size rows at a time, PCA is fit incrementally on the
+    energy-scaled waveforms and the data array is written to out_file as it is computed.
+
+    Parameters
+    ----------
+    waves : array-like
+        waveforms with a row for each spike, e.g. np.memmap from ``np.load(mmap_mode="r")``
+    n_pc : int (optional)
+        number of principal components to include in data array
+    out_file : str (optional)
+        .npy file to write the data array to, kept in memory if None
+    batch_size : int (optional)
+        number of waveforms processed at a time
+
+    Returns
+    -------
+    np.array or np.memmap, list of column names
+    """
+    if verbose:
+        print("Computing waveform metrics out of core")
+
+    n_waves = waves.shape[0]
+    shape = (n_waves, 3 + n_pc)
+    if out_file is None:
+        data = np.empty(shape)
+    else:
+        data = np.lib.format.open_memmap(out_file, mode="w+", dtype=np.float64, shape=shape)
+
+    for start in range(0, n_waves, batch_size):
+        stop = min(start + batch_size, n_waves)
+        data[start:stop, :3] = np.column_stack(get_waveform_features(waves[start:stop]))
+
+    pca, batches = implement_incremental_pca(waves, data[:, 1], n_pc=n_pc, batch_size=batch_size)
+    for start, stop in batches:
+        block = np.asarray(waves[start:stop], dtype=np.float64)
+        data[start:stop, 3:] = pca.transform(block / data[start:stop, 1][:, None])
+
+    if isinstance(data, np.memmap):
+        data.flush()
+
+    data_columns = ["amplitude", "energy", "spike_slope"]
+    data_columns.extend(["PC%i" % i for i in range(n_pc)])
+    return data, data_columns
+
+
 def get_mahalanobis_distances_to_cluster(data, model, clusters, target_cluster):
     """
     Computes mahalanobis distance from spikes in target_cluster to all clusters in a GMM model
@@ -713,14 +991,33 @@ class SpikeDetection:
             return electrode, 1, self.recording_cutoff
 
         ic(f"Running spike detection on electrode {electrode}")
-        raw_trace = h5io.get_raw_trace(rec_dir=file_dir, chan_idx=electrode)
-        print(raw_trace)
-        if raw_trace is None or len(raw_trace) == 0:
-            raise FileNotFoundError(f"Could not find data for {electrode} in {file_dir}")
-
-        # Filter electrode trace
-        filt_el = get_filtered_electrode(raw_trace, freq=params["bandpass"], sampling_rate=params["sampling_rate"])
-        del raw_trace
+        # Filter electrode trace block by block into a scratch file, so neither the raw
+        # nor the filtered trace has to be held in memory
+        filt_file = self._data_dir / "filtered_electrode.dat"
+        with h5io.open_raw_trace(rec_dir=file_dir, chan_idx=electrode) as raw_trace:
+            if raw_trace is None or len(raw_trace) == 0:
+                raise FileNotFoundError(f"Could not find data for {electrode} in {file_dir}")
+
+            filt_el = np.memmap(filt_file, dtype=np.float64, mode="w+", shape=(len(raw_trace),))
+            get_filtered_electrode(
+                raw_trace,
+                freq=params["bandpass"],
+                sampling_rate=params["sampling_rate"],
+                out=filt_el,
+            )
+
+        try:
+            return self._run_filtered(filt_el)
+        finally:
+            del filt_el
+            filt_file.unlink(missing_ok=True)
+
+    def _run_filtered(self, filt_el):
+        """Runs the detection steps following filtering on the filtered electrode trace"""
+        status = self._status
+        electrode = self._electrode
+        params = self.params
+
         # Get recording cutoff
         if not status["recording_cutoff"]:
             self.recording_cutoff = get_recording_cutoff(filt_el, **params)
@@ -774,22 +1071,18 @@ class SpikeDetection:
             status["spike_times"] = True
 
         # Get various metrics and scale waveforms
+        amplitudes, energy, slopes = get_waveform_features(waves)
         if not status["spike_amplitudes"]:
-            amplitudes = np.min(waves)
             np.save(self._files["spike_amplitudes"], amplitudes)
             status["spike_amplitudes"] = True
 
         if not status["slopes"]:
-            slopes = get_spike_slopes(waves)
             np.save(self._files["slopes"], slopes)
             status["slopes"] = True
 
         if not status["energy"]:
-            energy = get_waveform_energy(waves)
             np.save(self._files["energy"], energy)
             status["energy"] = True
-        else:
-            energy = None
 
         # get pca of scaled waveforms
         if not status["pca_waveforms"]:
@@ -802,16 +1095,20 @@ class SpikeDetection:
 
         return electrode, 1, self.recording_cutoff
 
-    def get_spike_waveforms(self):
+    def get_spike_waveforms(self, mmap_mode=None):
         """Returns spike waveforms if they have been extracted, None otherwise
         Dejittered waveforms upsampled to 10 x sampling_rate
 
+        Parameters
+        ----------
+        mmap_mode : str (optional), passed to np.load to memory-map the file instead of reading it
+
         Returns
         -------
         numpy.array
         """
         if os.path.isfile(self._files["spike_waveforms"]):
-            return np.load(self._files["spike_waveforms"])
+            return np.load(self._files["spike_waveforms"], mmap_mode=mmap_mode)
         else:
             return None
 
@@ -910,16 +1207,67 @@ class SpikeDetection:
         return "\n".join(out)
 
 
+def _fit_gmm_restart(data, n_clusters, iterations, thresh, random_state, means_init=None):
+    """Fits one GMM restart, returns the model and its BIC (None if EM did not converge)"""
+    model = GaussianMixture(
+        n_components=n_clusters,
+        covariance_type="full",
+        tol=thresh,
+        random_state=random_state,
+        max_iter=iterations,
+        means_init=means_init,
+    )
+    model.fit(data)
+    if not model.converged_:
+        return model, None
+
+    return model, model.bic(data)
+
+
+def get_warm_start_means(data, model):
+    """
+    Initial means for a GMM with one more cluster than model.
+
+    Keeps the fitted means and adds the data point least likely under model.
+    """
+    worst = np.argmin(model.score_samples(data))
+    return np.vstack((model.means_, data[worst]))
+
+
 class ClusterGMM:
     def __init__(
             self,
             n_iters: int = None,
             n_restarts: int = None,
             thresh: int | float = None,
+            n_jobs: int = 1,
+            bic_patience: int = None,
+            bic_tol: float = 1e-4,
     ):
-        self.params = {"iterations": n_iters, "restarts": n_restarts, "thresh": thresh}
+        """
+        Parameters
+        ----------
+        n_iters : int, max EM iterations per restart
+        n_restarts : int, random restarts per number of clusters
+        thresh : float, EM convergence threshold
+        n_jobs : int (optional)
+            number of restarts fit in parallel, 1 fits them serially in process
+        bic_patience : int (optional)
+            stop restarting once this many consecutive restarts fail to lower the best
+            BIC by more than bic_tol (relative), None runs every restart
+        bic_tol : float (optional)
+            relative BIC improvement counted as progress
+        """
+        self.params = {
+            "iterations": n_iters,
+            "restarts": n_restarts,
+            "thresh": thresh,
+            "n_jobs": n_jobs,
+            "bic_patience": bic_patience,
+            "bic_tol": bic_tol,
+        }
 
-    def fit(self, data, n_clusters):
+    def fit(self, data, n_clusters, init_model=None):
         """
         Perform Gaussian Mixture Model (GMM) clustering on spike waveform data.
 
@@ -934,51 +1282,126 @@ class ClusterGMM:
             (e.g., amplitude, principal component, etc.) down each column.
         n_clusters : int
             The number of clusters to use in the GMM.
-            d
+        init_model : GaussianMixture (optional)
+            Fitted model with n_clusters - 1 components to warm start the first restart from.
 
         Returns
         -------
         best_model : GaussianMixture
-            The best-fitting GMM object.
+            The best-fitting GMM object, None if no restart converged.
         predictions : array_like
             The cluster assignments for each data point as a 1-D array.
         min_bic : float
             The minimum Bayesian information criterion (BIC) value achieved across all restarts. This value
             indicates the best-fitting model, lower number = better predictor.
+        """
+        if n_clusters is not None:
+            self.params["clusters"] = n_clusters
 
-        Args:
-            data:
+        return self.sweep(data, [self.params["clusters"]], init_models={
+            self.params["clusters"]: init_model
+        })[self.params["clusters"]]
 
+    def sweep(self, data, cluster_counts, warm_start=False, init_models=None):
         """
+        Fits GMMs for several numbers of clusters, scheduling restarts across a worker pool.
 
-        min_bic = None
-        best_model = None
-        if n_clusters is not None:
-            self.params["clusters"] = n_clusters
+        Restarts are submitted in rounds of n_jobs. Without warm starts, rounds mix every
+        number of clusters still running; a number of clusters drops out once it has run
+        all restarts or its BIC has plateaued (bic_patience). With warm_start, cluster
+        counts are fit in increasing order and the first restart of each is initialized
+        from the best model of the previous count.
 
-        for i in range(self.params["restarts"]):
-            model = GaussianMixture(
-                n_components=self.params["clusters"],
-                covariance_type="full",
-                tol=self.params["thresh"],
-                random_state=i,
-                max_iter=self.params["iterations"],
-            )
-            model.fit(data)
-            if model.converged_:
-                new_bic = model.bic(data)
-                if min_bic is None:
-                    min_bic = model.bic(data)
-                    best_model = model
-                elif new_bic < min_bic:
-                    best_model = model
-                    min_bic = new_bic
-
-        predictions = best_model.predict(data)
-        self._model = best_model
-        self._predictions = predictions
-        self._bic = min_bic
-        return best_model, predictions, min_bic
+        Parameters
+        ----------
+        data : array_like, feature matrix with a row for each spike
+        cluster_counts : iterable of int, numbers of clusters to fit
+        warm_start : bool (optional)
+        init_models : dict (optional), number of clusters -> model to warm start it from
+
+        Returns
+        -------
+        dict, number of clusters -> (best_model, predictions, min_bic), as :meth:`fit`
+        """
+        cluster_counts = sorted(cluster_counts)
+        init_models = {} if init_models is None else dict(init_models)
+        if warm_start:
+            out = {}
+            for n_clusters in cluster_counts:
+                out.update(self._run_restarts(data, [n_clusters], init_models))
+                if out[n_clusters][0] is not None:
+                    init_models[n_clusters + 1] = out[n_clusters][0]
+            return out
+
+        return self._run_restarts(data, cluster_counts, init_models)
+
+    def _run_restarts(self, data, cluster_counts, init_models):
+        params = self.params
+        n_workers = effective_n_jobs(params["n_jobs"] or 1)
+        patience = params["bic_patience"]
+        n_restarts = params["restarts"]
+
+        best = {k: (None, None) for k in cluster_counts}
+        stale = dict.fromkeys(cluster_counts, 0)
+        next_seed = dict.fromkeys(cluster_counts, 0)
+        with Parallel(n_jobs=n_workers) as parallel:
+            while True:
+                active = [
+                    k for k in cluster_counts
+                    if next_seed[k] < n_restarts and (patience is None or stale[k] < patience)
+                ]
+                if len(active) == 0:
+                    break
+
+                # one round: up to n_workers restarts, spread over the active cluster counts
+                jobs = []
+                while len(jobs) < n_workers:
+                    pending = [k for k in active if next_seed[k] < n_restarts]
+                    if len(pending) == 0:
+                        break
+                    for k in pending[: n_workers - len(jobs)]:
+                        jobs.append((k, next_seed[k]))
+                        next_seed[k] += 1
+
+                results = parallel(
+                    delayed(_fit_gmm_restart)(
+                        data,
+                        k,
+                        params["iterations"],
+                        params["thresh"],
+                        seed,
+                        get_warm_start_means(data, init_models[k])
+                        if seed == 0 and init_models.get(k) is not None else None,
+                    )
+                    for k, seed in jobs
+                )
+                for (k, seed), (model, bic) in zip(jobs, results):
+                    if bic is None:
+                        stale[k] += 1
+                        continue
+
+                    best_model, min_bic = best[k]
+                    if min_bic is None or bic < min_bic - params["bic_tol"] * abs(min_bic):
+                        stale[k] = 0
+                    else:
+                        stale[k] += 1
+
+                    if min_bic is None or bic < min_bic:
+                        best[k] = (model, bic)
+
+        out = {}
+        for k, (best_model, min_bic) in best.items():
+            if best_model is None:
+                out[k] = (None, None, None)
+                continue
+
+            predictions = best_model.predict(data)
+            out[k] = (best_model, predictions, min_bic)
+            self._model = best_model
+            self._predictions = predictions
+            self._bic = min_bic
+
+        return out
 
 
 class CplClust:
@@ -992,11 +1415,24 @@ class CplClust:
             no_write=False,
             n_pc=3,
             data_transform=compute_waveform_metrics,
+            out_of_core=False,
+            n_jobs=1,
+            warm_start=False,
+            bic_patience=None,
             verbose=True
     ):
-        """Recording directories should be ordered to make spike sorting easier later on"""
+        """Recording directories should be ordered to make spike sorting easier later on
+
+        With out_of_core=True, waveforms from all recordings are concatenated into a
+        memory-mapped file and the default feature transform is computed in batches
+        (:func:`compute_waveform_metrics_out_of_core`), so clustering is not bound by RAM.
+
+        n_jobs, warm_start and bic_patience configure the GMM sweep, see
+        :meth:`ClusterGMM.sweep`. Keep n_jobs=1 when electrodes are already clustered
+        in a process pool.
+        """
         ic(rec_dirs, channel_number, out_dir, params, overwrite, no_write, n_pc, data_transform,
-           verbose) if verbose else None
+           out_of_core, n_jobs, warm_start, bic_patience, verbose) if verbose else None
 
         if not isinstance(rec_dirs, Iterable):
             rec_dirs = [rec_dirs]
@@ -1004,6 +1440,8 @@ class CplClust:
         self.electrode = channel_number
         self._data_transform = data_transform
         self._n_pc = n_pc
+        self._out_of_core = out_of_core
+        self._gmm_params = {"n_jobs": n_jobs, "warm_start": warm_start, "bic_patience": bic_patience}
         if out_dir is None:
             if len(rec_dirs) > 1:
                 top = os.path.dirname(rec_dirs[0])
@@ -1038,6 +1476,9 @@ class CplClust:
             "spike_map": map_file,
             "rec_key": key_file,
             "clustering_results": results_file,
+            "spike_waveforms": os.path.join(self._data_dir, "spike_waveforms.npy"),
+            "features": os.path.join(self._data_dir, "features.npy"),
+            "feature_columns": os.path.join(self._data_dir, "feature_columns.json"),
         }
         self.params = params
         self._load_existing_data()
@@ -1057,8 +1498,14 @@ class CplClust:
             error_str = "\n\t".join(invalid)
             raise ValueError("Spike detection has not been run on:\n\t%s" % error_str)
 
-    def run(self, n_pc=None, overwrite=False, verbose=True):
+    def run(self, n_pc=None, overwrite=False, verbose=True, plot=True):
+        """Fits GMM solutions for 2 to max_clusters clusters and saves the numeric results
 
+        Each solution is saved to clustering_results/N_clusters (bic.npy, predictions.npy and
+        the GMM means and covariances) before any plotting. With plot=True the diagnostic
+        plots are rendered afterwards by :meth:`render_plots`; with plot=False they can be
+        rendered later, on demand or in a background process.
+        """
         try:
             if self.clustered and not overwrite:
                 ic("Clustering has already been run, skipping...") if verbose else None
@@ -1074,6 +1521,8 @@ class CplClust:
             self.params["max_iterations"],
             self.params["num_restarts"],
             self.params["threshold"],
+            n_jobs=self._gmm_params["n_jobs"],
+            bic_patience=self._gmm_params["bic_patience"],
         )
 
         # Collect data from all recordings
@@ -1088,8 +1537,18 @@ class CplClust:
         # Save array to map spikes and predictions back to original recordings
         np.save(self._files["spike_map"], spike_map)
 
-        data, data_columns = self._data_transform(waveforms, n_pc)
-        amplitudes = np.min(waveforms, axis=1)
+        if self._out_of_core and self._data_transform is compute_waveform_metrics:
+            data, data_columns = compute_waveform_metrics_out_of_core(
+                waveforms, n_pc, out_file=self._files["features"], verbose=verbose
+            )
+            amplitudes = np.asarray(data[:, 0])
+        else:
+            data, data_columns = self._data_transform(np.asarray(waveforms), n_pc)
+            amplitudes = np.min(waveforms, axis=1)
+            np.save(self._files["features"], data)
+
+        # Keep the features for the render stage
+        write_dict_to_json({"columns": list(data_columns)}, self._files["feature_columns"])
 
         # Run GMM for each number of clusters from 2 to max_clusters
         tested_clusters = np.arange(2, self.params["max_clusters"] + 1)
@@ -1097,13 +1556,20 @@ class CplClust:
             columns=["clusters", "converged", "BIC", "spikes_per_cluster"],
             index=tested_clusters,
         )
+
+        # Fit every missing solution up front, scheduling restarts across the worker pool
+        to_fit = [
+            n_clust for n_clust in tested_clusters
+            if overwrite or not (
+                    os.path.isfile(os.path.join(self._data_dir, "%i_clusters" % n_clust, "bic.npy"))
+                    and os.path.isfile(os.path.join(self._data_dir, "%i_clusters" % n_clust, "predictions.npy"))
+            )
+        ]
+        fits = GMM.sweep(data, to_fit, warm_start=self._gmm_params["warm_start"]) if to_fit else {}
+
         for n_clust in tested_clusters:
             ic(n_clust) if verbose else None
             data_dir = os.path.join(self._data_dir, "%i_clusters" % n_clust)
-            plot_dir = os.path.join(self._plot_dir, "%i_clusters" % n_clust)
-            wave_plot_dir = os.path.join(
-                self._plot_dir, "%i_clusters_waveforms_ISIs" % n_clust
-            )
             bic_file = os.path.join(data_dir, "bic.npy")
             pred_file = os.path.join(data_dir, "predictions.npy")
 
@@ -1117,19 +1583,13 @@ class CplClust:
                 ic("Clustering already completed for %i clusters" % n_clust) if verbose else None
                 continue
 
-            if not os.path.isdir(wave_plot_dir):
-                ic("Making directory %s" % wave_plot_dir) if verbose else None
-                os.makedirs(wave_plot_dir)
             if not os.path.isdir(data_dir):
                 ic("Making directory %s" % data_dir) if verbose else None
                 os.makedirs(data_dir)
-            if not os.path.isdir(plot_dir):
-                ic("Making directory %s" % plot_dir) if verbose else None
-                os.makedirs(plot_dir)
 
-            model, predictions, bic = GMM.fit(data, n_clust)
+            model, predictions, bic = fits[n_clust]
             if model is None:
-                clust_results.loc[n_clust] = [n_clust, bic, False, [0]]
+                clust_results.loc[n_clust] = [n_clust, False, bic, [0]]
                 ic("GMM did not converge for %i clusters" % n_clust) if verbose else None
                 continue
 
@@ -1140,68 +1600,165 @@ class CplClust:
                 mean_amp = np.mean(amplitudes[idx])
                 sd_amp = np.std(amplitudes[idx])
                 cutoff_amp = mean_amp - (sd_amp * self.params["wf_amplitude_sd_cutoff"])
-                rejected_idx = np.array([i for i in idx if amplitudes[i] <= cutoff_amp])
-                if len(rejected_idx) > 0:
-                    predictions[rejected_idx] = -1
-
-                idx = np.where(predictions == c)[0]
-                spikes_per_clust.append(len(idx))
-
-                if len(idx) == 0:
-                    continue
-
-                # Plot waveforms and ISIs of cluster
-                ISIs, violations_1ms, violations_2ms = get_ISI_and_violations(
-                    spike_times[idx], self.params["sampling_rate"], spike_map[idx]
-                )
-                cluster_waves = waveforms[idx]
-                isi_fn = os.path.join(wave_plot_dir, "Cluster%i_ISI.png" % c)
-                wave_fn = os.path.join(wave_plot_dir, "Cluster%i_waveforms.png" % c)
-                title_str = (
-                        "Cluster%i\nviolations_1ms = %i, "
-                        "violations_2ms = %i\n"
-                        "Number of waveforms = %i"
-                        % (c, violations_1ms, violations_2ms, len(idx))
-                )
-                plot_waveforms(cluster_waves, title=title_str, save_file=wave_fn)
-                if len(ISIs) > 0:
-                    plot_ISIs(ISIs, total_spikes=len(idx), save_file=isi_fn)
+                predictions[idx[amplitudes[idx] <= cutoff_amp]] = -1
+                spikes_per_clust.append(int(np.sum(predictions == c)))
 
             clust_results.loc[n_clust] = [n_clust, True, bic, spikes_per_clust]
 
-            # Plot feature pairs
-            feature_pairs = itertools.combinations(list(range(data.shape[1])), 2)
-            for f1, f2 in feature_pairs:
-                fn = "%sVS%s.png" % (data_columns[f1], data_columns[f2])
-                fn = os.path.join(plot_dir, fn)
-                plot_cluster_features(
-                    data[:, [f1, f2]],
-                    predictions,
-                    x_label=data_columns[f1],
-                    y_label=data_columns[f2],
-                    save_file=fn,
-                )
-
-            # For each cluster plot mahanalobis distances to all other clusters
-            for c in range(n_clust):
-                distances = get_mahalanobis_distances_to_cluster(
-                    data, model, predictions, c
-                )
-                fn = os.path.join(plot_dir, "Mahalanobis_cluster%i.png" % c)
-                title = "Mahalanobis distance of Cluster %i from all other clusters" % c
-                plot_mahalanobis_to_cluster(distances, title=title, save_file=fn)
-
-            # Save data
+            # Save data, stale plots of a refit solution are re-rendered
             np.save(bic_file, bic)
             np.save(pred_file, predictions)
+            np.save(os.path.join(data_dir, "gmm_means.npy"), model.means_)
+            np.save(os.path.join(data_dir, "gmm_covariances.npy"), model.covariances_)
+            self._clear_plots(n_clust)
 
         # Save results table
         self.results = clust_results
         write_pandas_to_table(clust_results, self._files["clustering_results"], overwrite=True)
         self.clustered = True
+
+        if plot:
+            self.render_plots(n_jobs=self._gmm_params["n_jobs"], verbose=verbose)
+
         return True
 
-    def get_spike_data(self):
+    def _get_plot_dirs(self, n_clust):
+        plot_dir = os.path.join(self._plot_dir, "%i_clusters" % n_clust)
+        wave_plot_dir = os.path.join(self._plot_dir, "%i_clusters_waveforms_ISIs" % n_clust)
+        return plot_dir, wave_plot_dir
+
+    def _clear_plots(self, n_clust):
+        for plot_dir in self._get_plot_dirs(n_clust):
+            if os.path.isdir(plot_dir):
+                shutil.rmtree(plot_dir)
+
+    def plots_rendered(self, n_clust):
+        """True if the diagnostic plots of a solution have been rendered"""
+        plot_dir, _ = self._get_plot_dirs(n_clust)
+        return os.path.isfile(os.path.join(plot_dir, RENDER_COMPLETE_FILE))
+
+    def render_solution_plots(self, n_clust, overwrite=False):
+        """Renders the diagnostic plots of one saved solution
+
+        Waveforms and ISIs of each cluster, every pair of features and the Mahalanobis
+        distances of each cluster to all others, from the results saved by :meth:`run`.
+
+        Returns
+        -------
+        bool, False if the solution has not been saved
+        """
+        data_dir = os.path.join(self._data_dir, "%i_clusters" % n_clust)
+        means_file = os.path.join(data_dir, "gmm_means.npy")
+        covars_file = os.path.join(data_dir, "gmm_covariances.npy")
+        predictions = self.get_predictions(n_clust)
+        if predictions is None or not os.path.isfile(means_file):
+            return False
+
+        if self.plots_rendered(n_clust) and not overwrite:
+            return True
+
+        self._clear_plots(n_clust)
+        plot_dir, wave_plot_dir = self._get_plot_dirs(n_clust)
+        os.makedirs(plot_dir)
+        os.makedirs(wave_plot_dir)
+
+        waveforms, spike_times, spike_map, fs, _ = self.get_spike_data()
+        data = np.load(self._files["features"], mmap_mode="r")
+        data_columns = read_dict_from_json(self._files["feature_columns"])["columns"]
+        model = GaussianMixture(n_components=n_clust, covariance_type="full")
+        model.means_ = np.load(means_file)
+        model.covariances_ = np.load(covars_file)
+
+        for c in range(n_clust):
+            idx = np.where(predictions == c)[0]
+            if len(idx) == 0:
+                continue
+
+            # Plot waveforms and ISIs of cluster
+            ISIs, violations_1ms, violations_2ms = get_ISI_and_violations(
+                spike_times[idx], fs, spike_map[idx]
+            )
+            cluster_waves = waveforms[idx]
+            isi_fn = os.path.join(wave_plot_dir, "Cluster%i_ISI.png" % c)
+            wave_fn = os.path.join(wave_plot_dir, "Cluster%i_waveforms.png" % c)
+            title_str = (
+                    "Cluster%i\nviolations_1ms = %i, "
+                    "violations_2ms = %i\n"
+                    "Number of waveforms = %i"
+                    % (c, violations_1ms, violations_2ms, len(idx))
+            )
+            plot_waveforms(cluster_waves, title=title_str, save_file=wave_fn)
+            if len(ISIs) > 0:
+                plot_ISIs(ISIs, total_spikes=len(idx), save_file=isi_fn)
+
+        # Plot feature pairs
+        feature_pairs = itertools.combinations(list(range(data.shape[1])), 2)
+        for f1, f2 in feature_pairs:
+            fn = "%sVS%s.png" % (data_columns[f1], data_columns[f2])
+            fn = os.path.join(plot_dir, fn)
+            plot_cluster_features(
+                data[:, [f1, f2]],
+                predictions,
+                x_label=data_columns[f1],
+                y_label=data_columns[f2],
+                save_file=fn,
+            )
+
+        # For each cluster plot mahanalobis distances to all other clusters
+        for c in range(n_clust):
+            distances = get_mahalanobis_distances_to_cluster(
+                data, model, predictions, c
+            )
+            fn = os.path.join(plot_dir, "Mahalanobis_cluster%i.png" % c)
+            title = "Mahalanobis distance of Cluster %i from all other clusters" % c
+            plot_mahalanobis_to_cluster(distances, title=title, save_file=fn)
+
+        # Written last, so an interrupted render is redone
+        with open(os.path.join(plot_dir, RENDER_COMPLETE_FILE), "w") as f:
+            f.write(datetime.now().isoformat())
+
+        return True
+
+    def render_plots(self, solutions=None, n_jobs=1, overwrite=False, verbose=True):
+        """Renders the diagnostic plots of saved solutions, skipping those already rendered
+
+        Parameters
+        ----------
+        solutions : list of int (optional), numbers of clusters, all solutions if None
+        n_jobs : int (optional), number of solutions rendered in parallel
+        overwrite : bool (optional), re-render solutions that already have plots
+        """
+        if solutions is None:
+            solutions = list(range(2, self.params["max_clusters"] + 1))
+
+        solutions = [n for n in solutions if overwrite or not self.plots_rendered(n)]
+        ic("Rendering plots for solutions %s" % solutions) if verbose else None
+        if n_jobs == 1:
+            return [self.render_solution_plots(n, overwrite=overwrite) for n in solutions]
+
+        return Parallel(n_jobs=n_jobs)(
+            delayed(self.render_solution_plots)(n, overwrite=overwrite) for n in solutions
+        )
+
+    def render_plots_in_background(self, solutions=None, n_jobs=1, overwrite=False):
+        """Starts :meth:`render_plots` in a separate process and returns the process"""
+        process = multiprocessing.get_context("spawn").Process(
+            target=self.render_plots,
+            args=(solutions, n_jobs, overwrite, False),
+        )
+        process.start()
+        return process
+
+    def get_spike_data(self, out_of_core=None):
+        """Collects spike waveforms, times and recording map from all recordings
+
+        If out_of_core (default set at init), waveforms are returned as a memory-mapped
+        array concatenated on disk instead of stacked in memory.
+        """
+        if out_of_core is None:
+            out_of_core = self._out_of_core
+
+        mmap_mode = "r" if out_of_core else None
         # Collect data from all recordings
         tmp_waves = []
         tmp_times = []
@@ -1219,13 +1776,16 @@ class CplClust:
                 offset = offset + 3 * fs[i]
                 continue
 
-            tmp_waves.append(spike_detect.get_spike_waveforms())
+            tmp_waves.append(spike_detect.get_spike_waveforms(mmap_mode=mmap_mode))
             tmp_times.append(t)
             tmp_id.append(np.ones((t.shape[0],)) * i)
             offsets[i] = int(offset)
             offset = offset + max(t) + 3 * fs[i]
 
-        waveforms = np.vstack(tmp_waves)
+        if out_of_core:
+            waveforms = self._concatenate_waveforms(tmp_waves)
+        else:
+            waveforms = np.vstack(tmp_waves)
         spike_times = np.hstack(tmp_times)
         spike_map = np.hstack(tmp_id)
 
@@ -1239,6 +1799,43 @@ class CplClust:
 
         return waveforms, spike_times, spike_map, fs, offsets
 
+    def _concatenate_waveforms(self, waves_list, batch_size=FEATURE_BATCH_SIZE):
+        """Stacks memory-mapped waveform arrays into one .npy file, block by block
+
+        An existing file is only reused if every input is a memory-mapped file
+        and the mtimes and sizes of those files match the ones it was written
+        from, stored in spike_waveforms_key.json.
+        """
+        fn = self._files["spike_waveforms"]
+        key_fn = os.path.splitext(str(fn))[0] + "_key.json"
+        shape = (sum(w.shape[0] for w in waves_list), waves_list[0].shape[1])
+        key = get_waveform_source_key(waves_list)
+        if key is not None and os.path.isfile(fn) and os.path.isfile(key_fn):
+            if read_dict_from_json(key_fn) == key:
+                waveforms = np.load(fn, mmap_mode="r")
+                if waveforms.shape == shape:
+                    return waveforms
+
+                del waveforms
+
+        if os.path.isfile(key_fn):
+            os.remove(key_fn)
+
+        waveforms = np.lib.format.open_memmap(fn, mode="w+", dtype=np.float64, shape=shape)
+        offset = 0
+        for waves in waves_list:
+            for start in range(0, waves.shape[0], batch_size):
+                block = waves[start: start + batch_size]
+                waveforms[offset: offset + block.shape[0]] = block
+                offset += block.shape[0]
+
+        waveforms.flush()
+        del waveforms
+        if key is not None:
+            write_dict_to_json(key, key_fn)
+
+        return np.load(fn, mmap_mode="r")
+
     def get_clusters(self, solution_num, cluster_nums):
         if not isinstance(cluster_nums, list):
             cluster_nums = [cluster_nums]
@@ -1421,6 +2018,7 @@ class SpikeSorter:
         self._last_action = None
         self._last_popped = None  # Dict of indices to clusters
         self._last_added = None  # List of indices
+        self._render_processes = {}  # solution -> process rendering its plots
 
         thresh = []
         for rd in rec_dirs:
@@ -1462,6 +2060,13 @@ class SpikeSorter:
         self._last_popped = None
         self._last_added = None
 
+        # Render the diagnostic plots of the solution on first open, without blocking
+        render = self._render_processes.get(solution_num)
+        if not self.clustering.plots_rendered(solution_num) and (render is None or not render.is_alive()):
+            self._render_processes[solution_num] = self.clustering.render_plots_in_background(
+                [solution_num]
+            )
+
     def save_clusters(self, target_clusters, single_unit, multi_unit):
         """Saves active clusters as cells, write them to the h5_files in the
         appropriate recording directories
@@ -0,0 +1,309 @@
+"""
+Synthetic data and fitting benchmarks for cpl_pipeline.analysis.poissonHMM.
+
+Spike arrays are generated from known PI, A and B matrices so fitting speed and
+parameter recovery can be measured without recorded data. Results are returned
+as DataFrames that can be saved as a baseline and compared against later runs::
+
+    from cpl_pipeline.analysis import hmm_benchmark as hb
+    df = hb.run_benchmark_grid()
+    hb.save_benchmark(df, "hmm_baseline.csv")
+    ...
+    hb.compare_to_baseline(hb.run_benchmark_grid(), "hmm_baseline.csv")
+"""
+import os
+import time as sys_time
+import itertools as it
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+from cpl_pipeline.analysis import poissonHMM as phmm
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+BENCHMARK_GRID = {
+    "n_cells": [10, 30],
+    "n_trials": [15, 60],
+    "n_states": [3, 6],
+    "dt": [0.001, 0.01],
+}
+
+# columns used to match rows between a benchmark and its baseline
+GRID_COLUMNS = list(BENCHMARK_GRID.keys())
+TIMING_COLUMNS = [
+    "forward_time",
+    "backward_time",
+    "baum_welch_time",
+    "step_time",
+    "fit_time",
+]
+
+
+def get_peak_rss():
+    """Peak resident memory of this process in MB, None if unavailable"""
+    if resource is None:
+        return None
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+def make_hmm_params(n_cells, n_states, max_rate=50, stay_prob=0.998, seed=None):
+    """Random PI, A and B matrices for a left-to-right-ish Poisson HMM
+
+    Parameters
+    ----------
+    n_cells : int
+    n_states : int
+    max_rate : float, max firing rate in Hz
+    stay_prob : float, probability of staying in a state each time bin
+    seed : int (optional)
+
+    Returns
+    -------
+    PI : np.array, n_states
+    A : np.array, n_states x n_states
+    B : np.array, n_cells x n_states firing rates in Hz
+    """
+    rng = np.random.default_rng(seed)
+    PI = np.zeros((n_states,))
+    PI[0] = 1.0
+    A = np.full((n_states, n_states), (1 - stay_prob) / max(n_states - 1, 1))
+    np.fill_diagonal(A, stay_prob)
+    if n_states == 1:
+        A[:] = 1.0
+
+    B = rng.uniform(1, max_rate, (n_cells, n_states))
+    return PI, A, B
+
+
+def generate_hmm_data(PI, A, B, n_trials, n_steps, dt, seed=None):
+    """Samples spike arrays from a Poisson HMM, the inverse of PoissonHMM.fit
+
+    Parameters
+    ----------
+    PI : np.array, initial state distribution
+    A : np.array, transition matrix
+    B : np.array, cells x states firing rates in Hz
+    n_trials : int
+    n_steps : int, time bins per trial
+    dt : float, bin size in seconds
+    seed : int (optional)
+
+    Returns
+    -------
+    spikes : np.array, trials x cells x time spike counts
+    state_seqs : np.array, trials x time hidden states
+    """
+    rng = np.random.default_rng(seed)
+    n_cells, n_states = B.shape
+    cum_A = np.cumsum(A, axis=1)
+    state_seqs = np.zeros((n_trials, n_steps), dtype=np.int64)
+    state_seqs[:, 0] = rng.choice(n_states, size=n_trials, p=PI)
+    draws = rng.random((n_trials, n_steps))
+    for t in range(1, n_steps):
+        prev = state_seqs[:, t - 1]
+        state_seqs[:, t] = np.minimum(
+            (draws[:, t, None] > cum_A[prev]).sum(axis=1), n_states - 1
+        )
+
+    rates = B[:, state_seqs].transpose(1, 0, 2)
+    spikes = rng.poisson(rates * dt).astype(np.int32)
+    return spikes, state_seqs
+
+
+def _time_call(func, *args, n_repeats=3, **kwargs):
+    """Best wall time of n_repeats calls, after one untimed call to compile"""
+    func(*args, **kwargs)
+    best = np.inf
+    for _ in range(n_repeats):
+        start = sys_time.perf_counter()
+        func(*args, **kwargs)
+        best = min(best, sys_time.perf_counter() - start)
+
+    return best
+
+
+def get_recovery_error(PI, A, B, state_seqs, hmm, spikes, dt, win_size=0.25):
+    """How well a fitted HMM recovers the generating parameters
+
+    Fitted states are matched to the true states with match_states before
+    comparing matrices.
+
+    Returns
+    -------
+    dict with rate_rmse (compute_rate_rmse between the true rates and the rates
+    of the fitted emission along the decoded paths), emission_error and
+    transition_error (mean absolute error of the matched matrices)
+    """
+    state_map = phmm.match_states(B, hmm.emission)
+    order = np.array([state_map[i] for i in range(hmm.n_states)])
+    fit_B = np.zeros(B.shape)
+    fit_A = np.zeros(A.shape)
+    fit_B[:, order] = hmm.emission
+    fit_A[np.ix_(order, order)] = hmm.transition
+
+    best_paths, _ = hmm.get_best_paths(spikes, dt)
+    true_rates = phmm.generate_rate_array_from_state_seq(
+        state_seqs.astype(np.float64), B, dt, win_size
+    )
+    fit_rates = phmm.generate_rate_array_from_state_seq(
+        best_paths, hmm.emission, dt, win_size
+    )
+    return {
+        "rate_rmse": phmm.compute_rate_rmse(true_rates, fit_rates),
+        "emission_error": np.mean(np.abs(fit_B - B)),
+        "transition_error": np.mean(np.abs(fit_A - A)),
+    }
+
+
+def benchmark_hmm(
+    n_cells,
+    n_trials,
+    n_states,
+    dt,
+    trial_time=2.0,
+    max_iter=50,
+    threshold=1e-7,
+    n_repeats=3,
+    parallel=False,
+    log_space=False,
+    seed=0,
+):
+    """Times the fitting functions and a full fit on one synthetic data set
+
+    Parameters
+    ----------
+    n_cells, n_trials, n_states : int
+    dt : float, bin size in seconds
+    trial_time : float, trial length in seconds
+    max_iter : int, max iterations of the full fit
+    threshold : float, convergence threshold of the full fit
+    n_repeats : int, calls per timing, the best is kept
+    parallel : bool, passed to PoissonHMM._step and fit
+    log_space : bool, fit with the log-space engine, see PoissonHMM
+    seed : int, seeds the synthetic data, PoissonHMM.randomize is not seeded
+
+    Returns
+    -------
+    dict of grid parameters, timings in seconds, iterations, iterations/sec,
+    peak RSS in MB and the recovery errors from get_recovery_error. Peak RSS is
+    the high-water mark of the whole process, so it only describes this grid
+    point when run in a fresh process as run_benchmark_grid does
+    """
+    n_steps = int(trial_time / dt)
+    PI, A, B = make_hmm_params(n_cells, n_states, seed=seed)
+    spikes, state_seqs = generate_hmm_data(PI, A, B, n_trials, n_steps, dt, seed=seed)
+    time = np.arange(n_steps) * dt * 1000
+    trial = spikes[0]
+
+    out = {"n_cells": n_cells, "n_trials": n_trials, "n_states": n_states, "dt": dt}
+    out["forward_time"] = _time_call(
+        phmm.forward, trial, dt, PI, A, B, n_repeats=n_repeats
+    )
+    alpha, norms = phmm.forward(trial, dt, PI, A, B)
+    out["backward_time"] = _time_call(
+        phmm.backward, trial, dt, A, B, norms, n_repeats=n_repeats
+    )
+    beta = phmm.backward(trial, dt, A, B, norms)
+    out["baum_welch_time"] = _time_call(
+        phmm.compute_baum_welch, trial, dt, A, B, alpha, beta, n_repeats=n_repeats
+    )
+
+    hmm = phmm.PoissonHMM(n_states, log_space=log_space)
+    hmm.randomize(spikes, dt, time)
+    start_params = (hmm.initial_distribution, hmm.transition, hmm.emission)
+
+    def step():
+        hmm.initial_distribution, hmm.transition, hmm.emission = start_params
+        hmm._step(spikes, dt, parallel=parallel)
+
+    out["step_time"] = _time_call(step, n_repeats=n_repeats)
+
+    hmm = phmm.PoissonHMM(n_states, log_space=log_space)
+    hmm.randomize(spikes, dt, time)
+    start = sys_time.perf_counter()
+    hmm.fit(spikes, dt, time, max_iter=max_iter, threshold=threshold, parallel=parallel)
+    out["fit_time"] = sys_time.perf_counter() - start
+    out["iterations"] = hmm.iteration
+    out["iterations_per_sec"] = hmm.iteration / out["fit_time"]
+    out["converged"] = hmm.converged
+    out["peak_rss_mb"] = get_peak_rss()
+    out.update(get_recovery_error(PI, A, B, state_seqs, hmm, spikes, dt))
+    return out
+
+
+def run_benchmark_grid(grid=None, verbose=True, isolate=True, **kwargs):
+    """Runs benchmark_hmm over every combination in grid
+
+    Parameters
+    ----------
+    grid : dict (optional), lists of values for n_cells, n_trials, n_states
+        and dt, defaults to BENCHMARK_GRID
+    verbose : bool
+    isolate : bool, run each grid point in a fresh process so peak_rss_mb is
+        that configuration's own peak rather than the largest seen so far.
+        Each process compiles the numba kernels again, which is not timed
+    kwargs : passed to benchmark_hmm
+
+    Returns
+    -------
+    pandas.DataFrame, one row per grid point
+    """
+    if grid is None:
+        grid = BENCHMARK_GRID
+
+    grid = {k: grid.get(k, BENCHMARK_GRID[k]) for k in GRID_COLUMNS}
+    rows = []
+    for values in it.product(*grid.values()):
+        params = dict(zip(grid.keys(), values))
+        if verbose:
+            print("%s: Benchmarking %s" % (os.getpid(), params))
+
+        if isolate:
+            ctx = multiprocessing.get_context("spawn")
+            with ctx.Pool(1, maxtasksperchild=1) as pool:
+                rows.append(pool.apply(benchmark_hmm, kwds={**params, **kwargs}))
+        else:
+            rows.append(benchmark_hmm(**params, **kwargs))
+
+    return pd.DataFrame(rows)
+
+
+def save_benchmark(df, save_file):
+    """Saves benchmark results to csv to use as a baseline"""
+    df.to_csv(save_file, index=False)
+
+
+def compare_to_baseline(df, baseline):
+    """Compares benchmark results to a stored baseline
+
+    Parameters
+    ----------
+    df : pandas.DataFrame, output of run_benchmark_grid
+    baseline : pandas.DataFrame or str, baseline results or path to a csv
+        written with save_benchmark
+
+    Returns
+    -------
+    pandas.DataFrame, grid points in both with a <timing>_ratio column for each
+    timing (new / baseline, > 1 is slower) and a rate_rmse_change column
+    """
+    if isinstance(baseline, str):
+        baseline = pd.read_csv(baseline)
+
+    merged = df.merge(baseline, on=GRID_COLUMNS, suffixes=("", "_baseline"))
+    for col in TIMING_COLUMNS:
+        merged[col + "_ratio"] = merged[col] / merged[col + "_baseline"]
+
+    merged["rate_rmse_change"] = merged["rate_rmse"] - merged["rate_rmse_baseline"]
+    keep = GRID_COLUMNS + [c + "_ratio" for c in TIMING_COLUMNS] + ["rate_rmse_change"]
+    return merged[keep]
+
+
+if __name__ == "__main__":
+    print(run_benchmark_grid().to_string())
@@ -112,6 +112,7 @@ def palatability_identity_calculations(
 
     with tables.open_file(dat.h5_file, "r+") as hf5:
         trains_dig_in = hf5.list_nodes("/spike_trains")
+        spike_arrays = [h5io.read_spike_array(x)[1] for x in trains_dig_in]
         time = trains_dig_in[0].array_time[:]
         bin_times = np.arange(time[0], time[-1] - win_size + win_step, win_step)
         num_bins = len(bin_times)
@@ -139,7 +140,7 @@ def palatability_identity_calculations(
                 for k, t in enumerate(bin_times):
                     t_idx = np.where((time >= t) & (time <= t + win_size))[0]
                     unscaled_response[k, j, idx] = np.mean(
-                        trains_dig_in[i].spike_array[:, u, t_idx], axis=1
+                        spike_arrays[i][:, u, t_idx], axis=1
                     )
                     try:
                         lasers[k, j, idx] = np.vstack(
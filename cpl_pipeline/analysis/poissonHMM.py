@@ -1,14 +1,18 @@
 import os
 import math
+import json
+import hashlib
 import numpy as np
 import itertools as it
 import pandas as pd
 import tables
 import pprint
-import time as sys_time
+import threading
+import multiprocessing
 import seaborn as sns
-from numba import njit
+from numba import njit, prange
 from copy import deepcopy
+from collections import deque, OrderedDict
 
 from scipy.ndimage.filters import gaussian_filter1d
 
@@ -24,6 +28,12 @@ cachedir = Path().home() / '.cache'
 cachedir.mkdir(exist_ok=True)
 memory = Memory(cachedir, verbose=0)
 
+# max number of spike arrays kept in memory by get_hmm_spike_data in each
+# process, and max size of the on-disk cache after HmmHandler.run
+SPIKE_CACHE_SIZE = 8
+SPIKE_CACHE_BYTES = "2G"
+_spike_data_cache = OrderedDict()
+
 TEST_PARAMS = {
     "n_cells": 10,
     "n_states": 4,
@@ -55,6 +65,7 @@ HMM_PARAMS = {
     "converged": False,
     "area": "GC",
     "hmm_class": "PoissonHMM",
+    "log_space": False,
     "notes": "",
 }
 
@@ -64,6 +75,12 @@ FACTORIAL_LOOKUP = np.array(
 
 MIN_PROB = 1e-100
 
+# number of past PI/A/B matrices kept in PoissonHMM.history, the per iteration
+# stats in stat_arrays are always kept in full
+HISTORY_SIZE = 20
+# iterations between checkpoints written during HmmHandler.run
+CHECKPOINT_EVERY = 10
+
 
 @njit
 def fast_factorial(x):
@@ -131,6 +148,255 @@ def fix_arrays(PI, A, B):
     return PI, A, B
 
 
+@njit
+def log_emission_matrix(spikes, dt, B, underflow=True):
+    """Computes the log probability of each time bin's spike counts in every state
+
+    Same values as calling log_emission(B[:, s], spikes[:, t], dt) for every
+    state s and time bin t, computed once so forward, backward and baum-welch
+    passes can share it.
+
+    Parameters
+    ----------
+    spikes : np.array, N x T matrix of spike counts
+    dt : float, timebin size in seconds
+    B : np.array, N x nStates matrix of estimated spike rates for each neuron
+    underflow : bool, if True a bin whose probability underflows in any neuron
+        gets -inf, as in log_emission. The log-space engine passes False.
+
+    Returns
+    -------
+    np.array, nStates x T matrix of log emission probabilities
+    """
+    n_cells, n_steps = spikes.shape
+    n_states = B.shape[1]
+    log_min = np.log(MIN_PROB)
+
+    # log(n!) for every spike count in the trial
+    max_count = 0
+    for u in range(n_cells):
+        for t in range(n_steps):
+            if spikes[u, t] > max_count:
+                max_count = spikes[u, t]
+
+    log_fact = np.zeros(max_count + 1)
+    for x in range(max_count + 1):
+        log_fact[x] = math.lgamma(x + 1.0)
+
+    log_em = np.zeros((n_states, n_steps))
+    for s in range(n_states):
+        for t in range(n_steps):
+            total = 0.0
+            for u in range(n_cells):
+                rate = B[u, s]
+                n = spikes[u, t]
+                if rate < 1e-300:
+                    # rate is effectively zero
+                    lp = 0.0 if n == 0 else log_min
+                elif rate > 150:
+                    # cap rate at 150, since neurons don't really fire that fast
+                    lp = log_min
+                else:
+                    lp = n * np.log(rate * dt) - log_fact[n] - rate * dt
+                    if underflow and np.exp(lp) == 0.0:
+                        # probability underflows, as in sum_log_probs
+                        total = -np.inf
+                        break
+
+                total += lp
+
+            log_em[s, t] = total
+
+    return log_em
+
+
+@njit
+def forward_from_emission(log_em, PI, A):
+    """Forward algorithm on a precomputed log emission matrix, see forward"""
+    nStates, nTimeSteps = log_em.shape
+    log_PI = np.log(PI)
+    log_A = np.log(A)
+
+    alpha = np.zeros((nStates, nTimeSteps))
+    norms = np.zeros((nTimeSteps,))
+    for i in range(nStates):
+        alpha[i, 0] = np.exp(log_PI[i] + log_em[i, 0])
+
+    norms[0] = np.sum(alpha[:, 0])
+    alpha[:, 0] = alpha[:, 0] / norms[0]
+    for t in range(1, nTimeSteps):
+        log_prev = np.log(alpha[:, t - 1])
+        for s in range(nStates):
+            tmp_a = np.sum(np.exp(log_prev + log_A[:, s]))
+            alpha[s, t] = np.exp(log_em[s, t] + np.log(tmp_a))
+
+        norms[t] = np.sum(alpha[:, t])
+        alpha[:, t] = alpha[:, t] / norms[t]
+
+    return alpha, norms
+
+
+@njit
+def backward_from_emission(log_em, A, norms):
+    """Backward algorithm on a precomputed log emission matrix, see backward"""
+    nStates, nTimeSteps = log_em.shape
+    log_A = np.log(A)
+
+    beta = np.zeros((nStates, nTimeSteps))
+    beta[:, -1] = 1  # Initialize final beta to 1 for all states
+    for t in range(nTimeSteps - 2, -1, -1):
+        log_next = np.log(beta[:, t + 1]) + log_em[:, t + 1]
+        for s in range(nStates):
+            beta[s, t] = np.sum(np.exp(log_next + log_A[s, :]))
+
+        beta[:, t] = beta[:, t] / norms[t + 1]
+
+    return beta
+
+
+@njit
+def baum_welch_from_emission(log_em, A, alpha, beta):
+    """Computes gamma and epsilon on a precomputed log emission matrix, see compute_baum_welch"""
+    nStates, nTimeSteps = log_em.shape
+    log_A = np.log(A)
+    log_alpha = np.log(alpha)
+    log_beta = np.log(beta)
+
+    gamma = np.zeros((nStates, nTimeSteps))
+    epsilons = np.zeros((nStates, nStates, nTimeSteps - 1))
+    for t in range(nTimeSteps):
+        tmp_g = np.exp(log_alpha[:, t] + log_beta[:, t])
+        gamma[:, t] = tmp_g / np.sum(tmp_g)
+        if t < nTimeSteps - 1:
+            epsilonNumerator = np.zeros((nStates, nStates))
+            for si in range(nStates):
+                for sj in range(nStates):
+                    epsilonNumerator[si, sj] = np.exp(
+                        log_alpha[si, t] + log_A[si, sj] + log_beta[sj, t + 1] + log_em[sj, t + 1]
+                    )
+
+            epsilons[:, :, t] = epsilonNumerator / np.sum(epsilonNumerator)
+
+    return gamma, epsilons
+
+
+@njit
+def baum_welch_stats_from_emission(log_em, A, alpha, beta):
+    """Like baum_welch_from_emission, but sums epsilon over time as it is computed
+
+    Returns gamma (nStates x T) and the nStates x nStates sum of epsilons over
+    time, the only part of epsilon the M-step needs, so the full
+    nStates x nStates x T-1 array is never allocated.
+    """
+    nStates, nTimeSteps = log_em.shape
+    log_A = np.log(A)
+    log_alpha = np.log(alpha)
+    log_beta = np.log(beta)
+
+    gamma = np.zeros((nStates, nTimeSteps))
+    epsilon_sum = np.zeros((nStates, nStates))
+    epsilonNumerator = np.zeros((nStates, nStates))
+    for t in range(nTimeSteps):
+        tmp_g = np.exp(log_alpha[:, t] + log_beta[:, t])
+        gamma[:, t] = tmp_g / np.sum(tmp_g)
+        if t < nTimeSteps - 1:
+            for si in range(nStates):
+                for sj in range(nStates):
+                    epsilonNumerator[si, sj] = np.exp(
+                        log_alpha[si, t] + log_A[si, sj] + log_beta[sj, t + 1] + log_em[sj, t + 1]
+                    )
+
+            epsilon_sum += epsilonNumerator / np.sum(epsilonNumerator)
+
+    return gamma, epsilon_sum
+
+
+@njit
+def logsumexp(x):
+    m = np.max(x)
+    if m == -np.inf:
+        return -np.inf
+
+    return m + np.log(np.sum(np.exp(x - m)))
+
+
+@njit
+def log_forward_from_emission(log_em, log_PI, log_A):
+    """Log-space forward algorithm, log_alpha is normalized at each time step
+
+    Returns
+    -------
+    log_alpha : np.array, nStates x T
+    log_norms : np.array, T, log likelihood of the trial is their sum
+    """
+    nStates, nTimeSteps = log_em.shape
+    log_alpha = np.zeros((nStates, nTimeSteps))
+    log_norms = np.zeros((nTimeSteps,))
+    log_alpha[:, 0] = log_PI + log_em[:, 0]
+    log_norms[0] = logsumexp(log_alpha[:, 0])
+    log_alpha[:, 0] -= log_norms[0]
+    for t in range(1, nTimeSteps):
+        for s in range(nStates):
+            log_alpha[s, t] = log_em[s, t] + logsumexp(log_alpha[:, t - 1] + log_A[:, s])
+
+        log_norms[t] = logsumexp(log_alpha[:, t])
+        log_alpha[:, t] -= log_norms[t]
+
+    return log_alpha, log_norms
+
+
+@njit
+def log_backward_from_emission(log_em, log_A, log_norms):
+    """Log-space backward algorithm, scaled by the forward log_norms"""
+    nStates, nTimeSteps = log_em.shape
+    log_beta = np.zeros((nStates, nTimeSteps))
+    for t in range(nTimeSteps - 2, -1, -1):
+        log_next = log_em[:, t + 1] + log_beta[:, t + 1]
+        for s in range(nStates):
+            log_beta[s, t] = logsumexp(log_A[s, :] + log_next) - log_norms[t + 1]
+
+    return log_beta
+
+
+@njit
+def log_baum_welch_stats_from_emission(log_em, log_A, log_alpha, log_beta):
+    """Log-space gamma and time-summed epsilon, see baum_welch_stats_from_emission"""
+    nStates, nTimeSteps = log_em.shape
+    gamma = np.zeros((nStates, nTimeSteps))
+    epsilon_sum = np.zeros((nStates, nStates))
+    log_eps = np.zeros((nStates, nStates))
+    for t in range(nTimeSteps):
+        log_g = log_alpha[:, t] + log_beta[:, t]
+        gamma[:, t] = np.exp(log_g - logsumexp(log_g))
+        if t < nTimeSteps - 1:
+            for si in range(nStates):
+                for sj in range(nStates):
+                    log_eps[si, sj] = (
+                        log_alpha[si, t] + log_A[si, sj] + log_beta[sj, t + 1] + log_em[sj, t + 1]
+                    )
+
+            epsilon_sum += np.exp(log_eps - logsumexp(log_eps.ravel()))
+
+    return gamma, epsilon_sum
+
+
+@njit
+def log_forward(spikes, dt, PI, A, B):
+    """Log-space forward algorithm, returns log_alpha and log_norms. Unlike
+    forward it does not copy the matrices or floor zeros, zero probabilities
+    are carried as -inf
+    """
+    log_em = log_emission_matrix(spikes, dt, B, False)
+    return log_forward_from_emission(log_em, np.log(PI), np.log(A))
+
+
+@njit
+def log_backward(spikes, dt, A, B, log_norms):
+    """Log-space backward algorithm, see log_forward"""
+    log_em = log_emission_matrix(spikes, dt, B, False)
+    return log_backward_from_emission(log_em, np.log(A), log_norms)
+
+
 @njit
 def forward(spikes, dt, PI, A, B):
     """Run forward algorithm to compute alpha = P(Xt = i| o1...ot, pi)
@@ -163,35 +429,8 @@ def forward(spikes, dt, PI, A, B):
         distribution and also to scale the outputs of the backward algorithm.
         norms(t) = sum(alpha(:,t))
     """
-    nTimeSteps = spikes.shape[1]
-    nStates = A.shape[0]
     PI, A, B = fix_arrays(PI, A, B)
-
-    # For each state, use the the initial state distribution and spike counts
-    # to initialize alpha(:,1)
-    # row = np.array([PI[i] * np.prod(poisson(B[:,i], spikes[:,0], dt))
-    # row = np.array([np.log(PI[i]) + np.sum(np.log(poisson(B[:,i], spikes[:,0], dt)))
-    #                for i in range(nStates)])
-    a0 = [
-        np.exp(np.log(PI[i]) + log_emission(B[:, i], spikes[:, 0], dt))
-        for i in range(nStates)
-    ]
-    a0 = np.array(a0)
-    alpha = np.zeros((nStates, nTimeSteps))
-    norms = [np.sum(a0)]
-    alpha[:, 0] = a0 / norms[0]
-    for t in range(1, nTimeSteps):
-        for s in range(nStates):
-            tmp_em = log_emission(B[:, s], spikes[:, t], dt)
-            tmp_a = np.sum(np.exp(np.log(alpha[:, t - 1]) + np.log(A[:, s])))
-            tmp = np.exp(tmp_em + np.log(tmp_a))
-            alpha[s, t] = tmp
-
-        tmp_norm = np.sum(alpha[:, t])
-        norms.append(tmp_norm)
-        alpha[:, t] = alpha[:, t] / tmp_norm
-
-    return alpha, norms
+    return forward_from_emission(log_emission_matrix(spikes, dt, B), PI, A)
 
 
 @njit
@@ -212,97 +451,117 @@ def backward(spikes, dt, A, B, norms):
     -------
     beta : np.array, nStates x T matrix of backward probabilities
     """
-    _, A, B = fix_arrays(np.array([0]), A, B)
-    nTimeSteps = spikes.shape[1]
-    nStates = A.shape[0]
-    beta = np.zeros((nStates, nTimeSteps))
-    beta[:, -1] = 1  # Initialize final beta to 1 for all states
-    tStep = list(range(nTimeSteps - 1))
-    tStep.reverse()
-    for t in tStep:
-        for s in range(nStates):
-            tmp_em = log_emission(B[:, s], spikes[:, t + 1], dt)
-            tmp_b = np.log(beta[:, t + 1]) + np.log(A[s, :]) + tmp_em
-            beta[s, t] = np.sum(np.exp(tmp_b))
+    _, A, B = fix_arrays(np.array([0.0]), A, B)
+    return backward_from_emission(log_emission_matrix(spikes, dt, B), A, norms)
 
-        beta[:, t] = beta[:, t] / norms[t + 1]
 
-    return beta
+@njit
+def compute_baum_welch(spikes, dt, A, B, alpha, beta):
+    _, A, B = fix_arrays(np.array([0.0]), A, B)
+    return baum_welch_from_emission(log_emission_matrix(spikes, dt, B), A, alpha, beta)
 
 
 @njit
-def compute_baum_welch(spikes, dt, A, B, alpha, beta):
-    _, A, B = fix_arrays(np.array([0]), A, B)
-    nTimeSteps = spikes.shape[1]
+def baum_welch(trial_dat, dt, PI, A, B):
+    # emission probabilities are computed once and shared by all three passes
+    PI, A, B = fix_arrays(PI, A, B)
+    log_em = log_emission_matrix(trial_dat, dt, B)
+    alpha, norms = forward_from_emission(log_em, PI, A)
+    beta = backward_from_emission(log_em, A, norms)
+    tmp_gamma, tmp_epsilons = baum_welch_from_emission(log_em, A, alpha, beta)
+    return tmp_gamma, tmp_epsilons, norms
+
+
+def _baum_welch_stats_trials(spikes, dt, PI, A, B):
+    """Runs the E-step on every trial, keeping only the M-step sufficient statistics
+
+    Returns
+    -------
+    gammas : np.array, trials x nStates x T
+    epsilon_sums : np.array, trials x nStates x nStates, epsilons summed over time
+    norms : np.array, trials x T
+    """
+    nTrials, nCells, nTimeSteps = spikes.shape
     nStates = A.shape[0]
-    gamma = np.zeros((nStates, nTimeSteps))
-    epsilons = np.zeros((nStates, nStates, nTimeSteps - 1))
-    for t in range(nTimeSteps):
-        tmp_g = np.exp(np.log(alpha[:, t]) + np.log(beta[:, t]))
-        gamma[:, t] = tmp_g / np.sum(tmp_g)
-        if t < nTimeSteps - 1:
-            epsilonNumerator = np.zeros((nStates, nStates))
-            for si in range(nStates):
-                for sj in range(nStates):
-                    probs = log_emission(B[:, sj], spikes[:, t + 1], dt)
-                    tmp_en = (
-                        np.log(alpha[si, t])
-                        + np.log(A[si, sj])
-                        + np.log(beta[sj, t + 1])
-                        + probs
-                    )
-                    epsilonNumerator[si, sj] = np.exp(tmp_en)
+    PI, A, B = fix_arrays(PI, A, B)
+    gammas = np.zeros((nTrials, nStates, nTimeSteps))
+    epsilon_sums = np.zeros((nTrials, nStates, nStates))
+    norms = np.zeros((nTrials, nTimeSteps))
+    for tri in prange(nTrials):
+        log_em = log_emission_matrix(spikes[tri], dt, B)
+        alpha, norms[tri] = forward_from_emission(log_em, PI, A)
+        beta = backward_from_emission(log_em, A, norms[tri])
+        gammas[tri], epsilon_sums[tri] = baum_welch_stats_from_emission(log_em, A, alpha, beta)
 
-            epsilons[:, :, t] = epsilonNumerator / np.sum(epsilonNumerator)
+    return gammas, epsilon_sums, norms
 
-    return gamma, epsilons
 
+def _log_baum_welch_stats_trials(spikes, dt, PI, A, B):
+    """Log-space version of _baum_welch_stats_trials, returns log_norms in place
+    of norms. Logs of PI and A are taken once for all trials and nothing is copied
+    """
+    nTrials, nCells, nTimeSteps = spikes.shape
+    nStates = A.shape[0]
+    log_PI = np.log(PI)
+    log_A = np.log(A)
+    gammas = np.zeros((nTrials, nStates, nTimeSteps))
+    epsilon_sums = np.zeros((nTrials, nStates, nStates))
+    log_norms = np.zeros((nTrials, nTimeSteps))
+    for tri in prange(nTrials):
+        log_em = log_emission_matrix(spikes[tri], dt, B, False)
+        log_alpha, log_norms[tri] = log_forward_from_emission(log_em, log_PI, log_A)
+        log_beta = log_backward_from_emission(log_em, log_A, log_norms[tri])
+        gammas[tri], epsilon_sums[tri] = log_baum_welch_stats_from_emission(
+            log_em, log_A, log_alpha, log_beta
+        )
 
-@njit
-def baum_welch(trial_dat, dt, PI, A, B):
-    alpha, norms = forward(trial_dat, dt, PI, A, B)
-    beta = backward(trial_dat, dt, A, B, norms)
-    tmp_gamma, tmp_epsilons = compute_baum_welch(trial_dat, dt, A, B, alpha, beta)
-    return tmp_gamma, tmp_epsilons, norms
+    return gammas, epsilon_sums, log_norms
 
 
-def compute_new_matrices(spikes, dt, gammas, epsilons):
+# trials are processed across numba threads by the *_batch kernels, and serially
+# in process by the *_batch_serial variants, used when fits already run in
+# parallel processes
+baum_welch_stats_batch = njit(parallel=True)(_baum_welch_stats_trials)
+baum_welch_stats_batch_serial = njit(_baum_welch_stats_trials)
+log_baum_welch_stats_batch = njit(parallel=True)(_log_baum_welch_stats_trials)
+log_baum_welch_stats_batch_serial = njit(_log_baum_welch_stats_trials)
+
+
+def compute_new_matrices_from_stats(spikes, dt, gammas, epsilon_sums):
+    """M-step from gammas and the per-trial sums of epsilon over time
+
+    Parameters
+    ----------
+    spikes : np.array, trials x cells x T spike counts
+    dt : float, timebin size in seconds
+    gammas : np.array, trials x nStates x T state probabilities
+    epsilon_sums : np.array, trials x nStates x nStates transition probabilities
+        summed over time
+
+    Returns
+    -------
+    PI, A, B : np.array
+    """
     nTrials, nCells, nTimeSteps = spikes.shape
     n_states = gammas.shape[1]
     minFR = 1 / (nTimeSteps * dt)
 
     PI = np.mean(gammas[:, :, 0], axis=0)
-    A = np.zeros((n_states, n_states))
-    B = np.zeros((nCells, n_states))
-    for si in range(n_states):
-        for sj in range(n_states):
-            Anumer = np.sum(epsilons[:, si, sj, :])
-            Adenom = np.sum(gammas[:, si, -1])
-            if np.isfinite(Adenom) and Adenom != 0.0:
-                A[si, sj] = Anumer / Adenom
-            else:
-                A[si, sj] = 0  # incase of floating point errors resulting in zeros
 
-        # A[si, A[si,:] < 1e-50] = 0
-        row = A[si, :]
-        if np.sum(row) == 0.0:
-            A[si, sj] = 1.0
-        else:
-            A[si, :] = A[si, :] / np.sum(row)
-
-    for si in range(n_states):
-        for tri in range(nTrials):
-            for t in range(nTimeSteps - 1):
-                for u in range(nCells):
-                    B[u, si] = B[u, si] + gammas[tri, si, t] * spikes[tri, u, t]
-
-    # Convert and really small transition values into zeros
-    # A[A < 1e-50] = 0
-    # sums = np.sum(A, axis=1)
-    # A = A/np.sum(A, axis=1) # This divides columns not rows
-    # Bnumer = np.sum(np.array([np.matmul(tmp_y, tmp_g.T)
-    #                          for tmp_y, tmp_g in zip(spikes, gammas)]),
-    #                axis=0)
+    Anumer = np.sum(epsilon_sums, axis=0)
+    Adenom = np.sum(gammas[:, :, -1], axis=0)
+    valid = np.isfinite(Adenom) & (Adenom != 0.0)
+    # rows with invalid denominators incase of floating point errors resulting in zeros
+    A = np.where(valid[:, None], Anumer / np.where(valid, Adenom, 1.0)[:, None], 0.0)
+    row_sums = np.sum(A, axis=1)
+    empty = row_sums == 0.0
+    A[~empty] = A[~empty] / row_sums[~empty, None]
+    A[empty, -1] = 1.0
+
+    # B[u, si] = sum over trials and t < T-1 of gammas[tri, si, t] * spikes[tri, u, t]
+    B = np.tensordot(
+        spikes[:, :, :-1].astype(np.float64), gammas[:, :, :-1], axes=([0, 2], [0, 2])
+    )
     Bdenom = np.sum(np.sum(gammas, axis=2), axis=0)
     B = (B / Bdenom) / dt
     B[B < minFR] = minFR
@@ -371,22 +630,20 @@ def poisson_viterbi_deprecated(spikes, dt, PI, A, B):
     return bestPath, maxPathLogProb, T1, T2
 
 
-def poisson_viterbi(spikes, dt, PI, A, B):
-    n_states = A.shape[0]
-    PI, A, B = fix_arrays(PI, A, B)
-    n_cells, n_steps = spikes.shape
+@njit
+def viterbi_from_emission(log_em, PI, A):
+    """Viterbi decoding from a precomputed log emission matrix (see
+    log_emission_matrix), returns bestPath, max_log_prob, T1, T2
+    """
+    n_states, n_steps = log_em.shape
+    log_A = np.log(A)
     T1 = np.ones((n_states, n_steps)) * 1e-300
     T2 = np.zeros((n_states, n_steps))
 
-    T1[:, 0] = [
-        np.log(PI[i]) + sum_log_probs(poisson(B[:, i], spikes[:, 0], dt))
-        for i in range(n_states)
-    ]
-    # for t,s in it.product(range(1,n_steps), range(n_states)):
+    T1[:, 0] = np.log(PI) + log_em[:, 0]
     for t in range(1, n_steps):
         for s in range(n_states):
-            probs = sum_log_probs(poisson(B[:, s], spikes[:, t], dt))
-            vec1 = T1[:, t - 1] + np.log(A[:, s]) + probs
+            vec1 = T1[:, t - 1] + log_A[:, s] + log_em[s, t]
             T1[s, t] = np.max(vec1)
             T2[s, t] = np.argmax(vec1)
 
@@ -394,15 +651,48 @@ def poisson_viterbi(spikes, dt, PI, A, B):
     max_log_prob = T1[best_end_state, -1]
     bestPath = np.zeros((n_steps,))
     bestPath[-1] = best_end_state
-    tStep = list(range(n_steps - 1))
-    tStep.reverse()
-    for t in tStep:
+    for t in range(n_steps - 2, -1, -1):
         bestPath[t] = T2[int(bestPath[t + 1]), t + 1]
 
     return bestPath, max_log_prob, T1, T2
 
 
-def compute_BIC(PI, A, B, spikes=None, dt=None, maxLogProb=None, n_time_steps=None):
+def poisson_viterbi(spikes, dt, PI, A, B):
+    PI, A, B = fix_arrays(PI, A, B)
+    log_em = log_emission_matrix(spikes, dt, B)
+    return viterbi_from_emission(log_em, PI, A)
+
+
+def _viterbi_trials(spikes, dt, PI, A, B, log_space=False):
+    """Viterbi decodes every trial of a trials x cells x time spike array.
+    With log_space the emission probabilities are not floored on underflow and
+    zeros in PI and A are kept as -inf, matching the log-space E-step
+
+    Returns
+    -------
+    bestPaths : np.array, trials x time
+    pathProbs : np.array, log probability of each best path
+    """
+    nTrials, nCells, nTimeSteps = spikes.shape
+    if not log_space:
+        PI, A, B = fix_arrays(PI, A, B)
+
+    bestPaths = np.zeros((nTrials, nTimeSteps)) - 1
+    pathProbs = np.zeros((nTrials,))
+    for tri in prange(nTrials):
+        log_em = log_emission_matrix(spikes[tri], dt, B, not log_space)
+        bestPaths[tri], pathProbs[tri], _, _ = viterbi_from_emission(log_em, PI, A)
+
+    return bestPaths, pathProbs
+
+
+viterbi_batch = njit(parallel=True)(_viterbi_trials)
+viterbi_batch_serial = njit(_viterbi_trials)
+
+
+def compute_BIC(
+    PI, A, B, spikes=None, dt=None, maxLogProb=None, n_time_steps=None, log_space=False
+):
     if (maxLogProb is None or n_time_steps is None) and (spikes is None or dt is None):
         raise ValueError("Must provide max log prob and n_time_steps or spikes and dt")
 
@@ -411,10 +701,12 @@ def compute_BIC(PI, A, B, spikes=None, dt=None, maxLogProb=None, n_time_steps=No
         + (PI.shape[0] - 1)
         + B.shape[0] * (B.shape[1] - 1)
     )
-    if maxLogProb and n_time_steps:
-        pass
+    if maxLogProb is not None and n_time_steps is not None:
+        bestPaths = None
     else:
-        bestPaths, path_probs = compute_best_paths(spikes, dt, PI, A, B)
+        bestPaths, path_probs = compute_best_paths(
+            spikes, dt, PI, A, B, log_space=log_space
+        )
         maxLogProb = np.sum(path_probs)
         n_time_steps = spikes.shape[-1]
 
@@ -423,11 +715,35 @@ def compute_BIC(PI, A, B, spikes=None, dt=None, maxLogProb=None, n_time_steps=No
     return BIC, bestPaths, maxLogProb
 
 
-def compute_hmm_cost(spikes, dt, PI, A, B, win_size=0.25, true_rates=None):
+def compute_hmm_cost(
+    spikes,
+    dt,
+    PI,
+    A,
+    B,
+    win_size=0.25,
+    true_rates=None,
+    log_space=False,
+    best_paths=None,
+    max_log_prob=None,
+):
+    """RMSE between the binned spike rates and the rates of the decoded state
+    sequences, and the BIC. If best_paths and max_log_prob are given, e.g.
+    from get_cached_best_paths, they are used instead of decoding again
+    """
     if true_rates is None:
         true_rates = convert_spikes_to_rates(spikes, dt, win_size, step_size=win_size)
 
-    BIC, bestPaths, maxLogProb = compute_BIC(PI, A, B, spikes=spikes, dt=dt)
+    if best_paths is not None and max_log_prob is not None:
+        BIC, _, maxLogProb = compute_BIC(
+            PI, A, B, maxLogProb=max_log_prob, n_time_steps=spikes.shape[-1]
+        )
+        bestPaths = best_paths
+    else:
+        BIC, bestPaths, maxLogProb = compute_BIC(
+            PI, A, B, spikes=spikes, dt=dt, log_space=log_space
+        )
+
     hmm_rates = generate_rate_array_from_state_seq(
         bestPaths, B, dt, win_size, step_size=win_size
     )
@@ -435,17 +751,11 @@ def compute_hmm_cost(spikes, dt, PI, A, B, win_size=0.25, true_rates=None):
     return RMSE, BIC, bestPaths, maxLogProb
 
 
-def compute_best_paths(spikes, dt, PI, A, B):
+def compute_best_paths(spikes, dt, PI, A, B, log_space=False):
     if len(spikes.shape) == 2:
         spikes = np.array([spikes])
 
-    nTrials, nCells, nTimeSteps = spikes.shape
-    bestPaths = np.zeros((nTrials, nTimeSteps)) - 1
-    pathProbs = np.zeros((nTrials,))
-
-    for i, trial in enumerate(spikes):
-        bestPaths[i, :], pathProbs[i], _, _ = poisson_viterbi(trial, dt, PI, A, B)
-    return bestPaths, pathProbs
+    return viterbi_batch_serial(spikes, dt, PI, A, B, log_space)
 
 
 @njit
@@ -492,8 +802,7 @@ def match_states(emission1, emission2):
         r = np.argmin(distances[s, :])
         if r == i and s in states:
             out[i] = s
-            idx = np.where(states == s)[0]
-            states.pop(int(idx))
+            states.remove(s)
 
     for i in range(emission2.shape[1]):
         if i not in out:
@@ -503,7 +812,6 @@ def match_states(emission1, emission2):
     return out
 
 
-@memory.cache
 @njit
 def convert_spikes_to_rates(spikes, dt, win_size, step_size=None):
     if step_size is None:
@@ -520,7 +828,6 @@ def convert_spikes_to_rates(spikes, dt, win_size, step_size=None):
     return out
 
 
-@memory.cache
 @njit
 def generate_rate_array_from_state_seq(bestPaths, B, dt, win_size, step_size=None):
     if not step_size:
@@ -543,7 +850,6 @@ def generate_rate_array_from_state_seq(bestPaths, B, dt, win_size, step_size=Non
     return mean_rates
 
 
-@memory.cache
 @njit
 def rebin_spike_array(spikes, dt, time, new_dt):
     if dt == new_dt:
@@ -564,7 +870,39 @@ def rebin_spike_array(spikes, dt, time, new_dt):
     return new_spikes.astype(np.int32), new_time
 
 
-@memory.cache
+def get_spike_data_version(rec_dir):
+    """Returns a hash identifying the current sorted units and spike arrays of
+    a recording: the mtime and size of its h5 file, the layout of
+    /sorted_units and /spike_trains and the contents of /unit_descriptor.
+    Cached spike data is only reused while this is unchanged.
+    """
+    h5_file = h5io.get_h5_filename(rec_dir)
+    stat = os.stat(h5_file)
+    h = hashlib.sha1()
+    h.update(("%s %i %i" % (h5_file, stat.st_mtime_ns, stat.st_size)).encode())
+    with tables.open_file(h5_file, "r") as hf5:
+        for where in ["/sorted_units", "/spike_trains"]:
+            if where not in hf5:
+                continue
+
+            for node in hf5.walk_nodes(where):
+                h.update(node._v_pathname.encode())
+                if isinstance(node, tables.Leaf):
+                    h.update(str((node.shape, node.dtype)).encode())
+
+        if "/unit_descriptor" in hf5:
+            h.update(hf5.root.unit_descriptor.read().tobytes())
+
+    return h.hexdigest()
+
+
+def _as_key(x):
+    if isinstance(x, (list, tuple, np.ndarray)):
+        return tuple(_as_key(y) for y in x)
+
+    return x
+
+
 def get_hmm_spike_data(
     rec_dir,
     unit_type,
@@ -577,6 +915,11 @@ def get_hmm_spike_data(
 ):
     """Grabs spike data and formats it for HMM fitting. Handles rebinning and trimming spike arrays.
 
+    Results are cached per recording data version (see get_spike_data_version),
+    the last SPIKE_CACHE_SIZE in memory and the rest on disk, so re-sorting
+    units or remaking spike arrays is picked up without clearing the cache.
+    Returned arrays may be shared between calls and should not be modified.
+
     Parameters
     ----------
     rec_dir: path to directory with h5 file
@@ -608,6 +951,57 @@ def get_hmm_spike_data(
     spike_array, dt, time
     np.array, float, np.array
 
+    """
+    data_version = get_spike_data_version(rec_dir)
+    key = _as_key(
+        [
+            rec_dir,
+            data_version,
+            unit_type,
+            channel,
+            time_start,
+            time_end,
+            dt,
+            trials,
+            area,
+        ]
+    )
+    if key in _spike_data_cache:
+        _spike_data_cache.move_to_end(key)
+        return _spike_data_cache[key]
+
+    out = _load_hmm_spike_data(
+        rec_dir,
+        data_version,
+        unit_type,
+        channel,
+        time_start=time_start,
+        time_end=time_end,
+        dt=dt,
+        trials=trials,
+        area=area,
+    )
+    _spike_data_cache[key] = out
+    while len(_spike_data_cache) > SPIKE_CACHE_SIZE:
+        _spike_data_cache.popitem(last=False)
+
+    return out
+
+
+@memory.cache
+def _load_hmm_spike_data(
+    rec_dir,
+    data_version,
+    unit_type,
+    channel,
+    time_start=None,
+    time_end=None,
+    dt=None,
+    trials=None,
+    area=None,
+):
+    """Uncached body of get_hmm_spike_data, data_version is only part of the
+    on-disk cache key
     """
     if isinstance(unit_type, str):
         units = query_units(rec_dir, unit_type, area=area)
@@ -646,7 +1040,6 @@ def get_hmm_spike_data(
     return spike_array, dt, time
 
 
-@memory.cache
 def query_units(dat, unit_type, area=None):
     """Returns the units names of all units in the dataset that match unit_type
 
@@ -667,6 +1060,18 @@ def query_units(dat, unit_type, area=None):
     -------
         list of str : unit_names
     """
+    if isinstance(dat, str):
+        return _query_rec_units(dat, get_spike_data_version(dat), unit_type, area=area)
+
+    return _query_units(dat, unit_type, area=area)
+
+
+@memory.cache
+def _query_rec_units(rec_dir, data_version, unit_type, area=None):
+    return _query_units(rec_dir, unit_type, area=area)
+
+
+def _query_units(dat, unit_type, area=None):
     if isinstance(dat, str):
         units = h5io.get_unit_table(dat)
         el_map = h5io.get_electrode_mapping(dat)
@@ -705,28 +1110,27 @@ def query_units(dat, unit_type, area=None):
     return out
 
 
-def fit_hmm_mp(rec_dir, params, h5_file=None, constraint_func=None):
-    params = params.copy()
+def get_hmm_fit_data(rec_dir, params):
+    """Gathers the spike array an HMM parameter set is fit to, stacking the
+    trials of every channel/taste in the set
+
+    Returns
+    -------
+    spikes : np.array, trials x cells x time
+    dt : float
+    time : np.array
+    row_id : np.array, (hmm_id, channel, taste, trial) for each row of spikes
+    """
     hmm_id = params["hmm_id"]
-    n_states = params["n_states"]
     dt = params["dt"]
     time_start = params["time_start"]
     time_end = params["time_end"]
-    max_iter = params["max_iter"]
-    threshold = params["threshold"]
     unit_type = params["unit_type"]
     channels = params["channel"]
     tastes = params["taste"]
     n_trials = params["n_trials"]
-    if params.get("trial_nums") is not None:
-        custom_trial_nums = params.pop("trial_nums")
-    else:
-        custom_trial_nums = None
-
-    if "area" in params.keys():
-        area = params["area"]
-    else:
-        area = None
+    custom_trial_nums = params.get("trial_nums")
+    area = params.get("area")
 
     if not isinstance(channels, list):
         channels = [channels]
@@ -769,14 +1173,103 @@ def fit_hmm_mp(rec_dir, params, h5_file=None, constraint_func=None):
     spikes = np.vstack(spikes)
     row_id = np.vstack(row_id)
 
-    if params["hmm_class"] == "PoissonHMM":
-        hmm = PoissonHMM(n_states, hmm_id=hmm_id)
-    elif params["hmm_class"] == "ConstrainedHMM":
-        hmm = ConstrainedHMM(len(channels), hmm_id=hmm_id)
+    return spikes, dt, time, row_id
+
+
+def fit_hmm_mp(
+    rec_dir,
+    params,
+    h5_file=None,
+    constraint_func=None,
+    result_queue=None,
+    n_restarts=1,
+    checkpoint=None,
+):
+    """Fits one HMM from a parameter set, if n_restarts > 1 that many random
+    restarts are raced with race_hmm_fits and only the best is kept
+
+    A single fit is checkpointed every CHECKPOINT_EVERY iterations, through
+    result_queue or straight to h5_file, and resumes from checkpoint (a dict
+    from read_hmm_checkpoint) if one is given instead of being randomized.
+
+    If result_queue is given the fitted HMM is handed to the writer reading that
+    queue (see HmmHandler.run) and this returns (hmm_id, success) without
+    touching the hdf5 store. Otherwise, if h5_file is given the HMM is written
+    directly, which is only safe when a single process is writing the store.
+    """
+    params = params.copy()
+    hmm_id = params["hmm_id"]
+    n_states = params["n_states"]
+    max_iter = params["max_iter"]
+    threshold = params["threshold"]
+    channels = params["channel"]
+    if not isinstance(channels, list):
+        channels = [channels]
+
+    spikes, dt, time, row_id = get_hmm_fit_data(rec_dir, params)
+    if params.get("trial_nums") is not None:
+        custom_trial_nums = params.pop("trial_nums")
+    else:
+        custom_trial_nums = None
+
+    hmms = []
+    for _ in range(max(n_restarts, 1)):
+        log_space = params.get("log_space", False)
+        if params["hmm_class"] == "PoissonHMM":
+            hmms.append(PoissonHMM(n_states, hmm_id=hmm_id, log_space=log_space))
+        elif params["hmm_class"] == "ConstrainedHMM":
+            hmms.append(
+                ConstrainedHMM(len(channels), hmm_id=hmm_id, log_space=log_space)
+            )
     # TODO: Generalize to take a function/class as hmm_class and create text rep for hdf5
 
-    hmm.randomize(spikes, dt, time, row_id=row_id, constraint_func=constraint_func)
-    success = hmm.fit(spikes, dt, time, max_iter=max_iter, threshold=threshold)
+    if len(hmms) > 1:
+        hmm = race_hmm_fits(
+            hmms,
+            spikes,
+            dt,
+            time,
+            max_iter=max_iter,
+            threshold=threshold,
+            row_id=row_id,
+            constraint_func=constraint_func,
+        )
+        success = True
+    else:
+        if result_queue is not None:
+
+            def checkpoint_func(x):
+                result_queue.put(("checkpoint", hmm_id, x.get_checkpoint(), params))
+
+        elif h5_file:
+
+            def checkpoint_func(x):
+                update_hmm_checkpoint(h5_file, hmm_id, x.get_checkpoint())
+
+        else:
+            checkpoint_func = None
+
+        hmm = hmms[0]
+        if checkpoint is not None:
+            print(
+                "%s: Resuming hmm %s from iteration %i"
+                % (os.getpid(), hmm_id, checkpoint["iteration"])
+            )
+            hmm.load_checkpoint(checkpoint, spikes, dt, time, row_id=row_id)
+        else:
+            hmm.randomize(
+                spikes, dt, time, row_id=row_id, constraint_func=constraint_func
+            )
+
+        success = hmm.fit(
+            spikes,
+            dt,
+            time,
+            max_iter=max_iter,
+            threshold=threshold,
+            checkpoint_func=checkpoint_func,
+        )
+
     if custom_trial_nums is not None:
         hmm.stat_arrays["trial_nums"] = np.array(custom_trial_nums)
     # else:
@@ -784,61 +1277,87 @@ def fit_hmm_mp(rec_dir, params, h5_file=None, constraint_func=None):
 
     if not success:
         print("%s: Fitting Aborted for hmm %s" % (os.getpid(), hmm_id))
+    else:
+        print("%s: Done Fitting for hmm %s" % (os.getpid(), hmm_id))
+
+    if result_queue is not None:
+        result_queue.put(("result", hmm_id, hmm if success else None, params))
+        return hmm_id, success
+    elif not success:
         if h5_file:
             return hmm_id, False
         else:
             return hmm_id, hmm
 
-    print("%s: Done Fitting for hmm %s" % (os.getpid(), hmm_id))
-    written = False
     if h5_file:
-        pid = os.getpid()
-        lock_file = h5_file + ".lock"
-        while os.path.exists(lock_file):
-            print("%s: Waiting for file lock" % pid)
-            sys_time.sleep(20)
-
-        locked = True
-        while locked:
-            if os.path.exists(lock_file):
-                locked = True
-                sys_time.sleep(10)
-            else:
-                open(lock_file, "w").close()
-                locked = False
-
-        try:
-            old_hmm, _, old_params = load_hmm_from_hdf5(h5_file, hmm_id)
+        written = write_hmm_result(h5_file, hmm, params)
+        if written and hmm.converged:
+            delete_hmm_checkpoint(h5_file, hmm_id)
 
-            if old_hmm is None:
-                print("%s: No existing HMM %s. Writing ..." % (pid, hmm_id))
-                write_hmm_to_hdf5(h5_file, hmm, params)
-                written = True
-            else:
-                print(
-                    "%s: Existing HMM %s found. Comparing log likelihood ..."
-                    % (pid, hmm_id)
-                )
-                print("New %.3E vs Old %.3E" % (hmm.fit_LL, old_hmm.fit_LL))
-                if hmm.fit_LL > old_hmm.fit_LL:
-                    print(
-                        "%s: Replacing HMM %s due to higher log likelihood"
-                        % (pid, hmm_id)
-                    )
-                    write_hmm_to_hdf5(h5_file, hmm, params)
-                    written = True
-
-        except Exception as e:
-            os.remove(lock_file)
-            raise Exception(e)
-
-        os.remove(lock_file)
-        del old_hmm, hmm, spikes, dt, time
+        del hmm, spikes, dt, time
         return hmm_id, written
     else:
         return hmm_id, hmm
 
 
+def write_hmm_result(h5_file, hmm, params):
+    """Writes a fitted HMM to the hdf5 store unless an existing fit of the same
+    hmm_id has a higher log likelihood
+
+    Returns
+    -------
+    bool, True if the HMM was written
+    """
+    pid = os.getpid()
+    hmm_id = params["hmm_id"]
+    old_hmm, _, old_params = load_hmm_from_hdf5(h5_file, hmm_id)
+
+    if old_hmm is None:
+        print("%s: No existing HMM %s. Writing ..." % (pid, hmm_id))
+        write_hmm_to_hdf5(h5_file, hmm, params)
+        return True
+
+    print("%s: Existing HMM %s found. Comparing log likelihood ..." % (pid, hmm_id))
+    print("New %.3E vs Old %.3E" % (hmm.fit_LL, old_hmm.fit_LL))
+    if hmm.fit_LL > old_hmm.fit_LL:
+        print("%s: Replacing HMM %s due to higher log likelihood" % (pid, hmm_id))
+        write_hmm_to_hdf5(h5_file, hmm, params)
+        return True
+
+    return False
+
+
+def hmm_writer(h5_file, result_queue, written, failures):
+    """Single writer for the hdf5 store, run on a thread by HmmHandler.run
+
+    Reads (kind, hmm_id, obj, params) tuples from result_queue until it gets
+    None. kind "result" carries a fitted HMM, or None for an aborted fit, which
+    is written with write_hmm_result. kind "checkpoint" carries a dict from
+    PoissonHMM.get_checkpoint, written with update_hmm_checkpoint. Whether each
+    HMM was written is stored in the written dict by hmm_id. Writes that raise
+    are appended to failures as (hmm_id, kind, exception) and the writer moves
+    on to the next item, the caller is responsible for raising them.
+    """
+    while True:
+        item = result_queue.get()
+        if item is None:
+            break
+
+        kind, hmm_id, obj, params = item
+        try:
+            if kind == "checkpoint":
+                update_hmm_checkpoint(h5_file, hmm_id, obj)
+                continue
+
+            written.setdefault(hmm_id, False)
+            if obj is not None and write_hmm_result(h5_file, obj, params):
+                written[hmm_id] = True
+                if obj.converged:
+                    delete_hmm_checkpoint(h5_file, hmm_id)
+        except Exception as e:
+            failures.append((hmm_id, kind, e))
+
+
 def load_hmm_from_hdf5(h5_file, hmm_id):
     hmm_id = int(hmm_id)
     try:
@@ -850,7 +1369,9 @@ def load_hmm_from_hdf5(h5_file, hmm_id):
         return None, None, None
 
     PI, A, B, stat_arrays, params = existing_hmm
-    hmm = PoissonHMM(params["n_states"], hmm_id=hmm_id)
+    hmm = PoissonHMM(
+        params["n_states"], hmm_id=hmm_id, log_space=bool(params.get("log_space", False))
+    )
     hmm._init_history()
     hmm.initial_distribution = PI
     hmm.transition = A
@@ -881,9 +1402,10 @@ def isConverged(hmm, thresh):
     pass
 
 
-def check_ll_trend(hmm, thresh, n_iter=None):
+def check_ll_trend(hmm, thresh, n_iter=None, n_recent=None):
     """Check the trend of the log-likelihood to see if it has plateaued, is
-    decreasing or is increasing
+    decreasing or is increasing. If n_recent is given only the last n_recent
+    iterations up to n_iter are considered
     """
     if n_iter is None:
         n_iter = hmm.iteration
@@ -894,6 +1416,9 @@ def check_ll_trend(hmm, thresh, n_iter=None):
         raise ValueError("Iteration %i is not in history" % n_iter)
 
     idx = np.where(iterations <= n_iter)[0]
+    if n_recent is not None:
+        idx = idx[-n_recent:]
+
     ll_hist = ll_hist[idx]
     filt_ll = gaussian_filter1d(ll_hist, 4)
     diff_ll = np.diff(filt_ll)
@@ -914,6 +1439,117 @@ def check_ll_trend(hmm, thresh, n_iter=None):
     return "flux"
 
 
+def rank_hmm_trajectories(hmms, thresh, n_recent=None):
+    """Orders HMMs from best to worst by their log likelihood trajectory. HMMs
+    whose recent log likelihood trend is decreasing rank below all others, the
+    rest are ordered by fit_LL
+
+    Returns
+    -------
+    list of int, indices into hmms
+    """
+    scores = []
+    for hmm in hmms:
+        trend = check_ll_trend(hmm, thresh, n_recent=n_recent)
+        fit_LL = hmm.fit_LL if np.isfinite(hmm.fit_LL) else -np.inf
+        scores.append((trend != "decreasing", fit_LL))
+
+    return sorted(range(len(hmms)), key=lambda i: scores[i], reverse=True)
+
+
+def race_hmm_fits(
+    hmms,
+    spikes,
+    dt,
+    time,
+    max_iter=500,
+    threshold=1e-5,
+    rung_iters=10,
+    keep_frac=0.5,
+    row_id=None,
+    constraint_func=None,
+    parallel=False,
+    seed=None,
+):
+    """Fits random restarts of an HMM by successive halving
+
+    Every HMM is randomized and all are fit in lockstep for rung_iters
+    iterations at a time. After each rung only the best keep_frac of the
+    population, ranked with rank_hmm_trajectories, keeps fitting. Once one HMM
+    is left it is fit until it converges or hits max_iter. Racing stops early
+    only if every survivor has converged or hit max_iter.
+
+    Parameters
+    ----------
+    hmms : list of PoissonHMM, unfitted HMMs with the same structure
+    spikes, dt, time : as in PoissonHMM.fit
+    max_iter : int, max iterations for any single HMM
+    threshold : float, convergence threshold
+    rung_iters : int, iterations between eliminations, at least 2
+    keep_frac : float, fraction of the population kept after each rung
+    row_id, constraint_func : as in PoissonHMM.randomize
+    parallel : bool, passed to PoissonHMM.fit
+    seed : int (optional), if given restart i is randomized with seed + i
+
+    Returns
+    -------
+    PoissonHMM, the surviving HMM with the highest fit_LL
+    """
+    rung_iters = max(rung_iters, 2)
+    for i, hmm in enumerate(hmms):
+        hmm.randomize(
+            spikes,
+            dt,
+            time,
+            row_id=row_id,
+            constraint_func=constraint_func,
+            seed=None if seed is None else seed + i,
+        )
+
+    active = list(hmms)
+    while True:
+        if len(active) == 1:
+            # the remaining budget goes to the winner
+            hmm = active[0]
+            if not (hmm.converged or hmm.iteration >= max_iter):
+                hmm.fit(
+                    spikes,
+                    dt,
+                    time,
+                    max_iter=max_iter,
+                    threshold=threshold,
+                    parallel=parallel,
+                )
+
+            break
+
+        for hmm in active:
+            if hmm.converged or hmm.iteration >= max_iter:
+                continue
+
+            hmm.fit(
+                spikes,
+                dt,
+                time,
+                max_iter=min(hmm.iteration + rung_iters, max_iter),
+                threshold=threshold,
+                parallel=parallel,
+            )
+
+        if all(hmm.converged or hmm.iteration >= max_iter for hmm in active):
+            break
+
+        order = rank_hmm_trajectories(active, threshold, n_recent=rung_iters + 1)
+        n_keep = max(1, int(np.ceil(len(active) * keep_frac)))
+        print(
+            "%s: Racing HMM %s: keeping %i of %i restarts"
+            % (os.getpid(), active[0].hmm_id, n_keep, len(active))
+        )
+        active = [active[i] for i in order[:n_keep]]
+
+    return max(active, key=lambda x: x.fit_LL if np.isfinite(x.fit_LL) else -np.inf)
+
+
 def roll_back_hmm_to_best(hmm, spikes, dt, thresh):
     """Looks at the log likelihood over fitting and determines the best
     iteration to have stopped at by choosing a local maxima during a period
@@ -921,13 +1557,16 @@ def roll_back_hmm_to_best(hmm, spikes, dt, thresh):
     This was necessary when HMM fitting algorithm was flawed, fixed now, so
     last iteration is always best iteration (max log likelihood).
     So this is basically deprecated, not even sure if it will still work.
+    Only the iterations still in hmm.history (the last history_size) can be
+    rolled back to, so only those are considered.
     """
     ll_hist = np.array(hmm.stat_arrays["max_log_prob"])
-    idx = np.where(np.isfinite(ll_hist))[0]
+    iterations = np.array(hmm.stat_arrays["iterations"])
+    in_history = np.isin(iterations, list(hmm.history["iterations"]))
+    idx = np.where(np.isfinite(ll_hist) & in_history)[0]
     if len(idx) == 0:
         return hmm
 
-    iterations = np.array(hmm.stat_arrays["iterations"])
     ll_hist = ll_hist[idx]
     iterations = iterations[idx]
     filt_ll = gaussian_filter1d(ll_hist, 4)
@@ -944,7 +1583,9 @@ def roll_back_hmm_to_best(hmm, spikes, dt, thresh):
     if len(below) == 0:
         below = np.arange(len(iterations))
 
-    below = below[below > 2]
+    below = np.asarray(below)
+    if np.any(below > 2):
+        below = below[below > 2]
 
     tmp = [
         x
@@ -972,13 +1613,20 @@ def get_new_id(ids=None):
 
 
 class PoissonHMM(object):
-    def __init__(self, n_states, hmm_id=None):
+    def __init__(
+        self, n_states, hmm_id=None, history_size=HISTORY_SIZE, log_space=False
+    ):
+        """log_space selects the log-space E-step (log_forward/log_backward),
+        which does not underflow on long trials, many cells or fine dt
+        """
         self.stat_arrays = {}  # dict of cumulative stats to keep while fitting
         # iterations, max_log_likelihood, fit log
         # likelihood, cost, best_sequences, gamma
         # probabilities, time, row_id
         self.n_states = n_states
         self.hmm_id = hmm_id
+        self.history_size = history_size
+        self.log_space = log_space
 
         self.transition = None
         self.emission = None
@@ -992,7 +1640,7 @@ class PoissonHMM(object):
         self.max_log_prob = None
         self.fit_LL = None
 
-    def randomize(self, spikes, dt, time, row_id=None, constraint_func=None):
+    def randomize(self, spikes, dt, time, row_id=None, constraint_func=None, seed=None):
         """Initialize and randomize HMM matrices: initial_distribution (PI),
         transition (A) and emission/rates (B)
         Parameters
@@ -1013,13 +1661,16 @@ class PoissonHMM(object):
             user can provide a function that is used after randomization to
             constrain the PI, A and B matrices. The function must take PI, A, B
             as arguments and return PI, A, B.
+        seed : int (optional)
+            seeds numpy's random state, by default it is reseeded from the OS
+            so HMMs randomized in forked processes differ
         """
         # setup parameters
         # make transition matrix
         # all baseline states have equal probability of staying or changing
         # into each other and the early states
         # each early state has high stay probability and low chance to transition into
-        np.random.seed(None)
+        np.random.seed(seed)
         n_trials, n_cells, n_steps = spikes.shape
         n_states = self.n_states
 
@@ -1077,7 +1728,13 @@ class PoissonHMM(object):
         self.stat_arrays["max_log_prob"] = []
         self.stat_arrays["fit_LL"] = []
         self.stat_arrays["iterations"] = []
-        self.history = {"A": [], "B": [], "PI": [], "iterations": []}
+        size = getattr(self, "history_size", HISTORY_SIZE)
+        self.history = {
+            "A": deque(maxlen=size),
+            "B": deque(maxlen=size),
+            "PI": deque(maxlen=size),
+            "iterations": deque(maxlen=size),
+        }
 
     def _update_history(self):
         itr = self.iteration
@@ -1092,10 +1749,24 @@ class PoissonHMM(object):
         self.stat_arrays["fit_LL"].append(self.fit_LL)
         self.stat_arrays["iterations"].append(itr)
 
-    def fit(self, spikes, dt, time, max_iter=500, threshold=1e-5, parallel=False):
-        """using parallels for processing trials actually seems to slow down
-        processing (with 15 trials). Might still be useful if there is a very
-        large nubmer of trials
+    def fit(
+        self,
+        spikes,
+        dt,
+        time,
+        max_iter=500,
+        threshold=1e-5,
+        parallel=False,
+        checkpoint_func=None,
+        checkpoint_every=CHECKPOINT_EVERY,
+    ):
+        """parallel runs the trials of each E-step across numba threads instead of
+        serially. Leave it off when several HMMs are already fit in parallel processes
+
+        If given, checkpoint_func is called with this HMM every checkpoint_every
+        iterations so an interrupted fit can be resumed with load_checkpoint.
+        Calling fit again on a partly fit HMM continues the convergence check
+        from the last fit_LL in stat_arrays
         """
         spikes = spikes.astype("int32")
         if (
@@ -1109,10 +1780,18 @@ class PoissonHMM(object):
 
         converged = False
         last_logl = None
+        if self.iteration > 0 and len(self.stat_arrays.get("fit_LL", [])) > 0:
+            # resuming, e.g. the next rung of race_hmm_fits, so the first
+            # iteration can be judged against the last one already run
+            last_logl = self.stat_arrays["fit_LL"][-1]
+
         self.stat_arrays["time"] = time
         while not converged and (self.iteration < max_iter):
             self.fit_LL = self._step(spikes, dt, parallel=parallel)
             self._update_history()
+            if checkpoint_func is not None and self.iteration % checkpoint_every == 0:
+                checkpoint_func(self)
+
             # if self.iteration >= 100:
             #     trend = check_ll_trend(self, threshold)
             #     if trend == 'decreasing':
@@ -1166,23 +1845,26 @@ class PoissonHMM(object):
         nStates = self.n_states
 
         # For multiple trials need to cmpute gamma and epsilon for every trial
-        # and then update
-        if parallel:
-            n_cores = cpu_count() - 1
+        # and then update, all trials are run in one compiled call
+        if self.log_space:
+            if parallel:
+                batch = log_baum_welch_stats_batch
+            else:
+                batch = log_baum_welch_stats_batch_serial
+
+            gammas, epsilon_sums, log_norms = batch(spikes, dt, PI, A, B)
+            logl = np.sum(log_norms)
         else:
-            n_cores = 1
+            if parallel:
+                batch = baum_welch_stats_batch
+            else:
+                batch = baum_welch_stats_batch_serial
 
-        results = Parallel(n_jobs=n_cores, backend="multiprocessing")(
-            delayed(baum_welch)(trial, dt, PI, A, B) for trial in spikes
-        )
-        gammas, epsilons, norms = zip(*results)
-        gammas = np.array(gammas)
-        epsilons = np.array(epsilons)
-        norms = np.array(norms)
-        # logl = np.sum(norms)
-        logl = sum_log_probs(norms)
-
-        PI, A, B = compute_new_matrices(spikes, dt, gammas, epsilons)
+            gammas, epsilon_sums, norms = batch(spikes, dt, PI, A, B)
+            # logl = np.sum(norms)
+            logl = sum_log_probs(norms)
+
+        PI, A, B = compute_new_matrices_from_stats(spikes, dt, gammas, epsilon_sums)
         # Make sure rates are non-zeros for computations
         # B[np.where(B==0)] = 1e-300
         A[A < 1e-50] = 0.0
@@ -1197,16 +1879,26 @@ class PoissonHMM(object):
         self._update_cost(spikes, dt)
         return logl
 
-    def get_best_paths(self, spikes, dt, recompute=False):
+    def get_best_paths(self, spikes, dt, recompute=False, h5_file=None, params=None):
+        """Viterbi paths and their summed log probability. If h5_file and the
+        HMM's params are given, a stored decoding of these matrices and data is
+        returned instead of decoding again, unless recompute is True
+        """
         # The is statement is causing issues here
         # if "best_sequences" is self.stat_arrays.keys() and recompute == False:
         #     return self.stat_arrays["best_sequences"], self.max_log_prob
+        if not recompute and h5_file is not None and params is not None:
+            bestPaths, maxLogProb = get_cached_best_paths(h5_file, self, params, spikes)
+            if bestPaths is not None:
+                return bestPaths, maxLogProb
 
         PI = self.initial_distribution
         A = self.transition
         B = self.emission
 
-        bestPaths, pathProbs = compute_best_paths(spikes, dt, PI, A, B)
+        bestPaths, pathProbs = compute_best_paths(
+            spikes, dt, PI, A, B, log_space=self.log_space
+        )
         return bestPaths, np.sum(pathProbs)
 
     def get_forward_probabilities(self, spikes, dt, parallel=False):
@@ -1249,33 +1941,43 @@ class PoissonHMM(object):
         PI = self.initial_distribution
         A = self.transition
         B = self.emission
-        if parallel:
-            n_cpu = cpu_count() - 1
+        if self.log_space and parallel:
+            gammas, _, _ = log_baum_welch_stats_batch(spikes, dt, PI, A, B)
+        elif self.log_space:
+            gammas, _, _ = log_baum_welch_stats_batch_serial(spikes, dt, PI, A, B)
+        elif parallel:
+            gammas, _, _ = baum_welch_stats_batch(spikes, dt, PI, A, B)
         else:
-            n_cpu = 1
+            gammas, _, _ = baum_welch_stats_batch_serial(spikes, dt, PI, A, B)
 
-        results = Parallel(n_jobs=n_cpu, backend="multiprocessing")(
-            delayed(baum_welch)(trial, dt, PI, A, B) for trial in spikes
-        )
-        gammas, _, _ = zip(*results)
-        return np.array(gammas)
+        return gammas
 
     def _update_cost(self, spikes, dt):
         spikes = spikes.astype("int")
         PI = self.initial_distribution
         A = self.transition
         B = self.emission
-        cost, BIC, bestPaths, maxLogProb = compute_hmm_cost(spikes, dt, PI, A, B)
+        cost, BIC, bestPaths, maxLogProb = compute_hmm_cost(
+            spikes, dt, PI, A, B, log_space=self.log_space
+        )
         self.cost = cost
         self.BIC = BIC
         self.max_log_prob = maxLogProb
         self.stat_arrays["best_sequences"] = bestPaths
 
     def roll_back(self, iteration, spikes=None, dt=None):
-        itrs = self.history["iterations"]
+        """Restores the matrices of a past iteration. Only the last
+        history_size iterations are kept in self.history, older ones raise a
+        ValueError
+        """
+        itrs = np.array(self.history["iterations"])
         idx = np.where(itrs == iteration)[0]
         if len(idx) == 0:
-            raise ValueError("Iteration %i not found in history" % iteration)
+            raise ValueError(
+                "Iteration %i not found in history, only iterations kept in the "
+                "last %i history entries (%s) can be rolled back to"
+                % (iteration, len(itrs), ", ".join(str(x) for x in itrs))
+            )
 
         idx = idx[0]
         self.emission = self.history["B"][idx]
@@ -1283,7 +1985,7 @@ class PoissonHMM(object):
         self.initial_distribution = self.history["PI"][idx]
         self.iteration = iteration
 
-        itrs = self.stat_arrays["iterations"]
+        itrs = np.array(self.stat_arrays["iterations"])
         idx = np.where(itrs == iteration)[0][0]
         self.fit_LL = self.stat_arrays["fit_LL"][idx]
         self.max_log_prob = self.stat_arrays["max_log_prob"][idx]
@@ -1297,6 +1999,52 @@ class PoissonHMM(object):
 
         self._update_history()
 
+    def get_checkpoint(self):
+        """Returns the current matrices, the per iteration stats and the
+        parameter history as a dict of arrays, see write_hmm_checkpoint
+        """
+        checkpoint = {
+            "iteration": self.iteration,
+            "initial_distribution": self.initial_distribution,
+            "transition": self.transition,
+            "emission": self.emission,
+            "history_PI": np.array(self.history["PI"]),
+            "history_A": np.array(self.history["A"]),
+            "history_B": np.array(self.history["B"]),
+            "history_iterations": np.array(self.history["iterations"]),
+            "iterations": np.array(self.stat_arrays["iterations"]),
+        }
+        for k in ["cost", "BIC", "max_log_prob", "fit_LL"]:
+            checkpoint[k] = np.array(self.stat_arrays[k], dtype="float64")
+
+        return checkpoint
+
+    def load_checkpoint(self, checkpoint, spikes, dt, time, row_id=None):
+        """Restores the HMM from a dict made by get_checkpoint so fitting can
+        continue from where it stopped, use in place of randomize
+        """
+        self.initial_distribution = checkpoint["initial_distribution"]
+        self.transition = checkpoint["transition"]
+        self.emission = checkpoint["emission"]
+        self.iteration = int(checkpoint["iteration"])
+        self.fitted = False
+        self.converged = False
+
+        self._init_history()
+        for k in ["PI", "A", "B", "iterations"]:
+            self.history[k].extend(checkpoint["history_" + k])
+
+        for k in ["cost", "BIC", "max_log_prob", "fit_LL", "iterations"]:
+            self.stat_arrays[k] = list(checkpoint[k])
+
+        self.stat_arrays["row_id"] = row_id
+        self.stat_arrays["time"] = time
+        self.stat_arrays["gamma_probabilities"] = self.get_gamma_probabilities(
+            spikes, dt
+        )
+        self._update_cost(spikes, dt)
+        self.fit_LL = self.stat_arrays["fit_LL"][-1]
+
     def gamma_sequences(self):
         gamma = self.stat_arrays["gamma_probabilities"]
         gamma_sequences = np.argmax(gamma, axis=1)
@@ -1311,6 +2059,200 @@ def get_hmm_overview_from_hdf5(h5_file):
     pass
 
 
+def write_hmm_checkpoint(h5_file, hmm_id, checkpoint):
+    """Writes a checkpoint from PoissonHMM.get_checkpoint to
+    /hmm_<hmm_id>/checkpoint, replacing any existing checkpoint
+    """
+    path = "/hmm_%i" % int(hmm_id)
+    with tables.open_file(h5_file, "a") as hf5:
+        if path + "/checkpoint" in hf5:
+            hf5.remove_node(path, "checkpoint", recursive=True)
+
+        group = hf5.create_group(path, "checkpoint", createparents=True)
+        group._v_attrs.iteration = int(checkpoint["iteration"])
+        for k, v in checkpoint.items():
+            if k != "iteration":
+                hf5.create_array(group, k, np.asarray(v))
+
+
+def read_hmm_checkpoint(h5_file, hmm_id):
+    """Returns the checkpoint dict stored for an HMM, None if there is none"""
+    path = "/hmm_%i/checkpoint" % int(hmm_id)
+    if not os.path.isfile(h5_file):
+        return None
+
+    with tables.open_file(h5_file, "r") as hf5:
+        if path not in hf5:
+            return None
+
+        group = hf5.get_node(path)
+        checkpoint = {node._v_name: node.read() for node in group._f_iter_nodes()}
+        checkpoint["iteration"] = int(group._v_attrs.iteration)
+
+    return checkpoint
+
+
+def delete_hmm_checkpoint(h5_file, hmm_id):
+    path = "/hmm_%i" % int(hmm_id)
+    if not os.path.isfile(h5_file):
+        return
+
+    with tables.open_file(h5_file, "a") as hf5:
+        if path + "/checkpoint" in hf5:
+            hf5.remove_node(path, "checkpoint", recursive=True)
+
+
+def get_hmm_param_hash(hmm, params):
+    """Hash of an HMM's matrices, the data selection in its parameters and its
+    forward/backward engine, a stored decoding is only reused while this
+    matches
+    """
+    data_keys = [
+        "dt",
+        "time_start",
+        "time_end",
+        "unit_type",
+        "channel",
+        "taste",
+        "n_trials",
+        "trial_nums",
+        "area",
+        "log_space",
+    ]
+    h = hashlib.sha1()
+    for arr in [hmm.initial_distribution, hmm.transition, hmm.emission]:
+        h.update(np.ascontiguousarray(arr, dtype="float64").tobytes())
+
+    data_params = {k: params.get(k) for k in data_keys}
+    # decoding uses the HMM's own engine, rows from before the log_space column
+    # have no entry for it
+    data_params["log_space"] = bool(hmm.log_space)
+    h.update(json.dumps(data_params, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+def decode_hmm(hmm, spikes, dt, parallel=True):
+    """Viterbi and posterior decoding of every trial in spikes
+
+    Returns
+    -------
+    dict with best_paths (trials x time), path_log_probs (trials),
+    gamma_probabilities (trials x states x time) and gamma_sequences
+    (trials x time, the most probable state in each bin)
+    """
+    spikes = spikes.astype("int32")
+    PI = hmm.initial_distribution
+    A = hmm.transition
+    B = hmm.emission
+    if parallel:
+        best_paths, path_log_probs = viterbi_batch(
+            spikes, dt, PI, A, B, hmm.log_space
+        )
+    else:
+        best_paths, path_log_probs = viterbi_batch_serial(
+            spikes, dt, PI, A, B, hmm.log_space
+        )
+
+    gammas = hmm.get_gamma_probabilities(spikes, dt, parallel=parallel)
+    return {
+        "best_paths": best_paths,
+        "path_log_probs": path_log_probs,
+        "gamma_probabilities": gammas,
+        "gamma_sequences": np.argmax(gammas, axis=1),
+    }
+
+
+def get_cached_best_paths(h5_file, hmm, params, spikes=None):
+    """Viterbi paths and summed path log probability from the decoding stored
+    for hmm with write_hmm_decoding, if it was made with the HMM's current
+    matrices and data parameters. If spikes is given the paths must also match
+    its trials x time shape.
+
+    Returns
+    -------
+    best_paths, max_log_prob : np.array, float or None, None if not cached
+    """
+    if hmm.hmm_id is None:
+        return None, None
+
+    decoded = read_hmm_decoding(h5_file, hmm.hmm_id, get_hmm_param_hash(hmm, params))
+    if decoded is None:
+        return None, None
+
+    best_paths = decoded["best_paths"]
+    if spikes is not None and best_paths.shape != (spikes.shape[0], spikes.shape[-1]):
+        return None, None
+
+    return best_paths, np.sum(decoded["path_log_probs"])
+
+
+def get_hmm_rate_array(
+    hmm, spikes, dt, win_size, step_size=None, h5_file=None, params=None
+):
+    """Rates of the HMM's Viterbi state sequences binned as in
+    generate_rate_array_from_state_seq, decoded paths are read from the store
+    when h5_file and params are given and a decoding is cached
+    """
+    best_paths, _ = hmm.get_best_paths(spikes, dt, h5_file=h5_file, params=params)
+    return generate_rate_array_from_state_seq(
+        best_paths, hmm.emission, dt, win_size, step_size
+    )
+
+
+def write_hmm_decoding(h5_file, hmm_id, param_hash, decoded):
+    """Stores the output of decode_hmm in /hmm_<hmm_id>/decoded, tagged with
+    the parameter hash from get_hmm_param_hash
+    """
+    path = "/hmm_%i" % int(hmm_id)
+    with tables.open_file(h5_file, "a") as hf5:
+        if path + "/decoded" in hf5:
+            hf5.remove_node(path, "decoded", recursive=True)
+
+        group = hf5.create_group(path, "decoded", createparents=True)
+        group._v_attrs.param_hash = param_hash
+        for k, v in decoded.items():
+            hf5.create_array(group, k, np.asarray(v))
+
+
+def read_hmm_decoding(h5_file, hmm_id, param_hash=None):
+    """Returns the stored decoding of an HMM as a dict, None if there is none
+    or, when param_hash is given, if it was made with different parameters
+    """
+    path = "/hmm_%i/decoded" % int(hmm_id)
+    if not os.path.isfile(h5_file):
+        return None
+
+    with tables.open_file(h5_file, "r") as hf5:
+        if path not in hf5:
+            return None
+
+        group = hf5.get_node(path)
+        if param_hash is not None and group._v_attrs.param_hash != param_hash:
+            return None
+
+        return {node._v_name: node.read() for node in group._f_iter_nodes()}
+
+
+def update_hmm_checkpoint(h5_file, hmm_id, checkpoint):
+    """Writes a checkpoint unless the stored one has a higher log likelihood,
+    as when several repeats of the same hmm_id are fit at once
+
+    Returns
+    -------
+    bool, True if the checkpoint was written
+    """
+    if os.path.isfile(h5_file):
+        path = "/hmm_%i/checkpoint" % int(hmm_id)
+        with tables.open_file(h5_file, "r") as hf5:
+            if path + "/fit_LL" in hf5:
+                old_LL = hf5.get_node(path + "/fit_LL")[-1]
+                if old_LL > checkpoint["fit_LL"][-1]:
+                    return False
+
+    write_hmm_checkpoint(h5_file, hmm_id, checkpoint)
+    return True
+
+
 class HmmHandler(object):
     def __init__(self, dat, save_dir=None):
         """Takes a cpl_pipeline dataset object and fits HMMs for each tastant
@@ -1425,8 +2367,28 @@ class HmmHandler(object):
         return
 
     def run(
-        self, parallel=True, overwrite="unconverged", constraint_func=None, n_cpu=None
+        self,
+        parallel=True,
+        overwrite="unconverged",
+        constraint_func=None,
+        n_cpu=None,
+        race=False,
     ):
+        """Fits all queued parameter sets
+
+        Parameters
+        ----------
+        parallel : bool, fit parameter sets in parallel processes
+        overwrite : {"unconverged", "all", False}, which fitted sets to refit
+        constraint_func : function, passed to PoissonHMM.randomize
+        n_cpu : int, number of processes
+        race : bool, if True the n_repeats restarts queued for each hmm_id are
+            raced in a single task with race_hmm_fits instead of each being
+            fit to completion
+
+        With overwrite="unconverged" the first repeat of each hmm_id resumes
+        from its stored checkpoint, if there is one, instead of re-randomizing
+        """
         h5_file = self.h5_file
         rec_dir = self.root_dir
 
@@ -1442,31 +2404,84 @@ class HmmHandler(object):
         if len(fit_params) == 0:
             return
 
+        if race:
+            grouped = {}
+            for p in fit_params:
+                grouped.setdefault(p["hmm_id"], []).append(p)
+
+            fit_tasks = [(group[0], len(group)) for group in grouped.values()]
+        else:
+            fit_tasks = [(p, 1) for p in fit_params]
+
+        checkpoints = {}
+        if overwrite == "unconverged":
+            for p, n in fit_tasks:
+                if n == 1 and p["hmm_id"] not in checkpoints:
+                    checkpoints[p["hmm_id"]] = read_hmm_checkpoint(h5_file, p["hmm_id"])
+
         print("Running fittings")
         max_cpu = cpu_count()
         if parallel and n_cpu is None:
-            n_cpu = int(np.min((cpu_count() - 1, len(fit_params))))
+            n_cpu = int(np.min((cpu_count() - 1, len(fit_tasks))))
         elif not parallel:
             n_cpu = 1
         else:
-            n_cpu = int(np.min((n_cpu, len(fit_params))))
+            n_cpu = int(np.min((n_cpu, len(fit_tasks))))
 
         assert (
             1 <= n_cpu <= max_cpu
         ), f"n_cpu must be a valid integer 1 <= n_cpu <= {max_cpu}"
 
-        results = Parallel(n_jobs=n_cpu, verbose=100, backend="multiprocessing")(
-            delayed(fit_hmm_mp)(rec_dir, p, h5_file, constraint_func)
-            for p in fit_params
-        )
+        # workers only fit, fitted HMMs are queued to one writer thread here so
+        # no process ever waits on the hdf5 store
+        written = {}
+        failures = []
+        with multiprocessing.Manager() as manager:
+            result_queue = manager.Queue()
+            writer = threading.Thread(
+                target=hmm_writer, args=(h5_file, result_queue, written, failures)
+            )
+            writer.start()
+            try:
+                results = Parallel(
+                    n_jobs=n_cpu, verbose=100, backend="multiprocessing"
+                )(
+                    delayed(fit_hmm_mp)(
+                        rec_dir,
+                        p,
+                        None,
+                        constraint_func,
+                        result_queue,
+                        n,
+                        checkpoints.pop(p["hmm_id"], None),
+                    )
+                    for p, n in fit_tasks
+                )
+            finally:
+                result_queue.put(None)
+                writer.join()
 
-        memory.clear(warn=False)
+        try:
+            memory.reduce_size(bytes_limit=SPIKE_CACHE_BYTES)
+        except TypeError:
+            # joblib < 1.4 reads the limit from the Memory object
+            memory.bytes_limit = SPIKE_CACHE_BYTES
+            memory.reduce_size()
         print("=" * 80)
         print("Fitting Complete")
         print("=" * 80)
         print("HMMs written to hdf5:")
-        for hmm_id, written in results:
-            print("%s : %s" % (hmm_id, written))
+        for hmm_id, _ in results:
+            print("%s : %s" % (hmm_id, written.get(hmm_id, False)))
+
+        if failures:
+            msg = "\n".join(
+                "HMM %s: failed to write %s: %r" % (hmm_id, kind, e)
+                for hmm_id, kind, e in failures
+            )
+            raise RuntimeError(
+                "%i HMM writes to %s failed:\n%s" % (len(failures), h5_file, msg)
+            ) from failures[0][2]
 
         # self.plot_saved_models()
         self.load_params()
@@ -1500,12 +2515,44 @@ class HmmHandler(object):
             print("Plotting HMM %s..." % i)
             make_hmm_raster(spikes, time, save_file)
 
+    def decode_saved_models(self, parallel=True, overwrite=False):
+        """Viterbi and posterior decodes every HMM in the store and saves the
+        results with write_hmm_decoding. HMMs that already have a decoding for
+        their current parameters are skipped unless overwrite is True.
+        Trials are decoded across numba threads if parallel is True.
+        """
+        data = self.get_data_overview()
+        rec_dir = self.root_dir
+        for hmm_id in data.hmm_id:
+            hmm, _, params = load_hmm_from_hdf5(self.h5_file, hmm_id)
+            if hmm is None:
+                continue
+
+            if hmm.stat_arrays.get("trial_nums") is not None:
+                params["trial_nums"] = list(hmm.stat_arrays["trial_nums"])
+
+            param_hash = get_hmm_param_hash(hmm, params)
+            if not overwrite and read_hmm_decoding(self.h5_file, hmm_id, param_hash):
+                continue
+
+            print("Decoding HMM %s..." % hmm_id)
+            spikes, dt, _, _ = get_hmm_fit_data(rec_dir, params)
+            decoded = decode_hmm(hmm, spikes, dt, parallel=parallel)
+            write_hmm_decoding(self.h5_file, hmm_id, param_hash, decoded)
+
     def plot_saved_models(self, dinlabels=True):
         print("Plotting saved models")
+        self.decode_saved_models()
         data = self.get_data_overview().set_index("hmm_id")
         rec_dir = self.root_dir
         for i, row in data.iterrows():
             hmm, _, params = load_hmm_from_hdf5(self.h5_file, i)
+            decoded = read_hmm_decoding(self.h5_file, i)
+            if decoded is not None:
+                hmm.stat_arrays["best_sequences"] = decoded["best_paths"]
+                hmm.stat_arrays["gamma_probabilities"] = decoded["gamma_probabilities"]
+                hmm.stat_arrays["gamma_sequences"] = decoded["gamma_sequences"]
+
             if params.get("trial_nums") is not None:
                 trials = params["trial_nums"]
             else:
@@ -1773,7 +2820,14 @@ def sequential_constraint(PI, A, B):
 
 
 class ConstrainedHMM(PoissonHMM):
-    def __init__(self, n_tastes, n_baseline=3, hmm_id=None):
+    def __init__(
+        self,
+        n_tastes,
+        n_baseline=3,
+        hmm_id=None,
+        history_size=HISTORY_SIZE,
+        log_space=False,
+    ):
         self.stat_arrays = {}  # dict of cumulative stats to keep while fitting
         # iterations, max_log_likelihood, fit log
         # likelihood, cost, best_sequences, gamma
@@ -1781,14 +2835,19 @@ class ConstrainedHMM(PoissonHMM):
         self.n_tastes = n_tastes
         self.n_baseline = n_baseline
         n_states = n_baseline + 2 * n_tastes
-        super().__init__(n_states, hmm_id=hmm_id)
+        super().__init__(
+            n_states, hmm_id=hmm_id, history_size=history_size, log_space=log_space
+        )
 
-    def randomize(self, spikes, dt, time, row_id=None, constraint_func=None):
+    def randomize(self, spikes, dt, time, row_id=None, constraint_func=None, seed=None):
         # setup parameters
         # make transition matrix
         # all baseline states have equal probability of staying or changing
         # into each other and the early states
         # each early state has high stay probability and low chance to transition into
+        if seed is not None:
+            np.random.seed(seed)
+
         n_trials, n_cells, n_steps = spikes.shape
         n_tastes = self.n_tastes
         n_baseline = self.n_baseline
@@ -1864,10 +2923,24 @@ class ConstrainedHMM(PoissonHMM):
         self._update_history()
         self._update_history()
 
-    def fit(self, spikes, dt, time, max_iter=500, threshold=1e-5, parallel=False):
-        """using parallels for processing trials actually seems to slow down
-        processing (with 15 trials). Might still be useful if there is a very
-        large nubmer of trials
+    def fit(
+        self,
+        spikes,
+        dt,
+        time,
+        max_iter=500,
+        threshold=1e-5,
+        parallel=False,
+        checkpoint_func=None,
+        checkpoint_every=CHECKPOINT_EVERY,
+    ):
+        """parallel runs the trials of each E-step across numba threads instead of
+        serially. Leave it off when several HMMs are already fit in parallel processes
+
+        If given, checkpoint_func is called with this HMM every checkpoint_every
+        iterations so an interrupted fit can be resumed with load_checkpoint.
+        Calling fit again on a partly fit HMM continues the convergence check
+        from the last fit_LL in stat_arrays
         """
         spikes = spikes.astype("int32")
         if (
@@ -1881,10 +2954,18 @@ class ConstrainedHMM(PoissonHMM):
 
         converged = False
         last_logl = None
+        if self.iteration > 0 and len(self.stat_arrays.get("fit_LL", [])) > 0:
+            # resuming, e.g. the next rung of race_hmm_fits, so the first
+            # iteration can be judged against the last one already run
+            last_logl = self.stat_arrays["fit_LL"][-1]
+
         self.stat_arrays["time"] = time
         while not converged and (self.iteration < max_iter):
             self.fit_LL = self._step(spikes, dt, parallel=parallel)
             self._update_history()
+            if checkpoint_func is not None and self.iteration % checkpoint_every == 0:
+                checkpoint_func(self)
+
             # if self.iteration >= 100:
             #     trend = check_ll_trend(self, threshold)
             #     if trend == 'decreasing':
@@ -5,6 +5,8 @@ from scipy.interpolate import interp1d
 from scipy.stats import mannwhitneyu, sem
 from joblib import Parallel, delayed
 
+from cpl_pipeline.spk_io import h5io
+
 
 def interpolate_waves(waves, fs, fs_new, axis=1):
     end_time = waves.shape[axis] / (fs / 1000)
@@ -14,57 +16,90 @@ def interpolate_waves(waves, fs, fs_new, axis=1):
     return f(x_new)
 
 
-def make_single_trial_psth(spike_train, win_size, win_step, time=None):
-    """Takes a spike train and returns firing rate trace in Hz
+def get_window_counts(spikes, time, win_starts, win_size):
+    """Sums spikes in the windows [start, start + win_size] along the last axis
+    using one cumulative sum, so any number of trials and units can be binned
+    at once
 
     Parameters
     ----------
-    spike_train : 1D numpy.array
-        spike train with 1s in bins with spikes and 0s elsewhere
+    spikes : numpy.array, ... x Time array of spike counts
+    time : numpy.array, sorted time vector corresponding to the last axis
+    win_starts : numpy.array, start time of each window
+    win_size : float, window size, windows include both edges
+
+    Returns
+    -------
+    counts : numpy.array, ... x Windows array of spike counts
+    """
+    csum = np.zeros(spikes.shape[:-1] + (spikes.shape[-1] + 1,))
+    np.cumsum(spikes, axis=-1, out=csum[..., 1:])
+    lo = np.searchsorted(time, win_starts, side="left")
+    hi = np.searchsorted(time, np.asarray(win_starts) + win_size, side="right")
+    return csum[..., hi] - csum[..., lo]
+
+
+def make_psth_array(spike_array, win_size, win_step, time=None):
+    """Takes an array of spike trains and returns firing rate traces in Hz,
+    computed along the last axis
+
+    Parameters
+    ----------
+    spike_array : numpy.array
+        ... x Time array with 1s in bins with spikes and 0s elsewhere, e.g. a
+        Trial x Unit x Time spike array
     win_size : float, window size of psth in ms
     win_step : float, step size of psth in ms
     time : numpy.array (optional)
-        time array with times corresponding to bins in spike_train
+        time array with times corresponding to bins in spike_array
         if not provided then on is created starting at 0 and assuming 1ms bins
 
     Returns
     -------
-    psth : numpy.array, firing rate vector with units of Hz
+    psth : numpy.array, ... x Time firing rate array with units of Hz
     psth_time: numpy.array, time vector corresponding to the psth
     """
     if time is None:
-        time = np.arange(0, len(spike_train), 1)  # assume 1ms bins
+        time = np.arange(0, spike_array.shape[-1], 1)  # assume 1ms bins
 
     psth_time = np.arange(
         np.min(time) + (win_size / 2), np.max(time) - (win_size / 2), win_step
     )
-    psth = np.zeros(psth_time.shape)
-    window = np.array([-win_size / 2, win_size / 2])
-
-    for i, t in enumerate(psth_time):
-        t_win = t + window
-        idx = np.where((time >= t_win[0]) & (time <= t_win[1]))[0]
-        psth[i] = np.sum(spike_train[idx]) / (win_size / 1000.0)  # in Hz
+    counts = get_window_counts(spike_array, time, psth_time - win_size / 2, win_size)
+    psth = counts / (win_size / 1000.0)  # in Hz
 
     return psth, psth_time
 
 
+def make_single_trial_psth(spike_train, win_size, win_step, time=None):
+    """Takes a spike train and returns firing rate trace in Hz
+
+    Parameters
+    ----------
+    spike_train : 1D numpy.array
+        spike train with 1s in bins with spikes and 0s elsewhere
+    win_size : float, window size of psth in ms
+    win_step : float, step size of psth in ms
+    time : numpy.array (optional)
+        time array with times corresponding to bins in spike_train
+        if not provided then on is created starting at 0 and assuming 1ms bins
+
+    Returns
+    -------
+    psth : numpy.array, firing rate vector with units of Hz
+    psth_time: numpy.array, time vector corresponding to the psth
+    """
+    return make_psth_array(spike_train, win_size, win_step, time)
+
+
 def make_mean_PSTHs(h5_file, win_size, win_step, dig_in_ch):
     with tables.open_file(h5_file, "r") as hf5:
         spike_data = hf5.root.spike_trains["dig_in_%i" % dig_in_ch]
-        spike_array = spike_data.spike_array[:]
-        time = spike_data.array_time[:]
+        time, spike_array = h5io.read_spike_array(spike_data)
 
-        psth_time = np.arange(
-            np.min(time) - (win_size / 2), np.max(time) + (win_size / 2), win_step
-        )
-        PSTHs = np.zeros((len(psth_time), spike_array.shape[1]))
-
-        for trial in spike_array:
-            for i, unit in enumerate(trial):
-                tmp, tmp_time = make_single_trial_psth(unit, win_size, win_step, time)
-                PSTHs[:, i] += tmp
-        PSTHs /= spike_array.shape[0]
+    # Time x Unit mean firing rates
+    psth, psth_time = make_psth_array(spike_array, win_size, win_step, time)
+    PSTHs = np.mean(psth, axis=0).T
 
     return PSTHs, psth_time
 
@@ -73,25 +108,14 @@ def make_psths_for_tastant(h5_file, win_size, win_step, dig_in_ch, smoothing_wid
     dig_str = "dig_in_%i" % dig_in_ch
     with tables.open_file(h5_file, "r+") as hf5:
         spike_data = hf5.root.spike_trains[dig_str]
-        spike_array = spike_data.spike_array[:]
-        time = spike_data.array_time[:]
-
-        psth_time = None
-        PSTHs = None
+        time, spike_array = h5io.read_spike_array(spike_data)
 
-        for ti, trial in enumerate(spike_array):
-            for ui, unit in enumerate(trial):
-                tmp, tmp_time = make_single_trial_psth(unit, win_size, win_step, time)
-                if psth_time is None:
-                    psth_time = tmp_time
-                    PSTHs = np.zeros(
-                        (spike_array.shape[1], spike_array.shape[0], len(psth_time))
-                    )
+        # Unit x Trial x Time firing rates
+        PSTHs, psth_time = make_psth_array(spike_array, win_size, win_step, time)
+        PSTHs = PSTHs.transpose(1, 0, 2)
 
-                # Smooth firing rate trace
-                tmp = gaussian_filter1d(tmp, sigma=smoothing_width)
-
-                PSTHs[ui, ti, :] = tmp
+        # Smooth firing rate traces
+        PSTHs = gaussian_filter1d(PSTHs, sigma=smoothing_width, axis=-1)
 
         if "/PSTHs" not in hf5:
             hf5.create_group("/", "PSTHs")
@@ -113,8 +137,7 @@ def make_rate_arrays(h5_file, dig_in_ch, mode="BAKS"):
         dig_str = "dig_in_%i" % dig_in_ch
         with tables.open_file(h5_file, "r+") as hf5:
             spike_data = hf5.root.spike_trains[dig_str]
-            spike_array = spike_data.spike_array[:]
-            time = spike_data.array_time[:]
+            time, spike_array = h5io.read_spike_array(spike_data)
             results = None
 
             # make array "rates" with the same shape as spike_array
@@ -167,13 +190,8 @@ def get_binned_firing_rate(time, spikes, bin_size=250, bin_step=25):
     """
     bin_start = np.arange(time[0], time[-1] - bin_size + bin_step, bin_step)
     bin_time = bin_start + int(bin_size / 2)
-    n_trials = spikes.shape[0]
-    n_bins = len(bin_start)
-
-    firing_rate = np.zeros((n_trials, n_bins))
-    for i, start in enumerate(bin_start):
-        idx = np.where((time >= start) & (time <= start + bin_size))[0]
-        firing_rate[:, i] = np.sum(spikes[:, idx], axis=1) / (bin_size / 1000)
+    counts = get_window_counts(spikes, time, bin_start, bin_size)
+    firing_rate = counts / (bin_size / 1000)
 
     return bin_time, firing_rate
 
@@ -259,6 +277,30 @@ def remove_baseline(time, fr):
     return norm_fr
 
 
+def get_spike_pairs(X, Y, lo, hi):
+    """Finds every pair of spikes with X[i] - Y[j] in [lo, hi]
+
+    Parameters
+    ----------
+    X : np.array, 1-D array of spike times
+    Y : np.array, 1-D array of sorted spike times
+    lo, hi : float, lag window
+
+    Returns
+    -------
+    x_idx, y_idx : np.array, indices of the spikes in X and Y of each pair
+    """
+    start = np.searchsorted(Y, X - hi, side="left")
+    stop = np.searchsorted(Y, X - lo, side="right")
+    counts = stop - start
+    x_idx = np.repeat(np.arange(len(X)), counts)
+
+    # positions start..stop-1 of every spike in X, concatenated
+    offsets = np.repeat(np.cumsum(counts) - counts - start, counts)
+    y_idx = np.arange(np.sum(counts)) - offsets
+    return x_idx, y_idx
+
+
 def spike_time_xcorr(X, Y, binsize=1, max_t=20):
     """Compute cross-correlation histogram for 2 sets of spike times
 
@@ -277,10 +319,14 @@ def spike_time_xcorr(X, Y, binsize=1, max_t=20):
     bin_edges = np.arange(-max_t, max_t + 1, binsize)
     bin_centers = (bin_edges + binsize / 2)[:-1]
 
-    counts = np.zeros(bin_centers.shape)
-    for spike in X:
-        rel_t = spike - Y
-        counts += np.histogram(rel_t, bins=bin_edges)[0]
+    X = np.asarray(X)
+    Y = np.sort(Y)
+    # pad the window by a bin, np.histogram drops any pairs outside the edges
+    x_idx, y_idx = get_spike_pairs(
+        X, Y, bin_edges[0] - binsize, bin_edges[-1] + binsize
+    )
+    rel_t = X[x_idx] - Y[y_idx]
+    counts = np.histogram(rel_t, bins=bin_edges)[0]
 
     # convert to spikes/s and adjust for number of spikes
     counts = counts / (len(X) * binsize)
@@ -291,17 +337,106 @@ def spike_time_acorr(X, binsize=1, max_t=20):
     bin_edges = np.arange(-max_t, max_t + 1, binsize)
     bin_centers = (bin_edges + binsize / 2)[:-1]
 
-    counts = np.zeros(bin_centers.shape)
-    for i, spike in enumerate(X):
-        Y = np.append(X[:i], X[i + 1 : -1])  # Exclude current spike
-        rel_t = spike - Y
-        counts += np.histogram(rel_t, bins=bin_edges)[0]
+    X = np.sort(X)
+    x_idx, y_idx = get_spike_pairs(
+        X, X, bin_edges[0] - binsize, bin_edges[-1] + binsize
+    )
+    keep = x_idx != y_idx  # Exclude current spike
+    rel_t = X[x_idx[keep]] - X[y_idx[keep]]
+    counts = np.histogram(rel_t, bins=bin_edges)[0]
 
     # convert to spikes/s and adjust for number of spikes
     counts = counts / (len(X) * binsize)
     return counts, bin_centers, bin_edges
 
 
+def spike_time_ccgs(spike_times, binsize=1, max_t=20, chunk_size=2**16):
+    """Computes the cross-correlogram of every pair of units, and the
+    autocorrelogram of every unit, from one sorted sweep over all spikes
+
+    Parameters
+    ----------
+    spike_times : list of np.array, 1-D arrays of spike times in ms per unit
+    binsize: int (optional), size of bins to use in histogram in ms(defualt=1)
+    max_t: int (optional), max time bin for histogram in ms(default=20)
+    chunk_size : int (optional), spikes processed at a time, bounds memory use
+
+    Returns
+    -------
+    ccgs : np.array
+        units x units x lags array, ccgs[i, j] matches
+        spike_time_xcorr(spike_times[i], spike_times[j]) and ccgs[i, i]
+        matches spike_time_acorr(spike_times[i])
+    bin_centers : np.array
+    bin_edges : np.array
+    """
+    bin_edges = np.arange(-max_t, max_t + 1, binsize)
+    bin_centers = (bin_edges + binsize / 2)[:-1]
+    n_units = len(spike_times)
+    n_bins = len(bin_centers)
+    n_spikes = np.array([len(x) for x in spike_times])
+
+    times = np.concatenate([np.asarray(x, dtype=float) for x in spike_times])
+    labels = np.repeat(np.arange(n_units), n_spikes)
+    order = np.argsort(times, kind="stable")
+    times = times[order]
+    labels = labels[order]
+
+    counts = np.zeros(n_units * n_units * n_bins, dtype=np.int64)
+    for start in range(0, len(times), chunk_size):
+        X = times[start : start + chunk_size]
+        x_idx, y_idx = get_spike_pairs(
+            X, times, bin_edges[0] - binsize, bin_edges[-1] + binsize
+        )
+        x_idx += start
+        keep = x_idx != y_idx
+        x_idx = x_idx[keep]
+        y_idx = y_idx[keep]
+        rel_t = times[x_idx] - times[y_idx]
+
+        # same bins as np.histogram, the last bin includes its right edge
+        lag = np.searchsorted(bin_edges, rel_t, side="right") - 1
+        lag[rel_t == bin_edges[-1]] = n_bins - 1
+        keep = (lag >= 0) & (lag < n_bins)
+        idx = (labels[x_idx[keep]] * n_units + labels[y_idx[keep]]) * n_bins
+        counts += np.bincount(idx + lag[keep], minlength=len(counts))
+
+    # convert to spikes/s and adjust for number of spikes
+    ccgs = counts.reshape((n_units, n_units, n_bins)) / (
+        n_spikes[:, None, None] * binsize
+    )
+    return ccgs, bin_centers, bin_edges
+
+
+def get_recording_ccgs(h5_file, fs, binsize=1, max_t=20):
+    """Computes the units x units x lags correlogram tensor of all sorted
+    units in an HDF5 store, see spike_time_ccgs
+
+    Parameters
+    ----------
+    h5_file : str, full path to HDF5 store
+    fs : float, sampling rate of data in Hz
+    binsize: int (optional), size of bins to use in histogram in ms(defualt=1)
+    max_t: int (optional), max time bin for histogram in ms(default=20)
+
+    Returns
+    -------
+    unit_names : list of str
+    ccgs : np.array, units x units x lags
+    bin_centers : np.array
+    bin_edges : np.array
+    """
+    with tables.open_file(h5_file, "r") as hf5:
+        units = hf5.list_nodes("/sorted_units")
+        unit_names = [x._v_name for x in units]
+        spike_times = [x.times[:] / (fs / 1000.0) for x in units]
+
+    ccgs, bin_centers, bin_edges = spike_time_ccgs(
+        spike_times, binsize=binsize, max_t=max_t
+    )
+    return unit_names, ccgs, bin_centers, bin_edges
+
+
 def check_taste_response(time, spikes, win_size=1500):
     pre_idx = np.where((time >= -win_size) & (time < 0))[0]
     post_idx = np.where((time >= 0) & (time < win_size))[0]
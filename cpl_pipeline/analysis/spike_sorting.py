@@ -2,7 +2,7 @@ import os
 import tables
 import numpy as np
 from cpl_pipeline.spk_io import h5io
-from numba import jit, NumbaDeprecationWarning
+from numba import njit, prange, NumbaDeprecationWarning
 import itertools
 
 from numba.core.errors import NumbaDeprecationWarning, NumbaPendingDeprecationWarning
@@ -12,6 +12,65 @@ warnings.simplefilter('ignore', category=NumbaDeprecationWarning)
 warnings.simplefilter('ignore', category=NumbaPendingDeprecationWarning)
 
 
+def bin_trial_spikes(times, trial_idx, pre_idx, post_idx, fs, n_pts):
+    """
+    Finds the 1ms bin of every spike within the window around each trial
+
+    Parameters
+    ----------
+    times : np.array, sorted spike times of one unit, in samples
+    trial_idx : np.array, trial onset indices, in samples
+    pre_idx : int, samples before onset to include
+    post_idx : int, samples after onset to include
+    fs : float, sampling rate in Hz
+    n_pts : int, number of 1ms bins in the window
+
+    Returns
+    -------
+    trial_rows : np.array, trial of each spike
+    bins : np.array, bin of each spike within its trial
+    """
+    start = np.searchsorted(times, trial_idx - pre_idx, side="left")
+    stop = np.searchsorted(times, trial_idx + post_idx, side="right")
+    counts = stop - start
+    trial_rows = np.repeat(np.arange(len(trial_idx)), counts)
+
+    # positions start..stop-1 of every trial, concatenated
+    offsets = np.repeat(np.cumsum(counts) - counts - start, counts)
+    spike_idx = np.arange(np.sum(counts)) - offsets
+
+    # Shift to align to trial window and convert to ms
+    spike_shift = pre_idx - trial_idx
+    bins = ((times[spike_idx] + spike_shift[trial_rows]) / (fs / 1000)).astype(int)
+
+    # Drop spikes that come too late after adjustment
+    keep = bins < n_pts
+    return trial_rows[keep], bins[keep]
+
+
+def match_laser_trials(trial_idx, laser_off, max_diff):
+    """
+    Matches each trial to the first laser event, in table order, whose
+    off_index is within max_diff samples of the trial index
+
+    Returns
+    -------
+    np.array, index into laser_off for each trial, -1 where there is no match
+    """
+    if len(laser_off) == 0 or len(trial_idx) == 0:
+        return np.full(len(trial_idx), -1)
+
+    order = np.argsort(laser_off, kind="stable")
+    sorted_off = laser_off[order]
+    start = np.searchsorted(sorted_off, trial_idx - max_diff, side="left")
+    stop = np.searchsorted(sorted_off, trial_idx + max_diff, side="right")
+
+    # min over order[start:stop] for every trial, sentinel makes stop indexable
+    bounds = np.column_stack((start, stop)).ravel()
+    first = np.minimum.reduceat(np.append(order, len(order)), bounds)[::2]
+    return np.where(stop > start, first, -1)
+
+
 def make_spike_arrays(h5_file, params):
     """
     Makes stimulus triggered spike array for all sorted units
@@ -26,6 +85,9 @@ def make_spike_arrays(h5_file, params):
             sampling_rate : float, sampling rate of data in Hz
             pre_stimulus: : int, ms before stimulus to include in array
             post_stimulus : int, ms after stimulus to include in array
+            sparse : bool (optional), if True spike arrays are stored as
+                ragged spike_bins/spike_indptr arrays instead of a dense
+                spike_array, see h5io.write_sparse_spike_array
     """
     print("\n----------\nMaking Unit Spike Arrays\n----------\n")
     dig_in_ch = params["dig_ins_to_use"]
@@ -36,6 +98,7 @@ def make_spike_arrays(h5_file, params):
     pre_idx = int(pre_stim * (fs / 1000))
     post_idx = int(post_stim * (fs / 1000))
     n_pts = pre_stim + post_stim
+    sparse = params.get("sparse", False)
 
     if dig_in_ch is None or dig_in_ch == []:
         raise ValueError(
@@ -55,13 +118,18 @@ def make_spike_arrays(h5_file, params):
         n_lasers = 1
 
     with tables.open_file(h5_file, "r+") as hf5:
-        n_units = len(hf5.list_nodes("/sorted_units"))
+        # read every unit's spike times once
+        unit_times = {}
+        for unit in hf5.root.sorted_units:
+            unit_times[int(unit._v_name[-3:])] = np.sort(unit.times[:])
+
+        n_units = len(unit_times)
 
         # Get experiment end time from last spike time in case headstage fell
         # off
         exp_end_idx = 0
-        for unit in hf5.root.sorted_units:
-            tmp = np.max(unit.times)
+        for times in unit_times.values():
+            tmp = np.max(times)
             if tmp > exp_end_idx:
                 exp_end_idx = tmp
 
@@ -80,80 +148,75 @@ def make_spike_arrays(h5_file, params):
             tmp_trials = dig_in_table.query("channel == @i")
             trial_cutoff_idx = exp_end_idx - post_idx
 
-            # get the end indices for those trials
-            # off_idx = np.array(tmp_trials['off_index'])
-            # off_idx.sort()
-            # n_trials = len(off_idx)
-
             on_idx = np.array(tmp_trials["on_index"])
             on_idx.sort()
             n_trials = len(on_idx)
 
-            # loop through trials and get spike train array for each
-            spike_train = []
             cond_array = np.zeros(n_trials)
             laser_start = np.zeros(n_trials)
             laser_single = np.zeros((n_trials, n_lasers))
 
-            for ti, trial_off in enumerate(on_idx):
-                if trial_off >= trial_cutoff_idx:
-                    cond_array[ti] = -1
-                    continue
-
-                window = (trial_off - pre_idx, trial_off + post_idx)
-                spike_shift = pre_idx - trial_off
-                spike_array = np.zeros((n_units, n_pts))
-
-                # loop through units
-                for unit in hf5.root.sorted_units:
-                    unit_num = int(unit._v_name[-3:])
-                    spike_idx = np.where(
-                        (unit.times[:] >= window[0]) & (unit.times[:] <= window[1])
-                    )[0]
-                    spike_times = unit.times[spike_idx]
-
-                    # Shift to align to trial window and convert to ms
-                    spike_times = (spike_times + spike_shift) / (fs / 1000)
-                    spike_times = spike_times.astype(int)
-
-                    # Drop spikes that come too late after adjustment
-                    spike_times = [x for x in spike_times if x < n_pts]
-                    spike_array[unit_num, spike_times] = 1
-
-                spike_train.append(spike_array)
-
-                if lasers:
-                    # figure out which laser trial matches with this dig_in
-                    # trial and get the duration and onset lag
-                    for li, l in enumerate(laser_ch):
-                        tmp_trial = laser_table.query(
-                            "abs(off_index - " "@trial_off) <= " "@post_idx"
-                        )
-                        if not tmp_trial.empty:
-                            # Mark which laser was on
-                            laser_single[ti, li] = 1.0
-
-                            # Get duration of laser
-                            duration = (
-                                tmp_trial["off_index"] - tmp_trial["on_index"]
-                            ) / (fs / 1000)
-                            # round duration down to nearest multiple of 10ms
-                            cond_array[ti] = 10 * int(duration.iloc[0] / 10)
-
-                            # Get onset lag of laser, time between laser start
-                            # and end of the trial
-                            lag = (tmp_trial["on_index"] - trial_off) / (fs / 1000)
-                            # Round lag down to nearest multiple of 10ms
-                            laser_start[ti] = 10 * int(lag.iloc[0] / 10)
+            valid = on_idx < trial_cutoff_idx
+            cond_array[~valid] = -1
+            valid_on = on_idx[valid]
+
+            # trials x units x time, trials past the cutoff are left out
+            spike_shape = (len(valid_on), n_units, n_pts)
+            spike_rows = [(np.zeros(0, dtype=int),) * 3]
+            for unit_num, times in unit_times.items():
+                trial_rows, bins = bin_trial_spikes(
+                    times, valid_on, pre_idx, post_idx, fs, n_pts
+                )
+                spike_rows.append((trial_rows, np.full(len(bins), unit_num), bins))
+
+            trial_rows, unit_idx, bins = (np.concatenate(x) for x in zip(*spike_rows))
+
+            if lasers:
+                # figure out which laser trial matches with each dig_in trial
+                # and get the duration and onset lag
+                valid_trials = np.where(valid)[0]
+                for li, l in enumerate(laser_ch):
+                    tmp_lasers = laser_table.query("channel == @l")
+                    laser_on = np.array(tmp_lasers["on_index"])
+                    laser_off = np.array(tmp_lasers["off_index"])
+                    match = match_laser_trials(valid_on, laser_off, post_idx)
+                    hit = match >= 0
+                    ti = valid_trials[hit]
+                    match = match[hit]
+
+                    # Mark which laser was on
+                    laser_single[ti, li] = 1.0
+
+                    # Get duration of laser, round down to nearest multiple of 10ms
+                    duration = (laser_off[match] - laser_on[match]) / (fs / 1000)
+                    cond_array[ti] = 10 * (duration / 10).astype(int)
+
+                    # Get onset lag of laser, time between laser start and end
+                    # of the trial, rounded down to nearest multiple of 10ms
+                    lag = (laser_on[match] - valid_on[hit]) / (fs / 1000)
+                    laser_start[ti] = 10 * (lag / 10).astype(int)
 
             array_time = np.arange(-pre_stim, post_stim, 1)  # time array in ms
             hf5.create_group("/spike_trains", "dig_in_%i" % i)
             time = hf5.create_array(
                 "/spike_trains/dig_in_%i" % i, "array_time", array_time
             )
-            tmp = hf5.create_array(
-                "/spike_trains/dig_in_%i" % i, "spike_array", np.array(spike_train)
-            )
+            if sparse:
+                h5io.write_sparse_spike_array(
+                    hf5,
+                    "/spike_trains/dig_in_%i" % i,
+                    trial_rows,
+                    unit_idx,
+                    bins,
+                    spike_shape,
+                )
+            else:
+                spike_train = np.zeros(spike_shape)
+                spike_train[trial_rows, unit_idx, bins] = 1
+                tmp = hf5.create_array(
+                    "/spike_trains/dig_in_%i" % i, "spike_array", spike_train
+                )
+
             hf5.flush()
 
             if lasers:
@@ -169,7 +232,7 @@ def make_spike_arrays(h5_file, params):
                 hf5.flush()
     print("Done with spike array creation!\n----------\n")
 
-@jit(nogil=True)
+@njit(nogil=True)
 def count_similar_spikes(unit1_times, unit2_times):
     """
     Compiled function to compute the number of spikes in unit1 that are
@@ -178,20 +241,53 @@ def count_similar_spikes(unit1_times, unit2_times):
     Parameters
     ----------
     unit1_times : numpy.array, 1D array of unit times in ms
-    unit2_times : numpy.array, 1D array of unit times in ms
+    unit2_times : numpy.array, 1D array of sorted unit times in ms
 
     Returns
     -------
     int : number of spikes in unit1 within 1ms of a spike in unit2
     """
     unit_counter = 0
-    for t1 in unit1_times:
-        diff_arr = np.abs(unit2_times - t1)
-        if np.where(diff_arr <= 1.0)[0].size > 0:
-            unit_counter += 1
+    n2 = len(unit2_times)
+    idx = np.searchsorted(unit2_times, unit1_times - 1.0)
+    for i in range(len(unit1_times)):
+        # only the spikes on either side of t1 - 1ms can be the closest match
+        for j in range(max(idx[i] - 1, 0), min(idx[i] + 1, n2)):
+            if np.abs(unit2_times[j] - unit1_times[i]) <= 1.0:
+                unit_counter += 1
+                break
 
     return unit_counter
 
+
+@njit(parallel=True)
+def count_similar_spikes_all(times, offsets):
+    """
+    Counts similar spikes, see count_similar_spikes, between every pair of
+    units, in parallel over pairs
+
+    Parameters
+    ----------
+    times : numpy.array, sorted unit times in ms of all units, concatenated
+    offsets : numpy.array, n_units + 1 offsets of each unit's times in times
+
+    Returns
+    -------
+    numpy.array : n_units x n_units, number of spikes in unit i within 1ms of
+        a spike in unit j
+    """
+    n_units = len(offsets) - 1
+    out = np.zeros((n_units, n_units), dtype=np.int64)
+    for k in prange(n_units * n_units):
+        i = k // n_units
+        j = k % n_units
+        out[i, j] = count_similar_spikes(
+            times[offsets[i] : offsets[i + 1]], times[offsets[j] : offsets[j + 1]]
+        )
+
+    return out
+
+
 def calc_units_similarity(h5_file, fs, similarity_cutoff=50, violation_file=None):
     """
 
@@ -228,22 +324,24 @@ def calc_units_similarity(h5_file, fs, similarity_cutoff=50, violation_file=None
         units = hf5.list_nodes("/sorted_units")
         unit_distances = np.zeros((len(units), len(units)))
 
-        for pair in itertools.product(units, repeat=2):
-            u1 = pair[0]
-            u2 = pair[1]
-            u1_idx = h5io.parse_unit_number(u1._v_name)
-            u2_idx = h5io.parse_unit_number(u2._v_name)
-            print("Computing similarity between Unit %i and Unit %i" % (u1_idx, u2_idx))
-            n_spikes = len(u1.times[:])
-            u1_times = u1.times[:] / (fs / 1000.0)
-            u2_times = u2.times[:] / (fs / 1000.0)
-            n_similar = count_similar_spikes(u1_times, u2_times)
-            tmp_dist = 100.0 * float(n_similar / n_spikes)
-            unit_distances[u1_idx, u2_idx] = tmp_dist
-
-            if u1_idx != u2_idx and tmp_dist >= similarity_cutoff:
+        # read and sort every unit's times once
+        unit_names = [u._v_name for u in units]
+        unit_idx = np.array([h5io.parse_unit_number(x) for x in unit_names])
+        unit_times = [np.sort(u.times[:] / (fs / 1000.0)) for u in units]
+        n_spikes = np.array([len(x) for x in unit_times])
+        offsets = np.zeros(len(units) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(n_spikes)
+        times = np.concatenate([np.zeros(0)] + unit_times)
+
+        print("Computing similarity between %i units" % len(units))
+        n_similar = count_similar_spikes_all(times, offsets)
+        tmp_dist = 100.0 * (n_similar / n_spikes[:, None])
+        unit_distances[np.ix_(unit_idx, unit_idx)] = tmp_dist
+
+        for i, j in itertools.product(range(len(units)), repeat=2):
+            if i != j and tmp_dist[i, j] >= similarity_cutoff:
                 violations += 1
-                violation_pairs.append((u1._v_name, u2._v_name))
+                violation_pairs.append((unit_names[i], unit_names[j]))
 
         print("\nSimilarity calculation done!")
         if "/unit_distances" in hf5:
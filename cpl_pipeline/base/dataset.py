@@ -1,5 +1,4 @@
 import datetime as dt
-import itertools
 import os
 import pprint
 import shutil
@@ -23,7 +22,7 @@ from cpl_pipeline.analysis import spike_analysis
 # from cpl_pipeline.analysis.spike_analysis import make_rate_arrays
 from cpl_pipeline.analysis.spike_sorting import make_spike_arrays, calc_units_similarity
 from cpl_pipeline.base import objects
-from cpl_pipeline.extract import Spike2Data
+from cpl_pipeline.extract import Spike2Data, read_wave_channels_parallel
 from cpl_pipeline.plot.data_plot import (
     plot_traces_and_outliers,
     make_unit_plots,
@@ -31,7 +30,7 @@ from cpl_pipeline.plot.data_plot import (
     plot_spike_raster,
     plot_ensemble_raster,
 )
-from cpl_pipeline.spk_io import printer as pt, writer as wt, userio, h5io
+from cpl_pipeline.spk_io import printer as pt, writer as wt, userio, h5io, rawio
 from cpl_pipeline.spk_io.paramio import load_params, write_params_to_json
 from cpl_pipeline.spk_io.h5io import (
     get_h5_filename,
@@ -39,7 +38,9 @@ from cpl_pipeline.spk_io.h5io import (
     cleanup_clustering,
     write_digital_map_to_h5,
     write_array_to_hdf5,
-    create_trial_data_table, write_spike2_array_to_h5, write_time_vector_to_h5,
+    create_trial_data_table, write_time_vector_to_h5,
+    append_spike2_chunks_to_h5,
+    append_spike2_channel_chunks_to_h5,
 )
 from cpl_pipeline.utils.spike_sorting_GUI import launch_sorter_GUI, SpikeSorterGUI
 
@@ -512,7 +513,7 @@ class Dataset(objects.data_object):
         write_params_to_json("psth_params", rec_dir, psth_params)
         write_params_to_json("pal_id_params", rec_dir, pal_id_params)
 
-    def extract_data(self, filename=None,merge=False):
+    def extract_data(self, filename=None, merge=False, multi_process=False, n_cores=None, memmap=False):
         """
         Create a new H5 file with a pre-defined structure:
 
@@ -538,6 +539,16 @@ class Dataset(objects.data_object):
         merge: bool (optional)
             if True, merge all h5 files in the recording directory into one
             continuous recording.
+        multi_process : bool, False (default)
+            set to True to read electrodes concurrently in worker processes,
+            each with its own Spike2 file handle. Writes to the h5 file are
+            still made from this process only.
+        n_cores : int (optional)
+            number of worker processes to use. default is max-1.
+            has no effect if multi_process is False
+        memmap : bool, False (default)
+            set to True to also write each electrode to a memory-mapped binary
+            file, see :meth:`make_raw_memmap`
         """
 
         file = filename if filename else self.h5_file
@@ -563,13 +574,34 @@ class Dataset(objects.data_object):
             )
 
         print("Extracting data from Spike2 file")
-        self._process_spike2data()
+        self._process_spike2data(multi_process=multi_process, n_cores=n_cores)
+
+        # any existing memory-mapped copies are from a previous extraction
+        rawio.delete_raw_memmap(self.root_dir)
+        if memmap:
+            self.make_raw_memmap()
+
         self.process_status["extract_data"] = True
         self.save()
 
         print("\nData Extraction Complete\n--------------------")
 
-    def _process_spike2data(self):
+    def make_raw_memmap(self):
+        """
+        Write each raw electrode to a flat binary file with a JSON header in
+        root_dir/raw_memmap. Once written, spike detection, the dead channel
+        plots and the circus export read the electrodes with np.memmap instead
+        of copying them out of the h5 store.
+
+        .. seealso::
+            :mod:`cpl_pipeline.spk_io.rawio`
+        """
+        print("Writing memory-mapped raw electrodes...")
+        for electrode in self.electrode_mapping["electrode"].unique():
+            rawio.write_raw_memmap_from_h5(self.h5_file, electrode, rec_dir=self.root_dir)
+        print("Done!")
+
+    def _process_spike2data(self, multi_process=False, n_cores=None):
         """
         Extract all data from Spike2 file and save to h5 file.
 
@@ -578,33 +610,47 @@ class Dataset(objects.data_object):
         electrodes = self.electrode_mapping["electrode"].unique()
         events = self.events["electrode"].unique()
         self.dig_in_mapping = self.events.copy()
-        _time_flag = False
+        unit_fs = dict(zip(self.electrode_mapping["electrode"], self.electrode_mapping["sampling_rate"]))
 
-        for electrode_idx in electrodes:
-            ic(f"Extracting electrode {electrode_idx}/{electrodes[-1]}")
+        if multi_process:
+            if n_cores is None or n_cores > cpu_count():
+                n_cores = max(cpu_count() - 1, 1)
 
-            this_electrode = self.electrode_mapping[self.electrode_mapping["electrode"] == electrode_idx]
-            electrode = this_electrode["electrode"].iloc[0]
-            unit_fs = this_electrode["sampling_rate"].iloc[0]
-            data = [chunk for chunk in self._data.read_data_in_chunks(electrode_idx, "wave")]
-            data = list(itertools.chain(*data))
+            ic(f"Extracting {len(electrodes)} electrodes on {n_cores} cores")
+            chunks = read_wave_channels_parallel(self._data.filename, electrodes, n_workers=n_cores)
+            n_samples = append_spike2_channel_chunks_to_h5(self.h5_file, chunks, fs=unit_fs)
+        else:
+            n_samples = {}
+            for electrode_idx in electrodes:
+                ic(f"Extracting electrode {electrode_idx}/{electrodes[-1]}")
+
+                # stream each chunk straight into the EArray, never holding the whole channel in memory
+                chunks = self._data.read_data_in_chunks(electrode_idx, "wave")
+                n_samples[electrode_idx] = append_spike2_chunks_to_h5(
+                    self.h5_file, electrode_idx, chunks, fs=unit_fs[electrode_idx]
+                )
 
-            write_spike2_array_to_h5(self.h5_file, electrode, waves=data, fs=unit_fs)
-            write_electrode_map_to_h5(self.h5_file, self.electrode_mapping)
-            if _time_flag is False:
-                saved = write_time_vector_to_h5(self.h5_file, electrode, unit_fs)
+        write_electrode_map_to_h5(self.h5_file, self.electrode_mapping)
+        for electrode in electrodes:
+            if n_samples.get(electrode):
+                saved = write_time_vector_to_h5(self.h5_file, electrode, unit_fs[electrode])
                 if saved:
                     ic("Time vector saved to h5 file")
-                    _time_flag = True
+                    break
 
         self._events = {}
         for event_idx in events:
-            events = [chunk for chunk in self._data.read_data_in_chunks(event_idx, "event")][0]
-            if events.shape[0] > 0:  # empty event will be [[]], which evaluates to true, so check the insides
-                code = events[:, 0].astype(str)
-                time = events[:, 1].astype(float)
+            chunks = list(self._data.read_data_in_chunks(event_idx, "event"))
+            if not chunks:
+                continue
 
-                self._events[event_idx] = {"code": code, "time": time}
+            # structured array with typed tick, time and code fields, see spike2.decode_markers
+            channel_events = np.concatenate(chunks)
+            if channel_events.shape[0] > 0:
+                self._events[event_idx] = {
+                    "code": channel_events["code"],
+                    "time": channel_events["time"],
+                }
 
     def create_trial_list(self):
         """
@@ -772,7 +818,7 @@ class Dataset(objects.data_object):
         print("Spike Detection Complete\n------------------")
         return results
 
-    def cluster_spikes(self, data_quality=None, multi_process=False, n_cores=None, umap=True):
+    def cluster_spikes(self, data_quality=None, multi_process=False, n_cores=None, umap=True, render_plots=True):
         """
         Write clustering parameters to file and
         Run process on each electrode using GNU parallel
@@ -786,6 +832,9 @@ class Dataset(objects.data_object):
         multi_process : bool
         n_cores :
         umap :
+        render_plots : bool
+            render the diagnostic plots of every solution after clustering, if False
+            they are rendered when a solution is first opened for sorting
         """
         if not self.process_status["detect_spikes"]:
             raise FileNotFoundError("Must run spike detection before clustering.")
@@ -835,15 +884,24 @@ class Dataset(objects.data_object):
                 n_cores = cpu_count() - 1
 
             results = Parallel(n_jobs=n_cores, verbose=10)(
-                delayed(run_joblib_process)(co) for co in clust_objs
+                delayed(run_joblib_process)(co, plot=False) for co in clust_objs
             )
+            # Render diagnostic plots once every electrode's numeric results are saved
+            if render_plots:
+                Parallel(n_jobs=n_cores, verbose=10)(
+                    delayed(co.render_plots)(verbose=False) for co in clust_objs
+                )
 
         else:
             results = []
             for x in clust_objs:
-                res = x.run()
+                res = x.run(plot=False)
                 results.append(res)
 
+            if render_plots:
+                for x in clust_objs:
+                    x.render_plots(verbose=False)
+
         self.process_status["spike_clustering"] = True
         self.process_status["cleanup_clustering"] = False
         write_electrode_map_to_h5(self.h5_file, em)
@@ -1212,7 +1270,7 @@ class Dataset(objects.data_object):
 
         for i in range(loops):
             if i < len(taste_dig_in):
-                spike_arrs[i] = taste_dig_in[i].spike_array[:]
+                spike_arrs[i] = h5io.read_spike_array(taste_dig_in[i])[1]
 
         nameparts = str.split(self.tbla_name, "_")
         tbl["ID"] = nameparts[0]
@@ -1252,7 +1310,7 @@ class Dataset(objects.data_object):
 
         for i in range(loops):
             if i < len(taste_dig_in):
-                spike_arrs[i] = taste_dig_in[i].spike_array[:]
+                spike_arrs[i] = h5io.read_spike_array(taste_dig_in[i])[1]
 
         h5.flush()
         h5.close()
@@ -1302,8 +1360,8 @@ class Dataset(objects.data_object):
         return [k for k, v in self.process_status.items() if v in [False, "False", "false"]]
 
 
-def run_joblib_process(process):
-    res = process.run()
+def run_joblib_process(process, **kwargs):
+    res = process.run(**kwargs)
     return res
 
 def port_in_dataset(rec_dir=None, shell=False):
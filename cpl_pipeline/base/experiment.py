@@ -372,6 +372,8 @@ class experiment(data_object):
         n_cores=None,
         custom_params=None,
         umap=False,
+        out_of_core=False,
+        render_plots=True,
     ):
         """
         Write clustering parameters to file and
@@ -386,6 +388,12 @@ class experiment(data_object):
         accept_params : bool, False (default)
             set to True in order to skip popup confirmation of parameters when
             running
+        out_of_core : bool, False (default)
+            compute clustering features in batches from memory-mapped waveforms,
+            for experiments with more spikes than fit in memory (ignored with umap)
+        render_plots : bool, True (default)
+            render the diagnostic plots of every solution after clustering, if False
+            they are rendered when a solution is first opened for sorting
         """
         clustering_params = None
         if custom_params:
@@ -438,7 +446,7 @@ class experiment(data_object):
         # Run clustering
         if not umap:
             clust_objs = [
-                CplClust(rec_dirs, x, params=clustering_params)
+                CplClust(rec_dirs, x, params=clustering_params, out_of_core=out_of_core)
                 for x in electrodes
             ]
         else:
@@ -459,15 +467,28 @@ class experiment(data_object):
 
             pool = multiprocessing.get_context("spawn").Pool(n_cores)
             for x in clust_objs:
-                pool.apply_async(x.run, callback=update_pbar)
+                pool.apply_async(x.run, kwds={"plot": False}, callback=update_pbar)
 
             pool.close()
             pool.join()
+
+            # Render diagnostic plots once every electrode's numeric results are saved
+            if render_plots:
+                pool = multiprocessing.get_context("spawn").Pool(n_cores)
+                for x in clust_objs:
+                    pool.apply_async(x.render_plots, kwds={"verbose": False})
+
+                pool.close()
+                pool.join()
         else:
             for x in clust_objs:
-                res = x.run()
+                res = x.run(plot=False)
                 update_pbar(res)
 
+            if render_plots:
+                for x in clust_objs:
+                    x.render_plots(verbose=False)
+
         pbar.close()
 
         for rd in rec_dirs:
@@ -9,6 +9,6 @@ This uses sonpy for spike2 rather than Neo. Neo is a great package, but it makes
 spike2 files.
 
 """
-from .spike2 import Spike2Data
+from .spike2 import Spike2Data, read_wave_channels_parallel
 
-__all__ = ["Spike2Data"]
+__all__ = ["Spike2Data", "read_wave_channels_parallel"]
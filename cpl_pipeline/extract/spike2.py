@@ -1,8 +1,9 @@
 from __future__ import annotations
 
+import multiprocessing
 import string
-from itertools import compress
 from pathlib import Path
+from queue import Empty
 
 import numpy as np
 import pandas as pd
@@ -32,6 +33,17 @@ EVENTS = [
 
 SIGNALS = [sp.DataType.Adc]
 
+# raw marker fields as read from the file, and the decoded events returned to the user
+MARKER_DTYPE = np.dtype(
+    [("Tick", np.int64), ("Code1", np.uint8), ("Code2", np.uint8), ("Code3", np.uint8), ("Code4", np.uint8)]
+)
+EVENT_DTYPE = np.dtype([("tick", np.int64), ("time", np.float64), ("code", "U4")])
+
+# lookup table of which byte values are allowed in a marker code, null bytes are padding
+_PRINTABLE_CODES = np.zeros(256, dtype=bool)
+_PRINTABLE_CODES[[ord(char) for char in string.printable]] = True
+_PRINTABLE_CODES[0] = True
+
 
 class SonfileException(BaseException):
     """
@@ -68,6 +80,158 @@ def ticks_to_time(ticks, time_base):
     return np.array(ticks) * time_base
 
 
+def decode_markers(marks, time_base):
+    """
+    Decode sonpy markers into a typed event array.
+
+    Spike2 stores each marker code as 4 ascii-encoded bytes. Null bytes are dropped,
+    and markers containing any non-printable byte are excluded.
+
+    Parameters
+    ----------
+    marks : list of sonpy markers
+        The output of ``SonFile.ReadMarkers``.
+    time_base : float
+        The number of seconds per clock tick.
+
+    Returns
+    -------
+    np.ndarray
+        Structured array of dtype :data:`EVENT_DTYPE` with fields ``tick`` (int64),
+        ``time`` (float64, seconds rounded to ms) and ``code`` (fixed-width string).
+    """
+    raw = np.array(
+        [(mark.Tick, mark.Code1, mark.Code2, mark.Code3, mark.Code4) for mark in marks],
+        dtype=MARKER_DTYPE,
+    )
+    codes = np.column_stack([raw["Code1"], raw["Code2"], raw["Code3"], raw["Code4"]])
+    is_printable_mask = _PRINTABLE_CODES[codes].all(axis=1)
+    codes = codes[is_printable_mask]
+
+    # move null bytes to the end of each code, keeping the order of the others
+    order = np.argsort(codes == 0, axis=1, kind="stable")
+    codes = np.ascontiguousarray(np.take_along_axis(codes, order, axis=1))
+
+    events = np.empty(codes.shape[0], dtype=EVENT_DTYPE)
+    events["tick"] = raw["Tick"][is_printable_mask]
+    events["time"] = np.round(ticks_to_time(events["tick"], time_base), 3)
+    events["code"] = codes.view("S4").ravel().astype("U4")
+    return events
+
+
+# seconds to wait for a chunk before checking that the workers are still alive
+QUEUE_POLL_TIMEOUT = 1.0
+
+
+def _stream_wave_channel(queue, filepath, channel_index, chunk_size=None):
+    """
+    Reads one wave channel with its own SonFile handle and puts each chunk on the
+    shared queue. If reading fails the exception is sent in place of a chunk. A
+    ``None`` chunk marks the end of the channel and is always sent last.
+    """
+    try:
+        data = Spike2Data(filepath)
+        for chunk in data.read_data_in_chunks(channel_index, "wave", chunk_size=chunk_size):
+            queue.put((channel_index, np.asarray(chunk)))
+    except Exception as e:
+        queue.put((channel_index, e))
+    finally:
+        queue.put((channel_index, None))
+
+
+def _channel_worker(tasks, queue, filepath, chunk_size=None):
+    """Worker process: streams channels taken from the task queue until it gets ``None``"""
+    for channel_index in iter(tasks.get, None):
+        _stream_wave_channel(queue, filepath, channel_index, chunk_size)
+
+
+def _check_channel_workers(workers):
+    """
+    Raises if one of the worker processes died without sending its end-of-channel
+    marker, e.g. killed by the OS or a crash inside sonpy, instead of waiting on
+    the queue forever.
+    """
+    for proc in workers:
+        if proc.exitcode is not None and proc.exitcode != 0:
+            raise RuntimeError(
+                f"Spike2 channel reader process {proc.pid} exited with code {proc.exitcode}"
+            )
+
+
+def read_wave_channels_parallel(filepath, channel_indices, n_workers=None, chunk_size=None, max_queued_chunks=64):
+    """
+    Read several wave channels concurrently, one worker process per channel at a time.
+
+    Each worker opens its own ``sp.SonFile`` handle, so channels are decoded in parallel,
+    while the caller consumes the chunks from a single process. Chunks of one channel are
+    yielded in order; chunks of different channels are interleaved. The workers are
+    terminated if a channel fails to read or the caller stops iterating early.
+
+    Parameters
+    ----------
+    filepath : Path | str
+        The full path to the Spike2 file.
+    channel_indices : list of int
+        The spike2 channels to read.
+    n_workers : int, optional
+        Number of worker processes. Default is one per channel, up to the number of cores.
+    chunk_size : int, optional
+        Number of samples per chunk, see :meth:`Spike2Data.read_data_in_chunks`.
+    max_queued_chunks : int, optional
+        Upper bound on chunks waiting to be consumed, this bounds peak memory.
+
+    Yields
+    ------
+    tuple of (int, np.ndarray)
+        The channel index and the next chunk of samples for that channel.
+    """
+    channel_indices = list(channel_indices)
+    if not channel_indices:
+        return
+    if n_workers is None:
+        n_workers = min(len(channel_indices), multiprocessing.cpu_count())
+    n_workers = min(n_workers, len(channel_indices))
+
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue(maxsize=max_queued_chunks)
+    tasks = ctx.Queue()
+    for idx in channel_indices:
+        tasks.put(idx)
+    for _ in range(n_workers):
+        tasks.put(None)
+
+    workers = [
+        ctx.Process(
+            target=_channel_worker,
+            args=(tasks, queue, str(filepath), chunk_size),
+            daemon=True,
+        )
+        for _ in range(n_workers)
+    ]
+    for proc in workers:
+        proc.start()
+
+    try:
+        remaining = len(channel_indices)
+        while remaining > 0:
+            try:
+                channel_index, chunk = queue.get(timeout=QUEUE_POLL_TIMEOUT)
+            except Empty:
+                _check_channel_workers(workers)
+                continue
+            if chunk is None:
+                remaining -= 1
+                continue
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield channel_index, chunk
+    finally:
+        for proc in workers:
+            if proc.is_alive():
+                proc.terminate()
+            proc.join()
+
+
 class Spike2Data:
     """
     Spike2 CED Software data extractor. This class is used to extract data from a Spike2 file.
@@ -252,10 +416,15 @@ class Spike2Data:
         event_type : str
             The data-type of event to read, either "wave" or "event".
 
+        chunk_size : int, optional
+            The number of items to read per chunk. Default is 32 * 1024.
+
         Returns
         -------
         generator
-            A generator that yields chunks of data from the channel.
+            A generator that yields chunks of data from the channel. Wave chunks are
+            arrays of samples, event chunks are structured arrays of dtype
+            :data:`EVENT_DTYPE` (see :func:`decode_markers`).
         """
         chunk_size = chunk_size if chunk_size else 32 * 1024
         item_byte_size = self.sonfile.ItemSize(channel_index)
@@ -268,31 +437,8 @@ class Spike2Data:
             end_idx = min(start_idx + chunk_size, total_items)
             num_items = end_idx - start_idx
             if event_type == "event":
-
                 marks = self.sonfile.ReadMarkers(channel_index, num_items, start_idx)
-
-                # spike2 sends a 4-byte ascii-encoded int for each character in the string
-                # convert those ints to a string
-                char_codes = [
-                    codes_to_string([mark.Code1, mark.Code2, mark.Code3, mark.Code4])
-                    for mark in marks
-                ]
-
-                # create a boolean mask for filtering both char_codes and ticks
-                is_printable_mask = [
-                    all(char in string.printable for char in code) for code in char_codes
-                ]
-
-                # exclude null terminated strings, spaces, etc
-                filtered_codes = list(compress(char_codes, is_printable_mask))
-                ticks = [mark.Tick for mark in marks]
-                filtered_ticks = np.array(list(compress(ticks, is_printable_mask)))
-
-                # convert the filtered clock ticks to seconds
-                event_time = np.round(ticks_to_time(filtered_ticks, self._time_base()), 3)
-                events = np.vstack((filtered_codes, event_time)).T
-
-                yield events
+                yield decode_markers(marks, self._time_base())
 
             elif event_type == "wave":
                 chunk_data = self.sonfile.ReadFloats(channel_index, num_items, start_idx)
@@ -317,31 +463,8 @@ class Spike2Data:
             end_idx = min(start_idx + chunk_size, total_items)
             num_items = end_idx - start_idx
             if event_type == "event":
-
                 marks = self.sonfile.ReadMarkers(channel_index, num_items, start_idx)
-
-                # spike2 sends a 4-byte ascii-encoded int for each character in the string
-                # convert those ints to a string
-                char_codes = [
-                    codes_to_string([mark.Code1, mark.Code2, mark.Code3, mark.Code4])
-                    for mark in marks
-                ]
-
-                # create a boolean mask for filtering both char_codes and ticks
-                is_printable_mask = [
-                    all(char in string.printable for char in code) for code in char_codes
-                ]
-
-                # filter char_codes and ticks based on the boolean mask
-                filtered_codes = list(compress(char_codes, is_printable_mask))
-                ticks = [mark.Tick for mark in marks]
-                filtered_ticks = np.array(list(compress(ticks, is_printable_mask)))
-
-                # convert the filtered clock ticks to seconds
-                event_time = np.round(ticks_to_time(filtered_ticks, self._time_base()), 3)
-                events = np.vstack((filtered_codes, event_time)).T
-
-                yield events
+                yield decode_markers(marks, self._time_base())
 
             elif event_type == "wave":
                 chunk_data = self.sonfile.ReadFloats(channel_index, num_items, start_idx)
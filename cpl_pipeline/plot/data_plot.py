@@ -6,6 +6,7 @@ import pandas as pd
 import numpy as np
 import tables
 import os
+import re
 import umap
 import pywt
 import itertools as it
@@ -96,6 +97,18 @@ def plot_traces_and_outliers(h5_file: str, window=2, save_file=None):
     elif not os.path.isfile(h5_file):
         raise FileNotFoundError("%s not found." % h5_file)
 
+    rec_dir = os.path.dirname(h5_file)
+
+    def read_trace(node):
+        # prefer the memory-mapped copy of the electrode if one was written
+        match = re.fullmatch(r"electrode(\d+)", node._v_name)
+        trace = (
+            spk_io.rawio.load_raw_memmap(rec_dir, int(match[1]), node=node)
+            if match
+            else None
+        )
+        return node[:] if trace is None else trace
+
     with tables.open_file(h5_file, "r") as hf5:
         try:
             electrodes = hf5.list_nodes("/raw")
@@ -120,7 +133,7 @@ def plot_traces_and_outliers(h5_file: str, window=2, save_file=None):
 
         # make each electrode on the same scale
         for i, node in enumerate(electrodes):
-            trace = node[:]  # * 0.195  # some sort of voltage scalinghere
+            trace = read_trace(node)  # * 0.195  # some sort of voltage scalinghere
             max_amp[i] = np.max(np.abs(trace))
             max_amp_idx[i] = int(np.argmax(np.abs(trace)))
             std_amp[i] = np.std(trace)
@@ -137,8 +150,8 @@ def plot_traces_and_outliers(h5_file: str, window=2, save_file=None):
 
         fig, ax = plt.subplots(nrows=2, figsize=(30, 30))
         for i, node in enumerate(electrodes):
-            trace = node[:] / max_v
-            ax[0].plot(time_vector[idx], trace[idx] + i, linewidth=0.5)
+            trace = read_trace(node)[idx] / max_v
+            ax[0].plot(time_vector[idx], trace + i, linewidth=0.5)
             ax[1].plot([i, i], [0, metric[i]], color="black", linewidth=0.5)
 
         ax[1].scatter(np.arange(n_electrodes), metric)
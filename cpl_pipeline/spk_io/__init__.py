@@ -2,6 +2,7 @@ from .printer import *
 from .h5io import *
 from .paramio import *
 from .userio import *
+from .rawio import *
 
 __all__ = [
     "print_dict",
@@ -27,4 +28,6 @@ __all__ = [
     "select_from_list",
     "center",
     "check_h5_data",
+    "write_raw_memmap",
+    "load_raw_memmap",
 ]
@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 import pprint
+from contextlib import contextmanager
 from pathlib import Path
 
 import tables
@@ -14,7 +15,7 @@ import numpy as np
 from icecream import ic
 
 from cpl_pipeline.analysis import cluster as clust
-from cpl_pipeline.spk_io import userio, println, paramio
+from cpl_pipeline.spk_io import userio, println, paramio, rawio
 from cpl_pipeline.utils import particles
 
 SUPP_REC_TYPES = {
@@ -214,10 +215,129 @@ def get_next_unit_name(rec_dir, h5_file=None):
     return out
 
 
+def write_sparse_spike_array(hf5, where, trial_rows, unit_idx, bins, shape):
+    """
+    Writes a trials x units x time binary spike array in a compact CSR-style
+    format. Spikes are sorted by trial, then unit, then bin and stored as
+    ragged arrays:
+
+        spike_bins : int16 (int32 for windows >= 32768 ms), bin of every spike
+        spike_indptr : int64, n_trials * n_units + 1 offsets into spike_bins,
+            spikes of trial t and unit u are
+            spike_bins[spike_indptr[t * n_units + u]:spike_indptr[t * n_units + u + 1]]
+
+    The dense shape is stored in the spike_array_shape attribute of where.
+    Multiple spikes in the same bin are stored once, matching the dense array.
+
+    Parameters
+    ----------
+    hf5 : tables.File, open in write mode
+    where : str, group to write the arrays to, must exist
+    trial_rows : np.array, trial of each spike
+    unit_idx : np.array, unit of each spike
+    bins : np.array, bin of each spike within its trial
+    shape : tuple, (n_trials, n_units, n_pts)
+    """
+    n_trials, n_units, n_pts = shape
+    n_rows = n_trials * n_units
+    rows = np.asarray(trial_rows, dtype=np.int64) * n_units + unit_idx
+    keys = np.unique(rows * n_pts + bins)
+    rows = keys // n_pts
+    bin_dtype = np.int16 if n_pts <= np.iinfo(np.int16).max else np.int32
+    spike_bins = (keys % n_pts).astype(bin_dtype)
+    indptr = np.searchsorted(rows, np.arange(n_rows + 1)).astype(np.int64)
+
+    hf5.create_array(where, "spike_bins", spike_bins)
+    hf5.create_array(where, "spike_indptr", indptr)
+    hf5.get_node(where)._v_attrs["spike_array_shape"] = tuple(int(x) for x in shape)
+
+
+def read_spike_array(node, units=None, trials=None, bin_size=1):
+    """
+    Reads a trials x units x time spike array from a /spike_trains/dig_in_#
+    group stored either densely (spike_array) or with write_sparse_spike_array
+
+    Parameters
+    ----------
+    node : tables.Group, /spike_trains/dig_in_# group
+    units : int or list-like (optional)
+        unit numbers to return, all if None. If int then the unit axis is
+        dropped, like spike_array[:, unit, :]
+    trials : int or list-like (optional)
+        if None (default), returns all trials, if int N returns first N-trials,
+        if list-like then returns those indices
+    bin_size : int, number of 1ms bins to sum into each returned bin, a
+        trailing partial bin is dropped
+
+    Returns
+    -------
+    time : numpy.array, time of the start of each bin in ms
+    spike_array : numpy.array, spike counts per bin
+    """
+    bin_size = int(bin_size)
+    if bin_size < 1:
+        raise ValueError("bin_size must be a positive number of ms")
+
+    time = node.array_time[:]
+    n_bins = len(time) // bin_size
+    time = time[: n_bins * bin_size : bin_size]
+
+    if "spike_bins" not in node:
+        if units is None:
+            spike_array = node.spike_array[:]
+        else:
+            spike_array = node.spike_array[:, units, :]
+
+        spike_array = spike_array[_get_trial_index(trials, spike_array.shape[0])]
+
+        if bin_size > 1:
+            spike_array = spike_array[..., : n_bins * bin_size]
+            spike_array = spike_array.reshape(
+                spike_array.shape[:-1] + (n_bins, bin_size)
+            ).sum(axis=-1)
+
+        return time, spike_array
+
+    n_trials, n_units, n_pts = node._v_attrs["spike_array_shape"]
+    trial_idx = np.arange(n_trials)[_get_trial_index(trials, n_trials)]
+    unit_idx = np.arange(n_units) if units is None else np.asarray(units)
+    rows = (trial_idx[:, None] * n_units + np.atleast_1d(unit_idx)[None, :]).ravel()
+
+    # gather the spikes of every requested trial/unit row from the ragged arrays
+    indptr = node.spike_indptr[:]
+    start = indptr[rows]
+    counts = indptr[rows + 1] - start
+    out_rows = np.repeat(np.arange(len(rows)), counts)
+    spike_idx = np.arange(np.sum(counts)) - np.repeat(
+        np.cumsum(counts) - counts - start, counts
+    )
+    bins = node.spike_bins[:][spike_idx].astype(np.int64) // bin_size
+    keep = bins < n_bins
+
+    spike_array = np.zeros((len(rows), n_bins))
+    np.add.at(spike_array, (out_rows[keep], bins[keep]), 1)
+    spike_array = spike_array.reshape((len(trial_idx), -1, n_bins))
+    if np.ndim(unit_idx) == 0:
+        spike_array = spike_array[:, 0, :]
+
+    return time, spike_array
+
+
+def _get_trial_index(trials, n_trials):
+    if trials is None:
+        return slice(None)
+
+    if isinstance(trials, (int, np.integer)):
+        return slice(None, trials)
+
+    return np.asarray(trials)
+
+
 def get_spike_data(rec_dir, units=None, din=None, trials=None, h5_file=None):
     """
     Opens hf5 file in rec_dir and returns a Trial x Time spike array and a
-    1D time vector
+    1D time vector. Spike arrays can be stored dense or sparse, see
+    read_spike_array
 
     Parameters
     ----------
@@ -272,21 +392,9 @@ def get_spike_data(rec_dir, units=None, din=None, trials=None, h5_file=None):
             elif not np.array_equal(time, tmp_time):
                 raise ValueError("Misaligned time vectors encountered")
 
-            spike_array = st["spike_array"][:, unit_nums, :]
+            _, spike_array = read_spike_array(st, unit_nums, trials)
             out[dig_str] = spike_array
 
-    if (
-            isinstance(trials, int)
-            or isinstance(trials, np.int32)
-            or isinstance(trials, np.int64)
-    ):
-        for k in out.keys():
-            out[k] = out[k][:trials]
-
-    elif trials is not None:
-        for k in out.keys():
-            out[k] = out[k][trials]
-
     if len(out) == 1:
         out = out.popitem()[1]
 
@@ -307,21 +415,59 @@ def get_raw_digital_signal(rec_dir, dig_type, channel, h5_file=None):
     return None
 
 
-def get_raw_trace(h5_file=None, rec_dir=None, chan_idx=None, ):
+def get_raw_trace(h5_file=None, rec_dir=None, chan_idx=None, use_memmap=True):
     """
     Returns raw voltage trace for electrode from hdf5 store.
+
+    If a memory-mapped copy of the electrode exists (see :mod:`cpl_pipeline.spk_io.rawio`)
+    and use_memmap is True, a read-only ``np.memmap`` is returned instead of copying the
+    array out of the hdf5 store. Copies whose length or dtype no longer match the
+    /raw node are ignored.
     """
     if h5_file is None:
         h5_file = get_h5_filename(rec_dir, shell=True)
 
+    memmap_dir = rec_dir if rec_dir is not None else os.path.dirname(h5_file)
     with tables.open_file(h5_file, "r") as hf5:
         if "/raw" in hf5 and f"/raw/electrode{chan_idx}" in hf5:
-            out = hf5.root.raw[f"electrode{chan_idx}"][:]
+            node = hf5.root.raw[f"electrode{chan_idx}"]
+            if use_memmap:
+                trace = rawio.load_raw_memmap(memmap_dir, chan_idx, node=node)
+                if trace is not None:
+                    return trace
+
+            out = node[:]
             return out
         else:
             return None
 
 
+@contextmanager
+def open_raw_trace(h5_file=None, rec_dir=None, chan_idx=None, use_memmap=True):
+    """
+    Opens the raw voltage trace of an electrode without reading it into memory.
+
+    Yields the read-only ``np.memmap`` copy of the electrode if it exists and still
+    matches the /raw node, otherwise the /raw/electrodeN EArray of the open hdf5 store,
+    valid until the context exits. Both can be sliced block by block. Yields None if the
+    electrode is not in the store.
+    """
+    if h5_file is None:
+        h5_file = get_h5_filename(rec_dir, shell=True)
+
+    memmap_dir = rec_dir if rec_dir is not None else os.path.dirname(h5_file)
+    with tables.open_file(h5_file, "r") as hf5:
+        if "/raw" in hf5 and f"/raw/electrode{chan_idx}" in hf5:
+            node = hf5.root.raw[f"electrode{chan_idx}"]
+            trace = None
+            if use_memmap:
+                trace = rawio.load_raw_memmap(memmap_dir, chan_idx, node=node)
+
+            yield node if trace is None else trace
+        else:
+            yield None
+
+
 def _check_electrode_data_exists(h5_file=None, rec_dir=None, chan_idx=None, ):
     if h5_file is None:
         h5_file = get_h5_filename(rec_dir, shell=True)
@@ -430,7 +576,7 @@ def get_raw_unit_waveforms(
 
     print("Getting raw waveforms for %s %s" % (os.path.basename(rec_dir), unit_name))
     electrode = descriptor["electrode_number"]
-    raw_el = get_raw_trace(rec_dir, electrode, electrode_mapping)
+    raw_el = get_raw_trace(h5_file=h5_file, rec_dir=rec_dir, chan_idx=electrode)
     if electrode_mapping is None and raw_el is None:
         raise FileNotFoundError(
             "Raw data not found in h5 file and" " electrode_mapping not found"
@@ -445,19 +591,120 @@ def get_raw_unit_waveforms(
     return slices_dj, descriptor, new_fs
 
 
-def write_time_vector_to_h5(h5_file, electrode, fs):
-    """Writes time vector the same size as the electrode array"""
+def write_time_vector_to_h5(h5_file, electrode, fs, chunk_size=32 * 1024):
+    """Writes time vector the same size as the electrode array
+
+    The vector is appended in blocks of ``chunk_size`` samples so the electrode
+    never has to be read back into memory.
+    """
     with tables.open_file(h5_file, "r+") as hf5:
 
         if "/raw/electrode%i" % electrode in hf5:
-            arr = hf5.root.raw["electrode%i" % electrode][:]
-            time = np.arange(0, arr.shape[0])
-            hf5.root.time.time_vector.append(time)
+            n_samples = hf5.root.raw["electrode%i" % electrode].nrows
+            time_vector = hf5.root.time.time_vector
+            for start in range(0, n_samples, chunk_size):
+                stop = min(start + chunk_size, n_samples)
+                time_vector.append(np.arange(start, stop, dtype=np.float64))
             return True
         else:
             return False
 
 
+def append_spike2_chunks_to_h5(h5_file, electrode, chunks, fs=None, dtype=np.float64):
+    """
+    Streams chunks of a Spike2 wave channel into /raw/electrodeN.
+
+    Each chunk is appended to the EArray as soon as it is read, so peak memory
+    is bounded by the chunk size rather than by the length of the recording.
+
+    Parameters
+    ----------
+    h5_file : str, path to hdf5 store
+    electrode : int, electrode number
+    chunks : iterable of array-like
+        chunks of samples, i.e. ``Spike2Data.read_data_in_chunks(idx, "wave")``
+    fs : float (optional), sampling rate stored as a node attribute
+    dtype : numpy dtype (optional), dtype of the buffer handed to the EArray
+
+    Returns
+    -------
+    int, number of samples written, or None if the electrode array is missing
+    """
+    if not Path(h5_file).exists():
+        h5_file = get_h5_filename(h5_file)
+
+    println("Streaming electrode%i to %s..." % (electrode, h5_file))
+    with tables.open_file(h5_file, "r+") as hf5:
+        if "/raw" not in hf5 or "/raw/electrode%i" % electrode not in hf5:
+            print("No array for electrode%i found. Skipping..." % electrode)
+            return None
+
+        node = hf5.root.raw["electrode%i" % electrode]
+        if fs is not None:
+            node._v_attrs["sampling_rate"] = fs
+
+        n_samples = 0
+        for chunk in chunks:
+            buffer = np.asarray(chunk, dtype=dtype)
+            if buffer.size == 0:
+                continue
+            node.append(buffer)
+            n_samples += buffer.size
+
+        hf5.flush()
+
+    print("Done!")
+    return n_samples
+
+
+def append_spike2_channel_chunks_to_h5(h5_file, channel_chunks, fs=None, dtype=np.float64):
+    """
+    Single writer for chunks of several electrodes arriving in any order.
+
+    Keeps the hdf5 store open and appends each ``(electrode, chunk)`` pair to
+    /raw/electrodeN, i.e. the output of
+    :func:`cpl_pipeline.extract.spike2.read_wave_channels_parallel`.
+
+    Parameters
+    ----------
+    h5_file : str, path to hdf5 store
+    channel_chunks : iterable of (int, array-like)
+    fs : float or dict (optional)
+        sampling rate stored as a node attribute, or a dict of electrode -> sampling rate
+    dtype : numpy dtype (optional), dtype of the buffer handed to the EArray
+
+    Returns
+    -------
+    dict, electrode -> number of samples written
+    """
+    if not Path(h5_file).exists():
+        h5_file = get_h5_filename(h5_file)
+
+    println("Streaming electrodes to %s..." % h5_file)
+    n_samples = {}
+    with tables.open_file(h5_file, "r+") as hf5:
+        for electrode, chunk in channel_chunks:
+            node_name = "/raw/electrode%i" % electrode
+            if node_name not in hf5:
+                continue
+
+            node = hf5.get_node(node_name)
+            if electrode not in n_samples:
+                n_samples[electrode] = 0
+                el_fs = fs.get(electrode) if isinstance(fs, dict) else fs
+                if el_fs is not None:
+                    node._v_attrs["sampling_rate"] = el_fs
+
+            buffer = np.asarray(chunk, dtype=dtype)
+            node.append(buffer)
+            n_samples[electrode] += buffer.size
+
+        hf5.flush()
+
+    print("Done!")
+    return n_samples
+
+
 def write_spike2_array_to_h5(h5_file, electrode, waves, fs=None):
     if not Path(h5_file).exists():
         h5_file = get_h5_filename(h5_file)
@@ -1164,6 +1411,7 @@ def common_avg_reference(h5_file, electrodes, group_num):
         for x in electrodes:
             referenced_data = raw["electrode%i" % x][:min_samples] - common_avg
             hf5.remove_node("/raw/electrode%i" % x)
+            rawio.delete_raw_memmap(os.path.dirname(h5_file), x)
 
             if "/referenced" not in hf5:
                 hf5.create_group("/", "referenced", "Common average referenced signals")
@@ -0,0 +1,175 @@
+"""
+Memory-mapped copies of the raw electrode signals, an optional alternative to the /raw hdf5 store.
+
+Each electrode is stored as one flat binary file with a small JSON header:
+
+- <rec_dir>/raw_memmap
+    - electrode0.dat
+    - electrode0.json
+    - ...
+
+The files are written once at extraction and opened with ``np.memmap``, so readers
+slice them without decompressing or copying the whole electrode, and worker processes
+reading the same electrode share its pages.
+"""
+from __future__ import annotations
+
+import json
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+import tables
+
+MEMMAP_DIR = "raw_memmap"
+
+
+def get_memmap_dir(rec_dir):
+    """Returns the directory holding the memory-mapped raw signals of a recording"""
+    return Path(rec_dir) / MEMMAP_DIR
+
+
+def get_memmap_files(rec_dir, electrode):
+    """Returns the data and header file paths for an electrode"""
+    memmap_dir = get_memmap_dir(rec_dir)
+    return memmap_dir / f"electrode{electrode}.dat", memmap_dir / f"electrode{electrode}.json"
+
+
+def write_raw_memmap(rec_dir, electrode, chunks, fs=None, dtype=np.float64):
+    """
+    Writes chunks of an electrode signal to a flat binary file with a JSON header.
+
+    The header is written last, so a partially written electrode is never opened.
+
+    Parameters
+    ----------
+    rec_dir : str, path to recording directory
+    electrode : int, electrode number
+    chunks : iterable of array-like, consecutive chunks of samples
+    fs : float (optional), sampling rate in Hz
+    dtype : numpy dtype (optional), dtype of the stored samples
+
+    Returns
+    -------
+    int, number of samples written
+    """
+    data_file, header_file = get_memmap_files(rec_dir, electrode)
+    data_file.parent.mkdir(parents=True, exist_ok=True)
+    if header_file.is_file():
+        header_file.unlink()
+
+    dtype = np.dtype(dtype)
+    n_samples = 0
+    with open(data_file, "wb") as f:
+        for chunk in chunks:
+            buffer = np.asarray(chunk, dtype=dtype)
+            buffer.tofile(f)
+            n_samples += buffer.size
+
+    header = {
+        "electrode": int(electrode),
+        "dtype": dtype.str,
+        "n_samples": int(n_samples),
+        "sampling_rate": None if fs is None else float(fs),
+    }
+    with open(header_file, "w") as f:
+        json.dump(header, f, indent=4)
+
+    return n_samples
+
+
+def write_raw_memmap_from_h5(h5_file, electrode, rec_dir=None, chunk_size=1024 * 1024):
+    """
+    Copies /raw/electrodeN from the hdf5 store into a memory-mapped file, block by block.
+
+    Parameters
+    ----------
+    h5_file : str, path to hdf5 store
+    electrode : int, electrode number
+    rec_dir : str (optional), recording directory, defaults to the directory of h5_file
+    chunk_size : int (optional), number of samples copied at a time
+
+    Returns
+    -------
+    int, number of samples written, or None if the electrode is not in the hdf5 store
+    """
+    if rec_dir is None:
+        rec_dir = os.path.dirname(h5_file)
+
+    with tables.open_file(h5_file, "r") as hf5:
+        if f"/raw/electrode{electrode}" not in hf5:
+            return None
+
+        node = hf5.get_node(f"/raw/electrode{electrode}")
+        fs = getattr(node._v_attrs, "sampling_rate", None)
+        chunks = (
+            node.read(start, min(start + chunk_size, node.nrows))
+            for start in range(0, node.nrows, chunk_size)
+        )
+        return write_raw_memmap(rec_dir, electrode, chunks, fs=fs, dtype=node.dtype)
+
+
+def read_raw_memmap_header(rec_dir, electrode):
+    """Returns the JSON header of an electrode as a dict, None if it does not exist"""
+    _, header_file = get_memmap_files(rec_dir, electrode)
+    if not header_file.is_file():
+        return None
+
+    with open(header_file, "r") as f:
+        return json.load(f)
+
+
+def has_raw_memmap(rec_dir, electrode):
+    """True if a complete memory-mapped copy of the electrode exists"""
+    return read_raw_memmap_header(rec_dir, electrode) is not None
+
+
+def is_memmap_current(header, node):
+    """True if the header matches the length and dtype of the /raw/electrodeN node"""
+    return header["n_samples"] == node.nrows and np.dtype(header["dtype"]) == node.dtype
+
+
+def load_raw_memmap(rec_dir, electrode, mode="r", node=None):
+    """
+    Opens the memory-mapped raw signal of an electrode.
+
+    Parameters
+    ----------
+    rec_dir : str, path to recording directory
+    electrode : int, electrode number
+    mode : str (optional), ``np.memmap`` mode, read-only by default
+    node : tables.EArray (optional)
+        the /raw/electrodeN node the copy was made from. If given, the copy is
+        only opened if its length and dtype still match the node, so a stale
+        copy left over from before /raw was rewritten is never read.
+
+    Returns
+    -------
+    np.memmap, or None if no current memory-mapped copy exists
+    """
+    header = read_raw_memmap_header(rec_dir, electrode)
+    if header is None:
+        return None
+
+    if node is not None and not is_memmap_current(header, node):
+        return None
+
+    data_file, _ = get_memmap_files(rec_dir, electrode)
+    if header["n_samples"] == 0:
+        return np.empty(0, dtype=header["dtype"])
+
+    return np.memmap(data_file, dtype=header["dtype"], mode=mode, shape=(header["n_samples"],))
+
+
+def delete_raw_memmap(rec_dir, electrode=None):
+    """Deletes the memory-mapped copy of one electrode, or of all electrodes if electrode is None"""
+    if electrode is None:
+        memmap_dir = get_memmap_dir(rec_dir)
+        if memmap_dir.is_dir():
+            shutil.rmtree(memmap_dir)
+        return
+
+    for file in get_memmap_files(rec_dir, electrode):
+        if file.is_file():
+            file.unlink()
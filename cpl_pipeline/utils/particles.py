@@ -78,6 +78,7 @@ class HMMInfoParticle(tables.IsDescription):
     log_likelihood = tables.Float64Col()
     area = tables.StringCol(15)
     hmm_class = tables.StringCol(20)
+    log_space = tables.BoolCol()
     notes = tables.StringCol(40)
 
 
@@ -109,5 +110,6 @@ class AnonHMMInfoParticle(tables.IsDescription):
     log_likelihood = tables.Float64Col()
     area = tables.StringCol(15)
     hmm_class = tables.StringCol(20)
+    log_space = tables.BoolCol()
     notes = tables.StringCol(30)
     rec_dir = tables.StringCol(150)
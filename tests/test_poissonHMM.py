@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+
+phmm = pytest.importorskip("cpl_pipeline.analysis.poissonHMM")
+hb = pytest.importorskip("cpl_pipeline.analysis.hmm_benchmark")
+
+DT = 0.001
+N_STATES = 3
+MAX_ITER = 300
+THRESHOLD = 1e-7
+RUNG_ITERS = 5
+SEED = 42
+
+
+@pytest.fixture(scope="module")
+def hmm_data():
+    PI, A, B = hb.make_hmm_params(8, N_STATES, seed=0)
+    spikes, _ = hb.generate_hmm_data(PI, A, B, 10, 1500, DT, seed=0)
+    time = np.arange(spikes.shape[-1]) * DT * 1000
+    return spikes, time
+
+
+def fit_alone(spikes, time, seed):
+    hmm = phmm.PoissonHMM(N_STATES, hmm_id=0)
+    hmm.randomize(spikes, DT, time, seed=seed)
+    hmm.fit(spikes, DT, time, max_iter=MAX_ITER, threshold=THRESHOLD)
+    return hmm
+
+
+@pytest.mark.parametrize("n_restarts", [2, 4, 8])
+def test_race_hmm_fits(hmm_data, n_restarts, monkeypatch):
+    spikes, time = hmm_data
+
+    # record every elimination made by the race
+    rankings = []
+    rank = phmm.rank_hmm_trajectories
+
+    def recording_rank(hmms, thresh, n_recent=None):
+        order = rank(hmms, thresh, n_recent=n_recent)
+        rankings.append((list(hmms), order, [h.iteration for h in hmms]))
+        return order
+
+    monkeypatch.setattr(phmm, "rank_hmm_trajectories", recording_rank)
+
+    hmms = [phmm.PoissonHMM(N_STATES, hmm_id=0) for _ in range(n_restarts)]
+    best = phmm.race_hmm_fits(
+        hmms,
+        spikes,
+        DT,
+        time,
+        max_iter=MAX_ITER,
+        threshold=THRESHOLD,
+        rung_iters=RUNG_ITERS,
+        seed=SEED,
+    )
+    alone = [fit_alone(spikes, time, SEED + i) for i in range(n_restarts)]
+
+    assert best.converged
+    # restarts often reach the same optimum, allow for the convergence threshold
+    mean_LL = np.mean([h.fit_LL for h in alone])
+    assert best.fit_LL >= mean_LL - 10 * THRESHOLD * np.abs(mean_LL)
+    assert sum(h.iteration for h in hmms) < n_restarts * MAX_ITER
+
+    # each rung keeps the top of rank_hmm_trajectories, the rest stop fitting
+    assert len(rankings) > 0
+    for k, (active, order, iterations) in enumerate(rankings):
+        n_keep = max(1, int(np.ceil(len(active) * 0.5)))
+        kept = [active[i] for i in order[:n_keep]]
+        if k + 1 < len(rankings):
+            assert rankings[k + 1][0] == kept
+        else:
+            assert best in kept
+
+        for i in order[n_keep:]:
+            assert active[i].iteration == iterations[i]